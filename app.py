@@ -1,20 +1,30 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, send_file, flash, jsonify, g, has_request_context
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
-import pandas as pd
-import sqlite3, psycopg2, os, io, pytz, json
+from datetime import datetime, date, timedelta
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturoTimeout
+from dataclasses import dataclass, field
+from typing import NamedTuple
+import sqlite3, os, io, re, csv, unicodedata, base64, hashlib, tempfile, functools, pytz, json, threading, time, queue, select
 from dateutil.relativedelta import relativedelta
-try:
-    import psycopg2
-except ImportError:
-    psycopg2 = None
-
-app = Flask(__name__)
-app.secret_key = "consigtech_secret_2025"
+from urllib.parse import quote
 
 DATABASE_URL = os.environ.get("DATABASE_URL", "").replace("postgres://", "postgresql://")
 LOCAL_DB = "local.db"
 
+# psycopg2 só é carregado quando há PostgreSQL configurado (o SQLite local não precisa)
+psycopg2 = None
+if DATABASE_URL:
+    try:
+        import psycopg2
+        import psycopg2.extensions
+    except ImportError:
+        psycopg2 = None
+
+app = Flask(__name__)
+app.secret_key = "consigtech_secret_2025"
+
 @app.template_filter('brl')
 def format_brl(value):
     try:
@@ -23,16 +33,889 @@ def format_brl(value):
     except Exception:
         return "R$ 0,00"
 
-def get_conn():
+# Pool de conexões: dimensionado para os threads de cada worker do Gunicorn
+# (Procfile: --workers=3 --threads=4), ou seja, uma conexão por thread.
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 4))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", 1800))
+DB_POOL_CHECK_IDLE = float(os.environ.get("DB_POOL_CHECK_IDLE", 30))
+
+# Réplica de leitura opcional: as rotas só de leitura pedem get_conn(leitura=True).
+# Sem réplica, ou com ela fora do ar (fica de lado por REPLICA_PAUSA segundos), vai
+# tudo para o primário. REPLICA_JANELA > 0 manda as leituras de quem acabou de gravar
+# para o primário por essa quantidade de segundos. Para testar com SQLite, use
+# DATABASE_READ_URL=sqlite:///caminho/da/copia.db.
+DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL", "").replace("postgres://", "postgresql://")
+REPLICA_PAUSA = float(os.environ.get("REPLICA_PAUSA", 30))
+REPLICA_JANELA = float(os.environ.get("REPLICA_JANELA", 0))
+
+# SQLite em produção (filiais pequenas): WAL deixa leitores e o escritor trabalharem
+# ao mesmo tempo, busy_timeout espera o lock em vez de falhar com "database is
+# locked". SQLITE_FILA_ESCRITA=1 liga o escritor único por processo, que serializa as
+# escritas das rotas e faz um commit por grupo (até SQLITE_GRUPO_MAX escritas).
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_MB", 64)) * 1024 * 1024,
+    "cache_size": -int(os.environ.get("SQLITE_CACHE_MB", 16)) * 1024,
+}
+SQLITE_FILA_ESCRITA = os.environ.get("SQLITE_FILA_ESCRITA", "0") == "1"
+SQLITE_GRUPO_MAX = int(os.environ.get("SQLITE_GRUPO_MAX", 64))
+SQLITE_FILA_ESPERA = float(os.environ.get("SQLITE_FILA_ESPERA", 30))
+
+
+def _registrar_emprestimo(conn):
+    if has_request_context():
+        g.setdefault("conexoes", []).append(conn)
+
+
+def _registrar_devolucao(conn):
+    if has_request_context():
+        conexoes = g.get("conexoes") or []
+        if conn in conexoes:
+            conexoes.remove(conn)
+
+
+# Instrumentação: todo cursor devolvido por get_conn() mede as consultas, agrupa
+# por fingerprint (SQL sem literais) e soma o tempo de banco da requisição.
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
+
+_consultas_stats = {}
+_consultas_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint_sql(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"%s|\b\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", sql)
+    sql = re.sub(r"\(\?, \.\.\.\)(?:\s*,\s*\(\?, \.\.\.\))+", "(?, ...), ...", sql)
+    return " ".join(sql.split()).rstrip(";")
+
+
+def registrar_consulta(sql, duracao, linhas):
+    impressao = fingerprint_sql(sql)
+    rota = request.endpoint if has_request_context() else None
+    with _consultas_lock:
+        stats = _consultas_stats.get(impressao)
+        if stats is None:
+            stats = _consultas_stats[impressao] = {
+                "chamadas": 0, "tempo_total": 0.0, "tempo_max": 0.0, "linhas": 0, "rotas": set()
+            }
+        stats["chamadas"] += 1
+        stats["tempo_total"] += duracao
+        stats["tempo_max"] = max(stats["tempo_max"], duracao)
+        stats["linhas"] += max(linhas, 0)
+        stats["rotas"].add(rota or "-")
+
+    if has_request_context():
+        g.db_consultas = g.get("db_consultas", 0) + 1
+        g.db_tempo = g.get("db_tempo", 0.0) + duracao
+
+    if duracao * 1000 >= SLOW_QUERY_MS:
+        print(f"🐢 Consulta lenta ({duracao * 1000:.0f} ms, {max(linhas, 0)} linhas, rota {rota or '-'}): {impressao[:300]}")
+    return stats
+
+
+def somar_linhas(stats, linhas):
+    with _consultas_lock:
+        stats["linhas"] += linhas
+
+
+def consultas_mais_lentas(n=20, ordem="tempo_max"):
+    with _consultas_lock:
+        itens = [
+            {
+                "sql": impressao,
+                "chamadas": s["chamadas"],
+                "tempo_total_ms": round(s["tempo_total"] * 1000, 2),
+                "tempo_medio_ms": round(s["tempo_total"] * 1000 / s["chamadas"], 2),
+                "tempo_max_ms": round(s["tempo_max"] * 1000, 2),
+                "linhas": s["linhas"],
+                "rotas": sorted(s["rotas"]),
+            }
+            for impressao, s in _consultas_stats.items()
+        ]
+    chave = {"tempo_max": "tempo_max_ms", "tempo_total": "tempo_total_ms", "chamadas": "chamadas"}.get(ordem, "tempo_max_ms")
+    return sorted(itens, key=lambda i: i[chave], reverse=True)[:n]
+
+
+class _CursorInstrumentado:
+    # No SQLite rowcount é -1 para SELECT; nesse caso as linhas são contadas no fetch.
+    _stats = None
+
+    def execute(self, sql, params=None):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql) if params is None else super().execute(sql, params)
+        finally:
+            self._stats = registrar_consulta(sql, time.perf_counter() - inicio, self.rowcount)
+
+    def executemany(self, sql, seq_params):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_params)
+        finally:
+            self._stats = registrar_consulta(sql, time.perf_counter() - inicio, self.rowcount)
+
+    def fetchall(self):
+        linhas = super().fetchall()
+        if self._stats is not None and self.rowcount < 0:
+            somar_linhas(self._stats, len(linhas))
+        return linhas
+
+    def fetchmany(self, *args, **kwargs):
+        linhas = super().fetchmany(*args, **kwargs)
+        if self._stats is not None and self.rowcount < 0:
+            somar_linhas(self._stats, len(linhas))
+        return linhas
+
+
+class CursorSQLite(_CursorInstrumentado, sqlite3.Cursor):
+    pass
+
+
+if psycopg2:
+    class CursorPostgres(_CursorInstrumentado, psycopg2.extensions.cursor):
+        pass
+
+
+class ConexaoSQLite(sqlite3.Connection):
+    # Uma conexão reaproveitada por thread, emprestada como EmprestimoSQLite: quando o
+    # último empréstimo volta, só desfaz o que não foi commitado. fechar() encerra de verdade.
+    emprestimos = 0
+
+    def devolver(self):
+        self.emprestimos = max(self.emprestimos - 1, 0)
+        if self.emprestimos == 0 and self.in_transaction:
+            self.rollback()
+
+    def cursor(self, factory=CursorSQLite):
+        return super().cursor(factory)
+
+    def fechar(self):
+        sqlite3.Connection.close(self)
+
+
+class EmprestimoSQLite:
+    # Como EmprestimoPostgres: cada get_conn() recebe o seu, e close() devolve uma vez
+    # só. Sem isso um close() repetido (o do except depois do normal, o do teardown)
+    # descontaria o empréstimo de outro trecho que ainda usa a conexão do thread.
+    # Passa por sqlite3.Connection nos isinstance das rotas.
+    def __init__(self, conn):
+        self._conn = conn
+
+    @property
+    def __class__(self):
+        return ConexaoSQLite
+
+    def __getattr__(self, nome):
+        conn = self.__dict__["_conn"]
+        if conn is None:
+            raise sqlite3.ProgrammingError("conexão já devolvida")
+        return getattr(conn, nome)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        _registrar_devolucao(self)
+        conn.devolver()
+
+
+if psycopg2:
+    class ConexaoPostgres(psycopg2.extensions.connection):
+        # Fica dentro do pool; quem pede conexão recebe um EmprestimoPostgres.
+        # fechar() encerra de verdade.
+        def fechar(self):
+            psycopg2.extensions.connection.close(self)
+
+
+class EmprestimoPostgres:
+    # Um empréstimo do pool: close() devolve a conexão uma vez só. Um close() repetido
+    # (o do except depois do close normal, o do teardown) não toca na conexão, que a
+    # essa altura pode estar com outra thread. Depois de devolvido, não serve mais.
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, nome):
+        conn = self.__dict__["_conn"]
+        if conn is None:
+            raise psycopg2.InterfaceError("conexão já devolvida ao pool")
+        return getattr(conn, nome)
+
+    @property
+    def closed(self):
+        return 1 if self._conn is None else self._conn.closed
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        _registrar_devolucao(self)
+        conn.pool.devolver(conn)
+
+
+class PoolConexoes:
+    def __init__(self, dsn, maximo=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 vida_maxima=DB_POOL_MAX_LIFETIME, checar_ocioso=DB_POOL_CHECK_IDLE):
+        self.dsn = dsn
+        self.maximo = maximo
+        self.timeout = timeout
+        self.vida_maxima = vida_maxima
+        self.checar_ocioso = checar_ocioso
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._ociosas = []
+        self._total = 0
+        self.stats = {
+            "checkouts": 0,
+            "esperas": 0,
+            "tempo_espera": 0.0,
+            "timeouts": 0,
+            "criadas": 0,
+            "recicladas": 0,
+            "descartadas": 0,
+        }
+
+    def _criar(self):
+        conn = psycopg2.connect(self.dsn, sslmode="require", connection_factory=ConexaoPostgres)
+        conn.cursor_factory = CursorPostgres
+        conn.pool = self
+        conn.criada_em = time.monotonic()
+        conn.devolvida_em = conn.criada_em
+        conn.emprestada = False
+        with self._cond:
+            self.stats["criadas"] += 1
+        return conn
+
+    def _descartar(self, conn, motivo="descartadas"):
+        try:
+            conn.fechar()
+        except Exception:
+            pass
+        with self._cond:
+            self._total -= 1
+            self.stats[motivo] += 1
+            self._cond.notify()
+
+    def _validar(self, conn):
+        agora = time.monotonic()
+        if conn.closed or agora - conn.criada_em > self.vida_maxima:
+            self._descartar(conn, "recicladas")
+            return None
+        if agora - conn.devolvida_em > self.checar_ocioso:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                conn.rollback()
+            except Exception:
+                self._descartar(conn)
+                return None
+        return conn
+
+    def emprestar(self):
+        while True:
+            conn, criar = None, False
+            inicio_espera = None
+            with self._cond:
+                while True:
+                    if self._ociosas:
+                        conn = self._ociosas.pop()
+                        break
+                    if self._total < self.maximo:
+                        self._total += 1
+                        criar = True
+                        break
+                    if inicio_espera is None:
+                        inicio_espera = time.monotonic()
+                        self.stats["esperas"] += 1
+                    restante = self.timeout - (time.monotonic() - inicio_espera)
+                    if restante <= 0:
+                        self.stats["timeouts"] += 1
+                        raise RuntimeError("Pool de conexões esgotado")
+                    self._cond.wait(restante)
+                if inicio_espera is not None:
+                    self.stats["tempo_espera"] += time.monotonic() - inicio_espera
+                self.stats["checkouts"] += 1
+
+            if criar:
+                try:
+                    conn = self._criar()
+                except Exception:
+                    with self._cond:
+                        self._total -= 1
+                        self._cond.notify()
+                    raise
+            else:
+                conn = self._validar(conn)
+                if conn is None:
+                    with self._cond:
+                        self.stats["checkouts"] -= 1
+                    continue
+
+            conn.emprestada = True
+            return EmprestimoPostgres(conn)
+
+    def devolver(self, conn):
+        if not getattr(conn, "emprestada", False):
+            return
+        conn.emprestada = False
+        if self.pid != os.getpid() or conn.closed:
+            self._descartar(conn)
+            return
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                self._descartar(conn)
+                return
+        conn.devolvida_em = time.monotonic()
+        with self._cond:
+            self._ociosas.append(conn)
+            self._cond.notify()
+
+    def fechar_todas(self):
+        with self._cond:
+            ociosas, self._ociosas = self._ociosas, []
+        for conn in ociosas:
+            self._descartar(conn)
+
+    def estatisticas(self):
+        with self._cond:
+            dados = dict(self.stats)
+            dados.update(maximo=self.maximo, abertas=self._total,
+                         ociosas=len(self._ociosas), em_uso=self._total - len(self._ociosas))
+        return dados
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+_sqlite_local = threading.local()
+_sqlite_stats = {"checkouts": 0, "criadas": 0}
+_sqlite_stats_lock = threading.Lock()
+_replica = {"fora_ate": 0.0, "leituras": 0, "no_primario_janela": 0, "falhas": 0}
+
+
+def pool_conexoes(leitura=False):
+    # Com --preload o pool do processo mestre não pode ser herdado pelos workers.
+    with _pool_lock:
+        pool = _pools.get(leitura)
+        if pool is None or pool.pid != os.getpid():
+            pool = _pools[leitura] = PoolConexoes(DATABASE_READ_URL if leitura else DATABASE_URL)
+        return pool
+
+
+def ajustar_sqlite(conn, somente_leitura=False):
+    # journal_mode fica gravado no arquivo; numa conexão só de leitura não dá para trocar
+    for pragma, valor in SQLITE_PRAGMAS.items():
+        if somente_leitura and pragma in ("journal_mode", "synchronous"):
+            continue
+        conn.execute(f"PRAGMA {pragma} = {valor};")
+
+
+def _conn_sqlite(caminho=None, somente_leitura=False):
+    caminho = caminho or LOCAL_DB
+    if getattr(_sqlite_local, "pid", None) != os.getpid():
+        _sqlite_local.conexoes, _sqlite_local.pid = {}, os.getpid()
+    conn = _sqlite_local.conexoes.get(caminho)
+    if conn is None:
+        if somente_leitura:
+            conn = sqlite3.connect(f"file:{caminho}?mode=ro", uri=True, check_same_thread=False, factory=ConexaoSQLite)
+        else:
+            conn = sqlite3.connect(caminho, check_same_thread=False, factory=ConexaoSQLite)
+        ajustar_sqlite(conn, somente_leitura)
+        _sqlite_local.conexoes[caminho] = conn
+        with _sqlite_stats_lock:
+            _sqlite_stats["criadas"] += 1
+    conn.emprestimos += 1
+    with _sqlite_stats_lock:
+        _sqlite_stats["checkouts"] += 1
+    return EmprestimoSQLite(conn)
+
+
+def _usar_replica():
+    if not DATABASE_READ_URL or time.monotonic() < _replica["fora_ate"]:
+        return False
+    if REPLICA_JANELA > 0 and has_request_context():
+        escrita = session.get("ultima_escrita")
+        if escrita and time.time() - escrita < REPLICA_JANELA:
+            _replica["no_primario_janela"] += 1
+            return False
+    return True
+
+
+def _conn_replica():
+    if DATABASE_READ_URL.startswith("sqlite:///"):
+        if DATABASE_URL:
+            raise RuntimeError("réplica SQLite com primário PostgreSQL")
+        return _conn_sqlite(DATABASE_READ_URL[len("sqlite:///"):], somente_leitura=True)
+    if not (DATABASE_URL and psycopg2):
+        raise RuntimeError("réplica PostgreSQL com primário SQLite")
+    return pool_conexoes(leitura=True).emprestar()
+
+
+def get_conn(leitura=False):
+    conn = None
+    if leitura and _usar_replica():
+        try:
+            conn = _conn_replica()
+            _replica["leituras"] += 1
+        except Exception as e:
+            _replica["fora_ate"] = time.monotonic() + REPLICA_PAUSA
+            _replica["falhas"] += 1
+            print("⚠️ Réplica de leitura indisponível, usando o primário:", e)
+    if conn is None:
+        if DATABASE_URL and psycopg2:
+            conn = pool_conexoes().emprestar()
+        else:
+            conn = _conn_sqlite()
+    _registrar_emprestimo(conn)
+    return conn
+
+
+@contextmanager
+def conexao(leitura=False):
+    conn = get_conn(leitura)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+class FilaEscrita:
+    # Um thread por processo com a única conexão de escrita do SQLite. Cada pedido é
+    # uma função escrita(cur, conn) sem commit; o thread junta o que chegou na fila,
+    # roda cada pedido num SAVEPOINT (o erro de um não desfaz os outros) e faz um
+    # commit só para o grupo. Quem espera desiste depois de SQLITE_FILA_ESPERA
+    # segundos; se o thread morrer, o próximo pedido sobe outro.
+    def __init__(self):
+        self.pid = os.getpid()
+        self._fila = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {"escritas": 0, "grupos": 0, "falhas": 0, "maior_grupo": 0,
+                      "desistencias": 0, "reinicios": 0}
+        self._garantir_thread()
+
+    def _garantir_thread(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if self._thread is not None:
+                self.stats["reinicios"] += 1
+                print("⚠️ Escritor SQLite parou; iniciando outro.")
+            self._thread = threading.Thread(target=self._rodar, name="escritor-sqlite", daemon=True)
+            self._thread.start()
+
+    def executar(self, escrita, subir_versao=True):
+        self._garantir_thread()
+        pedido = {"escrita": escrita, "subir_versao": subir_versao,
+                  "feito": threading.Event(), "resultado": None, "erro": None,
+                  "abandonado": False, "em_andamento": False, "gravado": False, "lock": threading.Lock()}
+        self._fila.put(pedido)
+        if not pedido["feito"].wait(SQLITE_FILA_ESPERA):
+            with pedido["lock"]:
+                # ainda não começou: o escritor vai pular o pedido
+                pedido["abandonado"] = not pedido["em_andamento"]
+            if pedido["abandonado"]:
+                self.stats["desistencias"] += 1
+                raise sqlite3.OperationalError("fila de escrita sem resposta")
+            pedido["feito"].wait()
+        if pedido["erro"] is not None:
+            raise pedido["erro"]
+        return pedido["resultado"]
+
+    def _rodar(self):
+        while True:
+            grupo = [self._fila.get()]
+            while len(grupo) < SQLITE_GRUPO_MAX:
+                try:
+                    grupo.append(self._fila.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._gravar(grupo)
+            except Exception as e:
+                print("❌ Falha no escritor SQLite:", e)
+            finally:
+                for pedido in grupo:
+                    if pedido["erro"] is None and not pedido["gravado"]:
+                        pedido["erro"] = sqlite3.OperationalError("escrita não executada")
+                    pedido["feito"].set()
+
+    def _gravar(self, grupo):
+        # pedidos abandonados por timeout ficam de fora; os outros são marcados como
+        # em andamento para quem espera não desistir no meio do commit
+        ativos = []
+        for pedido in grupo:
+            with pedido["lock"]:
+                if not pedido["abandonado"]:
+                    pedido["em_andamento"] = True
+                    ativos.append(pedido)
+        conn = None
+        try:
+            conn = _conn_sqlite()
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE;")
+            for pedido in ativos:
+                cur.execute("SAVEPOINT pedido;")
+                try:
+                    pedido["resultado"] = pedido["escrita"](cur, conn)
+                    cur.execute("RELEASE SAVEPOINT pedido;")
+                except Exception as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT pedido;")
+                    cur.execute("RELEASE SAVEPOINT pedido;")
+                    pedido["erro"] = e
+                    self.stats["falhas"] += 1
+            if any(pedido["erro"] is None and pedido["subir_versao"] for pedido in ativos):
+                # versão dos dados (ETag dos polls) no mesmo commit do grupo
+                cur.execute("UPDATE cache_versao SET versao = versao + 1 WHERE id = 2;")
+            conn.commit()
+            for pedido in ativos:
+                pedido["gravado"] = pedido["erro"] is None
+        except Exception as e:
+            print("❌ Falha no commit do grupo de escritas:", e)
+            if conn is not None and conn.in_transaction:
+                conn.rollback()
+            for pedido in ativos:
+                if pedido["erro"] is None:
+                    pedido["erro"] = e
+                    self.stats["falhas"] += 1
+        finally:
+            if conn is not None:
+                conn.close()
+        self.stats["escritas"] += len(ativos)
+        self.stats["grupos"] += 1
+        self.stats["maior_grupo"] = max(self.stats["maior_grupo"], len(ativos))
+
+
+_fila_escrita = {"fila": None, "lock": threading.Lock()}
+
+
+def fila_escrita():
+    # Como o pool: com --preload o thread do processo mestre não existe nos workers.
+    with _fila_escrita["lock"]:
+        fila = _fila_escrita["fila"]
+        if fila is None or fila.pid != os.getpid():
+            fila = _fila_escrita["fila"] = FilaEscrita()
+        return fila
+
+
+def executar_escrita(escrita, publicar=True):
+    # escrita(cur, conn) grava sem commit. Com a fila ligada (só SQLite) roda no
+    # escritor único; senão numa conexão normal. Roda em outro thread: nada de
+    # request/session dentro da escrita. Depois do commit, publicar=True avisa telas e
+    # caches (propostas e metas); publicar=False só grava, sem subir a versão dos dados
+    # (usuários e senha, que chamam limpar_cache_cadastros() depois, e as séries).
+    # Toda escrita das rotas passa por aqui. Ficam de fora só o boot (migrações,
+    # garantir_admin e calendário, antes de servir requisições) e o CLI
+    # reconstruir-agregados (processo separado, espera o lock pelo busy_timeout).
+    if SQLITE_FILA_ESCRITA and not DATABASE_URL:
+        resultado = fila_escrita().executar(escrita, subir_versao=publicar)
+        if publicar:
+            with conexao() as conn:
+                publicar_alteracao(conn, subir_versao=False)
+        return resultado
+    with conexao() as conn:
+        cur = conn.cursor()
+        resultado = escrita(cur, conn)
+        # no SQLite a escrita já é serial: a versão sobe no mesmo commit; no PostgreSQL
+        # sobe depois, para a linha de cache_versao não ficar travada na transação
+        sqlite = isinstance(conn, sqlite3.Connection)
+        if sqlite and publicar:
+            cur.execute("UPDATE cache_versao SET versao = versao + 1 WHERE id = 2;")
+        conn.commit()
+        if publicar:
+            publicar_alteracao(conn, subir_versao=not sqlite)
+    return resultado
+
+
+def estatisticas_pool():
     if DATABASE_URL and psycopg2:
-        return psycopg2.connect(DATABASE_URL, sslmode="require")
+        dados = {"backend": "postgres", **pool_conexoes().estatisticas()}
     else:
-        return sqlite3.connect(LOCAL_DB, check_same_thread=False)
+        with _sqlite_stats_lock:
+            dados = {"backend": "sqlite", "journal_mode": SQLITE_PRAGMAS["journal_mode"].lower(), **_sqlite_stats}
+        if _fila_escrita["fila"] is not None:
+            dados["fila_escrita"] = dict(_fila_escrita["fila"].stats)
+    if DATABASE_READ_URL:
+        dados["replica"] = dict(_replica, fora_do_ar=time.monotonic() < _replica["fora_ate"])
+        if True in _pools:
+            dados["replica"].update(_pools[True].estatisticas())
+    dados["senhas"] = estatisticas_senhas()
+    return dados
+
+
+@app.after_request
+def server_timing(resp):
+    if "db_consultas" in g:
+        resp.headers.add(
+            "Server-Timing", f'db;dur={g.db_tempo * 1000:.1f};desc="{g.db_consultas} consultas"'
+        )
+    return resp
 
-def init_db():
-    conn = get_conn()
+
+@app.teardown_request
+def devolver_conexoes(exc):
+    # Rotas que saem por exceção (ou esquecem o close) não seguram a conexão.
+    for conn in list(g.pop("conexoes", [])):
+        conn.close()
+
+
+class CacheTTL:
+    def __init__(self, ttl, max_itens=256):
+        self.ttl = ttl
+        self.max_itens = max_itens
+        self._itens = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expirados": 0}
+
+    def obter(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                self.stats["misses"] += 1
+                return None
+            if item[0] < time.monotonic():
+                del self._itens[chave]
+                self.stats["misses"] += 1
+                self.stats["expirados"] += 1
+                return None
+            self.stats["hits"] += 1
+            return item[1]
+
+    def guardar(self, chave, valor):
+        with self._lock:
+            if chave not in self._itens and len(self._itens) >= self.max_itens:
+                agora = time.monotonic()
+                for k in [k for k, (expira, _) in self._itens.items() if expira < agora]:
+                    del self._itens[k]
+                if len(self._itens) >= self.max_itens:
+                    del self._itens[next(iter(self._itens))]
+            self._itens[chave] = (time.monotonic() + self.ttl, valor)
+
+    def limpar(self):
+        with self._lock:
+            self._itens.clear()
+
+    def estatisticas(self):
+        with self._lock:
+            return {**self.stats, "itens": len(self._itens), "ttl": self.ttl}
+
+
+FONTES_LISTA = [
+    "URA",
+    "Disparo/Whatsapp",
+    "Disparo/SMS",
+    "Indicação",
+    "Discadora",
+    "Tráfego"
+]
+
+BANCOS_LISTA = ["C6", "Qualibank", "PAN", "V8", "Amigoz", "Facta-CLT", "Facta-FGTS", "Tá Quitado", "C6 INSS", "C6 CLT", "BMG"]
+
+OBSERVACOES_LISTA = ["PAGO", "AGUARDANDO SALDO", "EM ANÁLISE", "REPRESENTAÇÃO", "CANCELADO", "AGUARDANDO AVERBAÇÃO"]
+
+MOTIVOS_CANCELAMENTO = [
+    "Contrato liquidado/finalizado",
+    "Variação de valores",
+    "Retenção",
+    "Contrato em andamento",
+    "Número divergente do contrato",
+    "Desistência",
+    "Margem excedida",
+]
+
+# Status, fonte e banco também são gravados como códigos inteiros pequenos, com uma
+# tabela de códigos por dimensão (semeada com as listas acima, na ordem). As consultas
+# de agregação filtram e agrupam pelos códigos; o texto fica para exibição e exportação.
+DIMENSOES = {
+    "fonte": ("fontes", FONTES_LISTA),
+    "banco": ("bancos", BANCOS_LISTA),
+    "status": ("status_proposta", OBSERVACOES_LISTA),
+}
+COLUNAS_DIMENSAO = ["fonte_id", "banco_id", "status_id"]
+
+# Agregado diário de propostas (consultor × dia × fonte × banco × status), mantido
+# pelas rotas de escrita via ajustar_agregados() e usado pelas telas de leitura.
+CHAVE_AGREGADO = "consultor, dia, fonte_id, banco_id, status_id"
+
+def expr_dia(conn):
+    return "substr(data, 1, 10)" if isinstance(conn, sqlite3.Connection) else "CAST(data AS DATE)"
+
+def colunas_chave_agregado(conn):
+    # a linha de propostas_diarias (CHAVE_AGREGADO) em que cada proposta cai
+    return f"""COALESCE(consultor, ''),
+               {expr_dia(conn)},
+               COALESCE(fonte_id, 0),
+               COALESCE(banco_id, 0),
+               COALESCE(status_id, 0)"""
+
+def select_agregado(conn, sinal=1):
+    return f"""
+        SELECT {colunas_chave_agregado(conn)},
+               {sinal} * COUNT(*),
+               {sinal} * COALESCE(SUM(valor_equivalente), 0),
+               {sinal} * COALESCE(SUM(valor_original), 0)
+        FROM propostas
+    """
+
+def ajustar_agregados(cur, conn, ids, sinal):
+    # sinal=-1 antes de alterar/excluir as propostas, sinal=+1 depois de inserir/alterar.
+    if not ids:
+        return
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+    cur.execute(f"""
+        INSERT INTO propostas_diarias ({CHAVE_AGREGADO}, qtd, total_eq, total_or)
+        {select_agregado(conn, sinal)}
+        WHERE id IN ({','.join([ph] * len(ids))}) AND data IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5
+        ON CONFLICT ({CHAVE_AGREGADO}) DO UPDATE SET
+            qtd = propostas_diarias.qtd + excluded.qtd,
+            total_eq = propostas_diarias.total_eq + excluded.total_eq,
+            total_or = propostas_diarias.total_or + excluded.total_or
+    """, tuple(ids))
+    if sinal < 0:
+        # só as chaves que acabaram de ser ajustadas, não o agregado inteiro
+        cur.execute(f"""
+            DELETE FROM propostas_diarias
+            WHERE qtd <= 0 AND ({CHAVE_AGREGADO}) IN (
+                SELECT {colunas_chave_agregado(conn)}
+                FROM propostas
+                WHERE id IN ({','.join([ph] * len(ids))}) AND data IS NOT NULL
+            )
+        """, tuple(ids))
+    cur.execute(f"""
+        INSERT INTO series_pendentes (dia)
+        SELECT DISTINCT {expr_dia(conn)} FROM propostas
+        WHERE id IN ({','.join([ph] * len(ids))}) AND data IS NOT NULL
+        ON CONFLICT (dia) DO UPDATE SET dia = excluded.dia
+    """, tuple(ids))
+
+def reconstruir_agregados(conn):
+    cur = conn.cursor()
+    cur.execute("DELETE FROM propostas_diarias;")
+    cur.execute(f"""
+        INSERT INTO propostas_diarias ({CHAVE_AGREGADO}, qtd, total_eq, total_or)
+        {select_agregado(conn)}
+        WHERE data IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5
+    """)
+    reconstruir_series(cur, conn)
+    conn.commit()
+
+
+# Séries para os gráficos (/api/series): o agregado diário condensado por dia em uma
+# linha total e uma por consultor, fonte e banco, com pagos e cancelados já separados.
+# As escritas só marcam o dia em series_pendentes; quem lê recalcula esses dias a
+# partir de propostas_diarias antes de consultar.
+SERIES_DIMENSOES = {
+    "": "''",
+    "consultor": "consultor",
+    "fonte": "CAST(fonte_id AS TEXT)",
+    "banco": "CAST(banco_id AS TEXT)",
+}
+SERIES_METRICAS = ["qtd", "pagos_qtd", "pagos_eq", "cancelados_qtd", "cancelados_eq"]
+
+
+def _inserir_series(cur, conn, filtro="", params=()):
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+    pago = codigo_dimensao(cur, "status", "PAGO") or 0
+    cancelado = codigo_dimensao(cur, "status", "CANCELADO") or 0
+    for dimensao, valor in SERIES_DIMENSOES.items():
+        cur.execute(f"""
+            INSERT INTO propostas_series (dimensao, valor, dia, {', '.join(SERIES_METRICAS)})
+            SELECT {ph}, {valor}, dia, SUM(qtd),
+                   SUM(CASE WHEN status_id = {ph} THEN qtd ELSE 0 END),
+                   SUM(CASE WHEN status_id = {ph} THEN total_eq ELSE 0 END),
+                   SUM(CASE WHEN status_id = {ph} THEN qtd ELSE 0 END),
+                   SUM(CASE WHEN status_id = {ph} THEN total_eq ELSE 0 END)
+            FROM propostas_diarias
+            {filtro}
+            GROUP BY 2, 3
+        """, (dimensao, pago, pago, cancelado, cancelado, *params))
+
+
+def reconstruir_series(cur, conn):
+    cur.execute("DELETE FROM propostas_series;")
+    cur.execute("DELETE FROM series_pendentes;")
+    _inserir_series(cur, conn)
+
+
+def atualizar_series(cur, conn):
+    # Roda por executar_escrita(), sem commit. Sem pendências não grava nada. A marca
+    # sai antes do recálculo: uma escrita que chegue no meio marca o dia de novo e ele
+    # é refeito na próxima. As escritas marcam com DO UPDATE (não DO NOTHING) para
+    # travar a linha: assim este DELETE espera o commit de quem marcou e o recálculo
+    # já enxerga a escrita.
+    cur.execute("SELECT 1 FROM series_pendentes LIMIT 1;")
+    if not cur.fetchone():
+        return 0
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+    cur.execute("DELETE FROM series_pendentes RETURNING dia;")
+    dias = [r[0] for r in cur.fetchall()]
+    for i in range(0, len(dias), 500):
+        pagina = dias[i:i + 500]
+        lista = ",".join([ph] * len(pagina))
+        cur.execute(f"DELETE FROM propostas_series WHERE dia IN ({lista});", pagina)
+        _inserir_series(cur, conn, f"WHERE dia IN ({lista})", pagina)
+    return len(dias)
+
+def divergencias_agregados(conn):
     cur = conn.cursor()
+    cur.execute(f"SELECT {CHAVE_AGREGADO}, qtd, total_eq, total_or FROM propostas_diarias;")
+    tabela = {tuple(str(c) for c in r[:5]): r[5:] for r in cur.fetchall()}
+    cur.execute(f"{select_agregado(conn)} WHERE data IS NOT NULL GROUP BY 1, 2, 3, 4, 5;")
+    bruto = {tuple(str(c) for c in r[:5]): r[5:] for r in cur.fetchall()}
+
+    divergentes = []
+    for chave in tabela.keys() | bruto.keys():
+        esperado = bruto.get(chave, (0, 0, 0))
+        atual = tabela.get(chave, (0, 0, 0))
+        if any(abs(float(a or 0) - float(e or 0)) > 0.005 for a, e in zip(atual, esperado)):
+            divergentes.append((chave, atual, esperado))
+    return divergentes
+
+# Colunas de busca gravadas junto com a proposta: nome sem acentos em minúsculas e
+# CPF só com dígitos, para as buscas usarem índice em vez de tratar o texto linha a linha.
+COLUNAS_BUSCA = ["nome_busca", "cpf_digitos"]
+
+def sem_acentos(texto):
+    return "".join(c for c in unicodedata.normalize("NFKD", texto) if not unicodedata.combining(c))
+
+@functools.lru_cache(maxsize=4096)
+def _chave_texto(texto):
+    return re.sub(r"[^a-z0-9]+", "_", sem_acentos(str(texto)).lower()).strip("_")
+
+def _mapa_canonico(lista):
+    return {_chave_texto(item): item for item in lista}
+
+def colunas_busca(nome_cliente, cpf):
+    nome = " ".join(sem_acentos(str(nome_cliente)).lower().split()) if nome_cliente else ""
+    digitos = re.sub(r"\D", "", str(cpf)) if cpf else ""
+    return nome or None, digitos or None
+
+# Migrações versionadas do schema. Rodam uma vez no boot (ou via `flask migrar`),
+# serializadas por advisory lock no PostgreSQL e BEGIN IMMEDIATE no SQLite;
+# as rotas não executam DDL. Migrações novas entram no fim da lista. Uma migração
+# publicada não muda mais: o SQL e os valores ficam escritos nela, sem ler constantes
+# nem chamar funções do módulo (só _colunas_existentes, que inspeciona o schema), e
+# qualquer mudança de schema vira uma migração nova.
+SCHEMA_LOCK_ID = 7203114
+
+
+def _colunas_existentes(cur, conn, tabela):
+    if isinstance(conn, sqlite3.Connection):
+        cur.execute(f"PRAGMA table_info({tabela});")
+        return {c[1] for c in cur.fetchall()}
+    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s;", (tabela,))
+    return {c[0] for c in cur.fetchall()}
 
+
+def _m001_tabelas_base(conn, cur):
     if isinstance(conn, sqlite3.Connection):
         cur.execute("""CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -78,142 +961,854 @@ def init_db():
             telefone TEXT
         )""")
 
-    cur.execute("SELECT * FROM users WHERE nome = ?" if isinstance(conn, sqlite3.Connection)
-                else "SELECT * FROM users WHERE nome = %s", ("admin",))
-    if not cur.fetchone():
-        senha_hash = generate_password_hash("Tech@2025")
-        cur.execute("INSERT INTO users (nome, senha, role) VALUES (?, ?, ?)" if isinstance(conn, sqlite3.Connection)
-                    else "INSERT INTO users (nome, senha, role) VALUES (%s, %s, %s)",
-                    ("admin", senha_hash, "admin"))
-    conn.commit()
-    conn.close()
 
-init_db()
+def _m002_colunas_propostas(conn, cur):
+    sqlite = isinstance(conn, sqlite3.Connection)
+    colunas = {
+        "banco": "TEXT",
+        "produto": "TEXT",
+        "valor_parcela": "REAL" if sqlite else "NUMERIC(12,2)",
+        "quantidade_parcelas": "INTEGER",
+        "data_pagamento_prevista": "TEXT",
+        "motivo_cancelamento": "TEXT",
+    }
+    existentes = _colunas_existentes(cur, conn, "propostas")
+    for col, tipo in colunas.items():
+        if col not in existentes:
+            cur.execute(f"ALTER TABLE propostas ADD COLUMN {col} {tipo};")
 
-def ensure_banco_column():
-    conn = get_conn()
-    cur = conn.cursor()
 
-    try:
-        if isinstance(conn, sqlite3.Connection):
-            cur.execute("PRAGMA table_info(propostas);")
-            colunas = [col[1] for col in cur.fetchall()]
+def _m003_tabelas_metas(conn, cur):
+    if isinstance(conn, sqlite3.Connection):
+        serial, numero = "INTEGER PRIMARY KEY AUTOINCREMENT", "REAL"
+    else:
+        serial, numero = "SERIAL PRIMARY KEY", "NUMERIC(12,2)"
+    cur.execute(f"CREATE TABLE IF NOT EXISTS metas_globais (id {serial}, valor {numero})")
+    cur.execute(f"CREATE TABLE IF NOT EXISTS metas_individuais (id {serial}, consultor TEXT UNIQUE, meta {numero})")
+    cur.execute(f"CREATE TABLE IF NOT EXISTS meta_dia (id {serial}, valor {numero})")
 
-            if "banco" not in colunas:
-                print("🛠️ Adicionando coluna 'banco' no SQLite...")
-                cur.execute("ALTER TABLE propostas ADD COLUMN banco TEXT;")
 
-            if "produto" not in colunas:
-                print("🛠️ Adicionando coluna 'produto' no SQLite...")
-                cur.execute("ALTER TABLE propostas ADD COLUMN produto TEXT;")
+def _m004_agregado_diario(conn, cur):
+    # versão original do agregado, com as dimensões em texto; a 008 troca por códigos
+    if isinstance(conn, sqlite3.Connection):
+        dia, numero, dia_data = "TEXT", "REAL", "substr(data, 1, 10)"
+    else:
+        dia, numero, dia_data = "DATE", "NUMERIC(14,2)", "CAST(data AS DATE)"
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS propostas_diarias (
+            consultor TEXT NOT NULL,
+            dia {dia} NOT NULL,
+            fonte TEXT NOT NULL,
+            banco TEXT NOT NULL,
+            status TEXT NOT NULL,
+            qtd INTEGER NOT NULL DEFAULT 0,
+            total_eq {numero} NOT NULL DEFAULT 0,
+            total_or {numero} NOT NULL DEFAULT 0,
+            PRIMARY KEY (consultor, dia, fonte, banco, status)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_propostas_diarias_dia ON propostas_diarias (dia, status);")
+    cur.execute("DELETE FROM propostas_diarias;")
+    cur.execute(f"""
+        INSERT INTO propostas_diarias (consultor, dia, fonte, banco, status, qtd, total_eq, total_or)
+        SELECT COALESCE(consultor, ''), {dia_data}, COALESCE(fonte, ''), COALESCE(banco, ''),
+               COALESCE(UPPER(observacao), ''), COUNT(*),
+               COALESCE(SUM(valor_equivalente), 0), COALESCE(SUM(valor_original), 0)
+        FROM propostas
+        WHERE data IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5
+    """)
 
-            if "valor_parcela" not in colunas:
-                print("🛠️ Adicionando coluna 'valor_parcela' no SQLite...")
-                cur.execute("ALTER TABLE propostas ADD COLUMN valor_parcela REAL;")
 
-            if "quantidade_parcelas" not in colunas:
-                print("🛠️ Adicionando coluna 'quantidade_parcelas' no SQLite...")
-                cur.execute("ALTER TABLE propostas ADD COLUMN quantidade_parcelas INTEGER;")
+def _m005_indices_propostas(conn, cur):
+    # (data, id) e (consultor, data, id) atendem a paginação por cursor e substituem os
+    # índices só por data; o de status por texto sai na 008, trocado pelo de status_id
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_propostas_data_id ON propostas (data, id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_propostas_consultor_data_id ON propostas (consultor, data, id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_propostas_status_data ON propostas (UPPER(observacao), data);")
+    cur.execute("DROP INDEX IF EXISTS idx_propostas_data;")
+    cur.execute("DROP INDEX IF EXISTS idx_propostas_consultor_data;")
+
+
+def _m006_versao_cache(conn, cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS cache_versao (id INTEGER PRIMARY KEY, versao INTEGER NOT NULL DEFAULT 0)")
+    cur.execute("INSERT INTO cache_versao (id, versao) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;")
+
+
+def _m007_colunas_busca(conn, cur):
+    sqlite = isinstance(conn, sqlite3.Connection)
+    ph = "?" if sqlite else "%s"
+    existentes = _colunas_existentes(cur, conn, "propostas")
+    for col in ("nome_busca", "cpf_digitos"):
+        if col not in existentes:
+            cur.execute(f"ALTER TABLE propostas ADD COLUMN {col} TEXT;")
+
+    def busca(nome_cliente, cpf):
+        # cópia de colunas_busca() como estava nesta versão
+        nome = ""
+        if nome_cliente:
+            nome = "".join(c for c in unicodedata.normalize("NFKD", str(nome_cliente)) if not unicodedata.combining(c))
+            nome = " ".join(nome.lower().split())
+        digitos = re.sub(r"\D", "", str(cpf)) if cpf else ""
+        return nome or None, digitos or None
+
+    # preenche as propostas existentes em lotes por id
+    ultimo = 0
+    while True:
+        cur.execute(f"SELECT id, nome_cliente, cpf FROM propostas WHERE id > {ph} ORDER BY id LIMIT 5000;", (ultimo,))
+        linhas = cur.fetchall()
+        if not linhas:
+            break
+        valores = [(*busca(nome, cpf), id_) for id_, nome, cpf in linhas]
+        if sqlite:
+            cur.executemany("UPDATE propostas SET nome_busca = ?, cpf_digitos = ? WHERE id = ?;", valores)
+        else:
+            for i in range(0, len(valores), 500):
+                pagina = valores[i:i + 500]
+                cur.execute(f"""
+                    UPDATE propostas SET nome_busca = v.nome, cpf_digitos = v.cpf
+                    FROM (VALUES {','.join(['(%s, %s, %s)'] * len(pagina))}) AS v (nome, cpf, id)
+                    WHERE propostas.id = v.id
+                """, [v for linha in pagina for v in linha])
+        ultimo = linhas[-1][0]
+
+    if sqlite:
+        # CPF exato e prefixo (GLOB) pelo btree; trecho do nome pelo FTS5 com trigramas
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_propostas_cpf_digitos ON propostas (cpf_digitos);")
+        try:
+            cur.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS propostas_busca USING fts5(
+                    nome_busca, content='propostas', content_rowid='id', tokenize='trigram'
+                )
+            """)
+        except sqlite3.OperationalError as e:
+            print("⚠️ FTS5 indisponível, busca por nome sem índice:", e)
+            return
+        cur.execute("INSERT INTO propostas_busca (propostas_busca) VALUES ('rebuild');")
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS propostas_busca_ai AFTER INSERT ON propostas BEGIN
+                INSERT INTO propostas_busca (rowid, nome_busca) VALUES (new.id, new.nome_busca);
+            END
+        """)
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS propostas_busca_ad AFTER DELETE ON propostas BEGIN
+                INSERT INTO propostas_busca (propostas_busca, rowid, nome_busca) VALUES ('delete', old.id, old.nome_busca);
+            END
+        """)
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS propostas_busca_au AFTER UPDATE OF nome_busca ON propostas BEGIN
+                INSERT INTO propostas_busca (propostas_busca, rowid, nome_busca) VALUES ('delete', old.id, old.nome_busca);
+                INSERT INTO propostas_busca (rowid, nome_busca) VALUES (new.id, new.nome_busca);
+            END
+        """)
+    else:
+        # text_pattern_ops atende = e LIKE 'prefixo%' independente da collation
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_propostas_cpf_digitos ON propostas (cpf_digitos text_pattern_ops);")
+        cur.execute("SAVEPOINT trigramas;")
+        try:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_propostas_nome_busca ON propostas USING gin (nome_busca gin_trgm_ops);")
+            cur.execute("RELEASE SAVEPOINT trigramas;")
+        except psycopg2.Error as e:
+            cur.execute("ROLLBACK TO SAVEPOINT trigramas;")
+            print("⚠️ pg_trgm indisponível, busca por nome sem índice:", e)
 
-            if "data_pagamento_prevista" not in colunas:
-                print("🛠️ Adicionando coluna 'data_pagamento_prevista' no SQLite...")
-                cur.execute("ALTER TABLE propostas ADD COLUMN data_pagamento_prevista TEXT;")
 
-            if "motivo_cancelamento" not in colunas:
-                print("🛠️ Adicionando coluna 'motivo_cancelamento' no SQLite...")
-                cur.execute("ALTER TABLE propostas ADD COLUMN motivo_cancelamento TEXT;")
-            
-            conn.commit()
-            print("✅ Colunas garantidas no SQLite.")
+def _criar_codigo(cur, conn, tabela, nome, chave):
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+    cur.execute(f"SELECT id FROM {tabela} WHERE chave = {ph};", (chave,))
+    row = cur.fetchone()
+    if row:
+        return row[0]
+    cur.execute(f"INSERT INTO {tabela} (nome, chave) VALUES ({ph}, {ph}) ON CONFLICT (chave) DO NOTHING;", (nome, chave))
+    cur.execute(f"SELECT id FROM {tabela} WHERE chave = {ph};", (chave,))
+    return cur.fetchone()[0]
+
+
+def _m008_codigos_dimensoes(conn, cur):
+    sqlite = isinstance(conn, sqlite3.Connection)
+    ph = "?" if sqlite else "%s"
+    serial = "INTEGER PRIMARY KEY AUTOINCREMENT" if sqlite else "SMALLSERIAL PRIMARY KEY"
+    existentes = _colunas_existentes(cur, conn, "propostas")
+
+    # cópias de _chave_texto() e _criar_codigo() como estavam nesta versão
+    def chave_de(texto):
+        sem_acento = "".join(c for c in unicodedata.normalize("NFKD", str(texto)) if not unicodedata.combining(c))
+        return re.sub(r"[^a-z0-9]+", "_", sem_acento.lower()).strip("_")
+
+    def criar_codigo(tabela, nome, chave):
+        cur.execute(f"SELECT id FROM {tabela} WHERE chave = {ph};", (chave,))
+        row = cur.fetchone()
+        if row:
+            return row[0]
+        cur.execute(f"INSERT INTO {tabela} (nome, chave) VALUES ({ph}, {ph}) ON CONFLICT (chave) DO NOTHING;", (nome, chave))
+        cur.execute(f"SELECT id FROM {tabela} WHERE chave = {ph};", (chave,))
+        return cur.fetchone()[0]
+
+    # as tabelas de códigos são semeadas com as listas de opções das telas nesta versão
+    dimensoes = [
+        ("fonte", "fontes", "fonte_id",
+         ["URA", "Disparo/Whatsapp", "Disparo/SMS", "Indicação", "Discadora", "Tráfego"]),
+        ("banco", "bancos", "banco_id",
+         ["C6", "Qualibank", "PAN", "V8", "Amigoz", "Facta-CLT", "Facta-FGTS", "Tá Quitado", "C6 INSS", "C6 CLT", "BMG"]),
+        ("observacao", "status_proposta", "status_id",
+         ["PAGO", "AGUARDANDO SALDO", "EM ANÁLISE", "REPRESENTAÇÃO", "CANCELADO", "AGUARDANDO AVERBAÇÃO"]),
+    ]
+    casos, params = [], []
+    for coluna, tabela, coluna_id, lista in dimensoes:
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {tabela} (id {serial}, nome TEXT NOT NULL, chave TEXT UNIQUE NOT NULL)")
+        for nome in lista:
+            criar_codigo(tabela, nome, chave_de(nome))
+        if coluna_id not in existentes:
+            cur.execute(f"ALTER TABLE propostas ADD COLUMN {coluna_id} SMALLINT;")
+
+        # valores já gravados: os que não estão na lista ganham código novo
+        cur.execute(f"SELECT DISTINCT {coluna} FROM propostas WHERE {coluna} IS NOT NULL;")
+        codigos = {}
+        for (valor,) in cur.fetchall():
+            chave = chave_de(valor)
+            if chave:
+                codigos[valor] = criar_codigo(tabela, valor.strip(), chave)
+        if codigos:
+            casos.append(f"{coluna_id} = CASE {coluna} {' '.join([f'WHEN {ph} THEN {ph}'] * len(codigos))} END")
+            params += [v for par in codigos.items() for v in par]
+
+    # uma passada só pela tabela para as três colunas
+    if casos:
+        cur.execute(f"UPDATE propostas SET {', '.join(casos)};", params)
+
+    cur.execute("DROP INDEX IF EXISTS idx_propostas_status_data;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_propostas_status_id_data ON propostas (status_id, data);")
+
+    # agregado diário refeito com as dimensões em código
+    dia, numero = ("TEXT", "REAL") if sqlite else ("DATE", "NUMERIC(14,2)")
+    dia_data = "substr(data, 1, 10)" if sqlite else "CAST(data AS DATE)"
+    cur.execute("DROP TABLE IF EXISTS propostas_diarias;")
+    cur.execute(f"""
+        CREATE TABLE propostas_diarias (
+            consultor TEXT NOT NULL,
+            dia {dia} NOT NULL,
+            fonte_id SMALLINT NOT NULL,
+            banco_id SMALLINT NOT NULL,
+            status_id SMALLINT NOT NULL,
+            qtd INTEGER NOT NULL DEFAULT 0,
+            total_eq {numero} NOT NULL DEFAULT 0,
+            total_or {numero} NOT NULL DEFAULT 0,
+            PRIMARY KEY (consultor, dia, fonte_id, banco_id, status_id)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_propostas_diarias_dia ON propostas_diarias (dia, status_id);")
+    cur.execute(f"""
+        INSERT INTO propostas_diarias (consultor, dia, fonte_id, banco_id, status_id, qtd, total_eq, total_or)
+        SELECT COALESCE(consultor, ''), {dia_data}, COALESCE(fonte_id, 0), COALESCE(banco_id, 0),
+               COALESCE(status_id, 0), COUNT(*),
+               COALESCE(SUM(valor_equivalente), 0), COALESCE(SUM(valor_original), 0)
+        FROM propostas
+        WHERE data IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5
+    """)
 
-        else:
-            def add_col_pg(col, col_type):
-                cur.execute("""
-                    SELECT column_name
-                    FROM information_schema.columns
-                    WHERE table_name = 'propostas' AND column_name = %s;
-                """, (col,))
-                if not cur.fetchone():
-                    print(f"🛠️ Adicionando coluna '{col}' no PostgreSQL...")
-                    cur.execute(f"ALTER TABLE propostas ADD COLUMN {col} {col_type};")
-
-            add_col_pg("banco", "TEXT")
-            add_col_pg("produto", "TEXT")
-            add_col_pg("valor_parcela", "NUMERIC(12,2)")
-            add_col_pg("quantidade_parcelas", "INTEGER")
-            add_col_pg("data_pagamento_prevista", "TEXT")
-            add_col_pg("motivo_cancelamento", "TEXT")
 
-            conn.commit()
-            print("✅ Colunas garantidas no PostgreSQL.")
+# Calendário de dias úteis: feriados nacionais (incluindo os bancários de Carnaval e
+# Corpus Christi, que param a averbação) mais os locais de FERIADOS_LOCAIS, no formato
+# "MM-DD:Nome" (todo ano) ou "AAAA-MM-DD:Nome", separados por vírgula.
+FERIADOS_FIXOS = {
+    (1, 1): "Confraternização Universal",
+    (4, 21): "Tiradentes",
+    (5, 1): "Dia do Trabalho",
+    (9, 7): "Independência do Brasil",
+    (10, 12): "Nossa Senhora Aparecida",
+    (11, 2): "Finados",
+    (11, 15): "Proclamação da República",
+    (11, 20): "Consciência Negra",
+    (12, 25): "Natal",
+}
+FERIADOS_PASCOA = {-48: "Carnaval", -47: "Carnaval", -2: "Sexta-feira Santa", 60: "Corpus Christi"}
+FERIADOS_LOCAIS = os.environ.get("FERIADOS_LOCAIS", "")
+CALENDARIO_INICIO = int(os.environ.get("CALENDARIO_INICIO", 2020))
+
+
+def domingo_pascoa(ano):
+    # algoritmo de Meeus/Jones/Butcher (calendário gregoriano)
+    a, b, c = ano % 19, ano // 100, ano % 100
+    d, e = b // 4, b % 4
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    mes = (h + l - 7 * m + 114) // 31
+    return date(ano, mes, (h + l - 7 * m + 114) % 31 + 1)
+
+
+@functools.lru_cache(maxsize=1)
+def feriados_locais():
+    # [(ano ou None, mês, dia, nome)] a partir de FERIADOS_LOCAIS
+    feriados = []
+    for item in filter(None, (i.strip() for i in FERIADOS_LOCAIS.split(","))):
+        data_txt, _, nome = item.partition(":")
+        try:
+            if len(data_txt) == 5:
+                dia = datetime.strptime(f"2000-{data_txt}", "%Y-%m-%d").date()
+                feriados.append((None, dia.month, dia.day, nome.strip() or "Feriado local"))
+            else:
+                dia = datetime.strptime(data_txt, "%Y-%m-%d").date()
+                feriados.append((dia.year, dia.month, dia.day, nome.strip() or "Feriado local"))
+        except ValueError:
+            print("⚠️ Feriado local inválido em FERIADOS_LOCAIS:", item)
+    return feriados
+
+
+def feriados_ano(ano):
+    feriados = {date(ano, mes, dia): nome for (mes, dia), nome in FERIADOS_FIXOS.items()}
+    if ano < 2024:
+        feriados.pop(date(ano, 11, 20))  # nacional a partir da Lei 14.759/2023
+    pascoa = domingo_pascoa(ano)
+    for deslocamento, nome in FERIADOS_PASCOA.items():
+        feriados[pascoa + timedelta(days=deslocamento)] = nome
+    for ano_local, mes, dia, nome in feriados_locais():
+        if ano_local not in (None, ano):
+            continue
+        try:
+            feriados[date(ano, mes, dia)] = nome
+        except ValueError:
+            pass  # 29/02 em ano não bissexto
+    return feriados
+
+
+def sincronizar_calendario(conn, cur):
+    # Cobre de CALENDARIO_INICIO até dois anos à frente; só regrava a tabela quando a
+    # faixa ou os feriados mudaram (virada de ano, FERIADOS_LOCAIS alterado).
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+    inicio, fim = date(CALENDARIO_INICIO, 1, 1), date(datetime.now().year + 2, 12, 31)
+    feriados = {}
+    for ano in range(inicio.year, fim.year + 1):
+        feriados.update(feriados_ano(ano))
+    esperado = {d.isoformat(): nome for d, nome in feriados.items() if d.weekday() < 5}
+
+    cur.execute("SELECT MIN(dia), MAX(dia) FROM calendario;")
+    faixa = tuple(str(d) if d is not None else None for d in cur.fetchone())
+    cur.execute("SELECT dia, feriado FROM calendario WHERE feriado IS NOT NULL;")
+    if faixa == (inicio.isoformat(), fim.isoformat()) and {str(d): n for d, n in cur.fetchall()} == esperado:
+        return False
+
+    linhas, dia = [], inicio
+    while dia <= fim:
+        chave = dia.isoformat()
+        linhas.append((chave, int(dia.weekday() < 5 and chave not in esperado), esperado.get(chave)))
+        dia += timedelta(days=1)
+    cur.execute("DELETE FROM calendario;")
+    cur.executemany(f"INSERT INTO calendario (dia, util, feriado) VALUES ({ph}, {ph}, {ph})", linhas)
+    invalidar_cadastros(cur)
+    return True
+
+
+def _m009_calendario(conn, cur):
+    dia = "TEXT" if isinstance(conn, sqlite3.Connection) else "DATE"
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS calendario (
+            dia {dia} PRIMARY KEY,
+            util SMALLINT NOT NULL,
+            feriado TEXT
+        )
+    """)
+    # a tabela é preenchida (e mantida) por sincronizar_calendario() em todo boot,
+    # logo depois das migrações, em inicializar_banco()
 
-    except Exception as e:
-        print("⚠️ Erro ao garantir colunas em 'propostas':", e)
-    finally:
-        conn.close()
 
-def ensure_meta_table():
+def _m010_series(conn, cur):
+    sqlite = isinstance(conn, sqlite3.Connection)
+    ph = "?" if sqlite else "%s"
+    dia, numero = ("TEXT", "REAL") if sqlite else ("DATE", "NUMERIC(14,2)")
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS propostas_series (
+            dimensao TEXT NOT NULL,
+            valor TEXT NOT NULL,
+            dia {dia} NOT NULL,
+            qtd INTEGER NOT NULL DEFAULT 0,
+            pagos_qtd INTEGER NOT NULL DEFAULT 0,
+            pagos_eq {numero} NOT NULL DEFAULT 0,
+            cancelados_qtd INTEGER NOT NULL DEFAULT 0,
+            cancelados_eq {numero} NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimensao, valor, dia)
+        )
+    """)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS series_pendentes (dia {dia} PRIMARY KEY)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_propostas_series_dia ON propostas_series (dia);")
+    cur.execute("DELETE FROM propostas_series;")
+    cur.execute("DELETE FROM series_pendentes;")
+    cur.execute("SELECT id FROM status_proposta WHERE chave = 'pago';")
+    pago = (cur.fetchone() or (0,))[0]
+    cur.execute("SELECT id FROM status_proposta WHERE chave = 'cancelado';")
+    cancelado = (cur.fetchone() or (0,))[0]
+    for dimensao, valor in [("", "''"), ("consultor", "consultor"),
+                            ("fonte", "CAST(fonte_id AS TEXT)"), ("banco", "CAST(banco_id AS TEXT)")]:
+        cur.execute(f"""
+            INSERT INTO propostas_series (dimensao, valor, dia, qtd, pagos_qtd, pagos_eq, cancelados_qtd, cancelados_eq)
+            SELECT {ph}, {valor}, dia, SUM(qtd),
+                   SUM(CASE WHEN status_id = {ph} THEN qtd ELSE 0 END),
+                   SUM(CASE WHEN status_id = {ph} THEN total_eq ELSE 0 END),
+                   SUM(CASE WHEN status_id = {ph} THEN qtd ELSE 0 END),
+                   SUM(CASE WHEN status_id = {ph} THEN total_eq ELSE 0 END)
+            FROM propostas_diarias
+            GROUP BY 2, 3
+        """, (dimensao, pago, pago, cancelado, cancelado))
+
+
+def _m011_versao_dados(conn, cur):
+    # id 2: escritas em propostas (o id 1 segue sendo o de metas e usuários)
+    cur.execute("INSERT INTO cache_versao (id, versao) VALUES (2, 0) ON CONFLICT (id) DO NOTHING;")
+
+
+MIGRACOES = [
+    (1, "tabelas users e propostas", _m001_tabelas_base),
+    (2, "colunas adicionais de propostas", _m002_colunas_propostas),
+    (3, "tabelas de metas", _m003_tabelas_metas),
+    (4, "agregado diário de propostas", _m004_agregado_diario),
+    (5, "índices de propostas", _m005_indices_propostas),
+    (6, "contador de versão do cache", _m006_versao_cache),
+    (7, "colunas normalizadas para busca de cliente", _m007_colunas_busca),
+    (8, "códigos de status, fonte e banco", _m008_codigos_dimensoes),
+    (9, "calendário de dias úteis", _m009_calendario),
+    (10, "séries diárias para os gráficos", _m010_series),
+    (11, "versão dos dados de propostas", _m011_versao_dados),
+]
+
+
+def versao_schema(cur):
+    cur.execute("SELECT COALESCE(MAX(versao), 0) FROM schema_version;")
+    return cur.fetchone()[0]
+
+
+def aplicar_migracoes():
     conn = get_conn()
     cur = conn.cursor()
-    if isinstance(conn, sqlite3.Connection):
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS metas_globais (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                valor REAL
-            )
-        """)
-    else:
+    sqlite = isinstance(conn, sqlite3.Connection)
+    ph = "?" if sqlite else "%s"
+
+    try:
+        if sqlite:
+            # trava de escrita no arquivo enquanto as migrações rodam
+            cur.execute("BEGIN IMMEDIATE;")
+        else:
+            cur.execute("SELECT pg_advisory_lock(%s);", (SCHEMA_LOCK_ID,))
+
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS metas_globais (
-                id SERIAL PRIMARY KEY,
-                valor NUMERIC(12,2)
+            CREATE TABLE IF NOT EXISTS schema_version (
+                versao INTEGER PRIMARY KEY,
+                descricao TEXT,
+                aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-    conn.commit()
-    conn.close()
+        atual = versao_schema(cur)
+
+        for versao, descricao, migracao in MIGRACOES:
+            if versao <= atual:
+                continue
+            print(f"🛠️ Aplicando migração {versao:03d}: {descricao}...")
+            migracao(conn, cur)
+            cur.execute(f"INSERT INTO schema_version (versao, descricao) VALUES ({ph}, {ph});",
+                        (versao, descricao))
+            if not sqlite:
+                conn.commit()
+            atual = versao
 
-ensure_meta_table()
-ensure_banco_column()
+        conn.commit()
+        return atual
+
+    except Exception as e:
+        conn.rollback()
+        print("⚠️ Erro ao aplicar migrações:", e)
+        raise
 
-def garantir_schema_propostas():
+    finally:
+        if not sqlite:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (SCHEMA_LOCK_ID,))
+            conn.commit()
+        conn.close()
+
+
+def garantir_admin():
     conn = get_conn()
     cur = conn.cursor()
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+
+    cur.execute(f"SELECT 1 FROM users WHERE nome = {ph}", ("admin",))
+    if not cur.fetchone():
+        cur.execute(f"INSERT INTO users (nome, senha, role) VALUES ({ph}, {ph}, {ph})",
+                    ("admin", gerar_hash_senha("Tech@2025"), "admin"))
+        conn.commit()
+    conn.close()
+
+
+# Boot explícito: importar o módulo não toca no banco. O Gunicorn sobe pela fábrica
+# (app:create_app(), uma vez no master com --preload); a CLI usa
+# `flask --app "app:create_app()" ...` ou `flask migrar`.
+_boot = {"feito": False, "lock": threading.Lock()}
+
+
+def inicializar_banco():
+    with _boot["lock"]:
+        if _boot["feito"]:
+            return
+        aplicar_migracoes()
+        garantir_admin()
+        with conexao() as conn:
+            cur = conn.cursor()
+            sincronizado = sincronizar_calendario(conn, cur)
+            conn.commit()
+            if sincronizado:
+                limpar_cache_cadastros()
+                print("📅 Calendário de dias úteis atualizado.")
+        _boot["feito"] = True
+
+
+def create_app():
+    inicializar_banco()
+    return app
 
-    colunas = {
-        "produto": "TEXT",
-        "valor_parcela": "NUMERIC(12,2)",
-        "quantidade_parcelas": "INTEGER",
-        "data_pagamento_prevista": "TEXT",
-        "motivo_cancelamento": "TEXT"
-    }
 
+@app.cli.command("migrar")
+def migrar_cmd():
+    versao = aplicar_migracoes()
+    print(f"✅ Schema na versão {versao}.")
+
+# Cache de metas e usuários: mudam poucas vezes por mês e são lidos em quase toda
+# página. As rotas que alteram esses dados chamam invalidar_cadastros() dentro da
+# escrita e limpar_cache_cadastros() depois do commit (executar_escrita() com
+# publicar=True já faz isso por publicar_alteracao()); o contador
+# em cache_versao avisa os outros workers, que o conferem no máximo a cada
+# CACHE_VERSAO_INTERVALO segundos (0 desliga a conferência).
+CADASTROS_CACHE_TTL = float(os.environ.get("CADASTROS_CACHE_TTL", 300))
+CACHE_VERSAO_INTERVALO = float(os.environ.get("CACHE_VERSAO_INTERVALO", 5))
+
+_cache_cadastros = CacheTTL(CADASTROS_CACHE_TTL)
+_versao_cadastros = {"versao": None, "conferida_em": 0.0, "geracao": 0}
+
+
+def _conferir_versao_cadastros(cur):
+    if CACHE_VERSAO_INTERVALO <= 0:
+        return
+    agora = time.monotonic()
+    if agora - _versao_cadastros["conferida_em"] < CACHE_VERSAO_INTERVALO:
+        return
+    cur.execute("SELECT versao FROM cache_versao WHERE id = 1;")
+    row = cur.fetchone()
+    versao = row[0] if row else 0
+    if versao != _versao_cadastros["versao"]:
+        limpar_cache_cadastros()
+        _versao_cadastros["versao"] = versao
+    _versao_cadastros["conferida_em"] = agora
+
+
+def _cadastro(cur, chave, consulta):
+    _conferir_versao_cadastros(cur)
+    valor = _cache_cadastros.obter(chave)
+    if valor is None:
+        # uma leitura que começou antes da limpeza não guarda o valor antigo
+        geracao = _versao_cadastros["geracao"]
+        valor = consulta(cur)
+        if geracao == _versao_cadastros["geracao"]:
+            _cache_cadastros.guardar(chave, valor)
+    return valor
+
+
+def invalidar_cadastros(cur):
+    # Dentro da transação: só sobe a versão. O cache local é limpo depois do commit,
+    # senão outra thread relê o valor antigo e o guarda de novo.
+    cur.execute("UPDATE cache_versao SET versao = versao + 1 WHERE id = 1;")
+
+
+def limpar_cache_cadastros():
+    _versao_cadastros["geracao"] += 1
+    _cache_cadastros.limpar()
+
+
+def _ultimo_valor(cur, tabela):
+    cur.execute(f"SELECT valor FROM {tabela} ORDER BY id DESC LIMIT 1;")
+    row = cur.fetchone()
+    return float(row[0]) if row and row[0] is not None else 0.0
+
+
+def meta_global_atual(cur):
+    return _cadastro(cur, "meta_global", lambda c: _ultimo_valor(c, "metas_globais"))
+
+
+def meta_dia_atual(cur):
+    return _cadastro(cur, "meta_dia", lambda c: _ultimo_valor(c, "meta_dia"))
+
+
+def metas_individuais(cur):
+    def consulta(c):
+        c.execute("SELECT consultor, meta FROM metas_individuais;")
+        return {r[0]: float(r[1] or 0) for r in c.fetchall()}
+    return _cadastro(cur, "metas_individuais", consulta)
+
+
+def consultores_cadastrados(cur):
+    def consulta(c):
+        c.execute("SELECT nome FROM users WHERE role != 'admin' ORDER BY nome;")
+        return tuple(r[0] for r in c.fetchall())
+    return _cadastro(cur, "consultores", consulta)
+
+
+def dimensoes(cur):
+    # {dimensão: {"codigos": {chave normalizada: id}, "nomes": {id: nome}}}
+    def consulta(c):
+        mapas = {}
+        for dimensao, (tabela, _) in DIMENSOES.items():
+            c.execute(f"SELECT id, nome, chave FROM {tabela};")
+            linhas = c.fetchall()
+            mapas[dimensao] = {"codigos": {r[2]: r[0] for r in linhas}, "nomes": {r[0]: r[1] for r in linhas}}
+        return mapas
+    return _cadastro(cur, "dimensoes", consulta)
+
+
+def codigo_dimensao(cur, dimensao, valor):
+    chave = _chave_texto(valor) if valor else ""
+    return dimensoes(cur)[dimensao]["codigos"].get(chave) if chave else None
+
+
+def nomes_dimensao(cur, dimensao):
+    return dimensoes(cur)[dimensao]["nomes"]
+
+
+def codigos_proposta(cur, conn, fonte, banco, observacao):
+    # Códigos (fonte_id, banco_id, status_id) para gravar junto com a proposta;
+    # valor fora das listas ganha código novo e os outros workers são avisados.
+    codigos = []
+    for dimensao, valor in (("fonte", fonte), ("banco", banco), ("status", observacao)):
+        codigo = codigo_dimensao(cur, dimensao, valor)
+        chave = _chave_texto(valor) if valor else ""
+        if codigo is None and chave:
+            codigo = _criar_codigo(cur, conn, DIMENSOES[dimensao][0], str(valor).strip(), chave)
+            invalidar_cadastros(cur)
+        codigos.append(codigo)
+    return tuple(codigos)
+
+
+def filtro_dimensao(cur, ph, dimensao, texto, exato=True):
+    # Resolve o texto contra a tabela de códigos (poucas linhas) em vez de aplicar
+    # LOWER()/UPPER() em cada proposta; exato=False aceita trecho do nome.
+    coluna = COLUNAS_DIMENSAO[list(DIMENSOES).index(dimensao)]
+    trecho = _chave_texto(texto)
+    codigos = [
+        codigo for chave, codigo in dimensoes(cur)[dimensao]["codigos"].items()
+        if (chave == trecho if exato else trecho in chave)
+    ]
+    if not trecho or not codigos:
+        return "1 = 0", []
+    return f"{coluna} IN ({','.join([ph] * len(codigos))})", codigos
+
+@app.cli.command("reconstruir-agregados")
+def reconstruir_agregados_cmd():
+    """Recalcula propostas_diarias a partir da tabela propostas."""
+    conn = get_conn()
+    reconstruir_agregados(conn)
+    conn.close()
+    print("✅ Agregado diário reconstruído.")
+
+@app.cli.command("verificar-agregados")
+def verificar_agregados_cmd():
+    """Compara propostas_diarias com a tabela propostas e lista divergências."""
+    conn = get_conn()
+    divergentes = divergencias_agregados(conn)
+    conn.close()
+    if not divergentes:
+        print("✅ Agregado diário confere com propostas.")
+        return
+    print(f"⚠️ {len(divergentes)} chave(s) divergente(s):")
+    for chave, atual, esperado in divergentes:
+        print(f"    {chave}: tabela={tuple(atual)} propostas={tuple(esperado)}")
+
+def intervalo_datas(inicio, fim):
+    # Datas 'YYYY-MM-DD' inclusivas viram um intervalo semiaberto [inicio, fim + 1 dia),
+    # comparado direto com a coluna data para que os índices possam ser usados.
     try:
-        if isinstance(conn, sqlite3.Connection):
-            cur.execute("PRAGMA table_info(propostas);")
-            existentes = [c[1] for c in cur.fetchall()]
+        inicio_dt = datetime.strptime(inicio, "%Y-%m-%d")
+        fim_dt = datetime.strptime(fim, "%Y-%m-%d") + timedelta(days=1)
+    except (TypeError, ValueError):
+        return inicio, fim
+    return inicio_dt.strftime("%Y-%m-%d %H:%M:%S"), fim_dt.strftime("%Y-%m-%d %H:%M:%S")
+
+def filtro_periodo(ph, coluna="data"):
+    return f"{coluna} >= {ph} AND {coluna} < {ph}"
+
+def filtro_cpf(conn, ph, digitos):
+    # CPF completo por igualdade; parcial como prefixo, que o btree também atende
+    if len(digitos) == 11:
+        return f"cpf_digitos = {ph}", digitos
+    if isinstance(conn, sqlite3.Connection):
+        return f"cpf_digitos GLOB {ph}", f"{digitos}*"
+    return f"cpf_digitos LIKE {ph}", f"{digitos}%"
 
-            for col, tipo in colunas.items():
-                if col not in existentes:
-                    cur.execute(f"ALTER TABLE propostas ADD COLUMN {col} {tipo};")
+_fts_disponivel = {}
 
+def filtro_busca_cliente(cur, conn, ph, texto):
+    # Devolve (condição, params): texto com letras busca trecho do nome; só
+    # dígitos e pontuação busca o início do CPF.
+    nome, digitos = colunas_busca(texto, texto)
+    if any(c.isalpha() for c in nome or ""):
+        digitos = None
+    else:
+        nome = None
+    opcoes, params = [], []
+    if nome:
+        if isinstance(conn, sqlite3.Connection):
+            if "sqlite" not in _fts_disponivel:
+                cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'propostas_busca';")
+                _fts_disponivel["sqlite"] = cur.fetchone() is not None
+            if _fts_disponivel["sqlite"]:
+                opcoes.append(f"id IN (SELECT rowid FROM propostas_busca WHERE nome_busca LIKE {ph})")
+            else:
+                opcoes.append(f"nome_busca LIKE {ph}")
         else:
-            for col, tipo in colunas.items():
-                cur.execute("""
-                    SELECT column_name
-                    FROM information_schema.columns
-                    WHERE table_name = 'propostas' AND column_name = %s
-                """, (col,))
+            opcoes.append(f"nome_busca LIKE {ph}")
+        params.append(f"%{nome}%")
+    if digitos:
+        condicao, valor = filtro_cpf(conn, ph, digitos)
+        opcoes.append(condicao)
+        params.append(valor)
+    if not opcoes:
+        return "1 = 0", []
+    return "(" + " OR ".join(opcoes) + ")", params
+
+# Paginação por cursor (keyset) em (data, id) DESC: cada página custa o mesmo,
+# não importa a profundidade. O cursor é um token opaco com a linha de borda.
+def codificar_cursor(data, id_, direcao, pagina):
+    bruto = json.dumps([str(data) if data is not None else None, id_, direcao, pagina])
+    return base64.urlsafe_b64encode(bruto.encode()).decode().rstrip("=")
+
+def decodificar_cursor(token):
+    if not token:
+        return None
+    try:
+        bruto = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        data, id_, direcao, pagina = json.loads(bruto)
+    except (ValueError, TypeError):
+        return None
+    if direcao not in ("proxima", "anterior", "ultima"):
+        return None
+    return data, id_, direcao, int(pagina)
+
+def paginar_keyset(cur, ph, select_base, condicoes, params, token, por_pagina, total=None):
+    # select_base: SELECT ... FROM propostas, com id na coluna 0 e data na coluna 1.
+    # A ordem é data DESC com as datas nulas no fim (NULLS LAST), depois id DESC, lida
+    # em dois trechos: com data, por (data, id), e sem data, por id. Cada trecho tem o
+    # seu predicado de borda e usa o índice; o sem data só é lido quando a página chega
+    # nele. Com `total`, a "ultima" tem o resto da divisão e fica alinhada às outras.
+    cursor = decodificar_cursor(token)
+    direcao = cursor[2] if cursor else None
+    pagina = cursor[3] if cursor else 1
+    limite = por_pagina + 1
+    if direcao == "ultima" and total is not None:
+        pagina = max((total + por_pagina - 1) // por_pagina, 1)
+        limite = max(total - (pagina - 1) * por_pagina, 1)
+
+    crescente = direcao in ("anterior", "ultima")
+    ordem = "ASC" if crescente else "DESC"
+    borda = (cursor[0], cursor[1]) if direcao in ("proxima", "anterior") else None
+    borda_sem_data = borda is not None and borda[0] is None
+
+    trechos = []
+    for sem_data in ((True, False) if crescente else (False, True)):
+        extra, extra_params = [], []
+        if borda is not None:
+            if sem_data and borda_sem_data:
+                extra.append(f"id {'>' if crescente else '<'} {ph}")
+                extra_params.append(borda[1])
+            elif not sem_data and not borda_sem_data:
+                extra.append(f"(data, id) {'>' if crescente else '<'} ({ph}, {ph})")
+                extra_params += list(borda)
+            elif sem_data == crescente:
+                # a borda está no outro trecho, que vem depois deste nesta direção
+                continue
+        if sem_data:
+            trechos.append((["data IS NULL", *extra], extra_params, f"id {ordem}"))
+        else:
+            trechos.append((["data IS NOT NULL", *extra], extra_params, f"data {ordem}, id {ordem}"))
 
-                if not cur.fetchone():
-                    cur.execute(f"ALTER TABLE propostas ADD COLUMN {col} {tipo};")
+    linhas = []
+    for extra, extra_params, ordenacao in trechos:
+        where = " WHERE " + " AND ".join([*condicoes, *extra])
+        cur.execute(
+            f"{select_base}{where} ORDER BY {ordenacao} LIMIT {ph}",
+            tuple([*params, *extra_params, limite - len(linhas)])
+        )
+        linhas += cur.fetchall()
+        if len(linhas) >= limite:
+            break
 
-        conn.commit()
+    tem_mais = len(linhas) > por_pagina
+    linhas = linhas[:por_pagina]
+    if crescente:
+        linhas.reverse()
 
-    except Exception as e:
-        print("⚠️ Erro ao garantir schema:", e)
+    if not linhas:
+        return linhas, None, None, pagina
 
-    finally:
-        conn.close()
+    primeira, ultima = linhas[0], linhas[-1]
+    if direcao == "ultima" and total is not None:
+        ha_anterior = pagina > 1
+    else:
+        ha_anterior = tem_mais if crescente else direcao is not None
+    ha_proxima = tem_mais if direcao in (None, "proxima") else direcao == "anterior"
+
+    anterior = codificar_cursor(primeira[1], primeira[0], "anterior", max(pagina - 1, 1)) if ha_anterior else None
+    proxima = codificar_cursor(ultima[1], ultima[0], "proxima", pagina + 1) if ha_proxima else None
+    return linhas, anterior, proxima, pagina
+
+def tamanho_pagina(valor, padrao=50):
+    try:
+        return min(max(int(valor), 10), 500)
+    except (TypeError, ValueError):
+        return padrao
+
+@app.cli.command("verificar-indices")
+def verificar_indices():
+    """Mostra o plano (EXPLAIN) das consultas quentes e se usam os índices."""
+    conn = get_conn()
+    cur = conn.cursor()
+    sqlite = isinstance(conn, sqlite3.Connection)
+    ph = "?" if sqlite else "%s"
+
+    hoje = datetime.now().strftime("%Y-%m-%d")
+    periodo = intervalo_datas(datetime.now().replace(day=1).strftime("%Y-%m-%d"), hoje)
+
+    consultas = [
+        ("dashboard (período)",
+         f"SELECT COUNT(*) FROM propostas WHERE {filtro_periodo(ph)}", periodo),
+        ("pagos no período (ranking/painel_admin)",
+         f"SELECT consultor, SUM(valor_equivalente) FROM propostas "
+         f"WHERE status_id = {ph} AND {filtro_periodo(ph)} GROUP BY consultor",
+         (codigo_dimensao(cur, "status", "PAGO"), *periodo)),
+        ("painel_usuario",
+         f"SELECT id FROM propostas WHERE consultor = {ph} AND {filtro_periodo(ph)}", ("admin", *periodo)),
+        ("indice_dia (hoje)",
+         f"SELECT consultor, SUM(valor_equivalente) FROM propostas "
+         f"WHERE {filtro_periodo(ph)} GROUP BY consultor", intervalo_datas(hoje, hoje)),
+    ]
+    for nome, texto in (("busca por CPF", "12345678901"), ("busca por CPF (prefixo)", "123456"),
+                        ("busca por nome", "silva")):
+        filtro, valores = filtro_busca_cliente(cur, conn, ph, texto)
+        consultas.append((nome, f"SELECT id FROM propostas WHERE {filtro}", tuple(valores)))
+
+    for nome, sql, params in consultas:
+        if sqlite:
+            cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plano = [r[3] for r in cur.fetchall()]
+            usa_indice = any("INDEX" in linha for linha in plano)
+        else:
+            cur.execute("EXPLAIN " + sql, params)
+            plano = [r[0] for r in cur.fetchall()]
+            usa_indice = any("Index" in linha for linha in plano)
+
+        print(f"{'✅' if usa_indice else '⚠️'} {nome}")
+        for linha in plano:
+            print("    " + linha)
+
+    conn.close()
 
 
 @app.route("/")
@@ -222,107 +1817,160 @@ def home():
         return redirect(url_for("dashboard"))
     return redirect(url_for("login"))
 
+def dados_indice_dia(leitura=True):
+    # Produção do dia por consultor, a partir do ranking e do ritmo do mês.
+    ritmo = ritmo_mes(leitura=leitura)
+    ranking = ritmo.ranking
+    linhas = sorted(ranking.linhas, key=lambda r: (-r.dia_eq, r.consultor))
+    return {
+        "ranking": [
+            [r.consultor, r.dia_eq, r.dia_or, r.meta, ritmo.consultores[r.consultor].falta,
+             ritmo.consultores[r.consultor].necessario_dia]
+            for r in linhas
+        ],
+        "total_eq": ranking.dia_eq,
+        "total_or": ranking.dia_or,
+        "meta_dia": ranking.meta_dia,
+        "falta_meta_dia": ranking.falta_meta_dia,
+        "data_atual": ranking.dia,
+    }
+
+# ETag dos polls: sai das versões em cache_versao (propostas e cadastros), do dia e
+# da URL, numa consulta por chave primária. O If-None-Match é conferido antes de montar
+# o payload, então um 304 não roda nenhuma das consultas do dashboard.
+_versao_dados = {"versao": None, "lock": threading.Lock()}
+
+
+def etag_dados():
+    with conexao(leitura=True) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, versao FROM cache_versao ORDER BY id;")
+        versoes = tuple(tuple(row) for row in cur.fetchall())
+    with _versao_dados["lock"]:
+        if versoes != _versao_dados["versao"]:
+            # escrita feita por outro worker: os caches deste estão antigos
+            if _versao_dados["versao"] is not None:
+                _cache_resumos.limpar()
+                _cache_ranking.limpar()
+                _cache_ritmo.limpar()
+                _cache_series.limpar()
+            _versao_dados["versao"] = versoes
+    hoje = datetime.now(pytz.timezone("America/Sao_Paulo")).date().isoformat()
+    bruto = json.dumps([versoes, hoje, request.full_path])
+    return hashlib.sha1(bruto.encode()).hexdigest()
+
+
+def resposta_json_condicional(montar):
+    # montar() só roda se o cliente não tiver a versão atual; senão 304 sem corpo.
+    etag = etag_dados()
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = jsonify(montar())
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = True
+    return resp
+
 @app.route("/indice_dia")
 def indice_dia():
     if "user" not in session:
         return redirect(url_for("login"))
 
-    conn = get_conn()
-    cur = conn.cursor()
+    return render_template("indice_dia.html", **dados_indice_dia())
 
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS metas_individuais (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            consultor TEXT UNIQUE,
-            meta REAL
-        )
-    """ if isinstance(conn, sqlite3.Connection) else """
-        CREATE TABLE IF NOT EXISTS metas_individuais (
-            id SERIAL PRIMARY KEY,
-            consultor TEXT UNIQUE,
-            meta NUMERIC(12,2)
-        )
-    """)
+@app.route("/api/indice_dia")
+def api_indice_dia():
+    if "user" not in session:
+        return jsonify({"erro": "não autenticado"}), 401
 
-    cur.execute("SELECT consultor, meta FROM metas_individuais;")
-    metas_dict = {row[0]: row[1] for row in cur.fetchall()}
+    return resposta_json_condicional(dados_indice_dia)
 
-    cur.execute("SELECT nome FROM users WHERE role != 'admin' ORDER BY nome;")
-    todos_usuarios = [r[0] for r in cur.fetchall()]
+# Senhas: método e custo configuráveis em SENHA_METODO, no formato do Werkzeug
+# ("scrypt:32768:8:1", "pbkdf2:sha256:600000"...). Hashes gravados com outro método são
+# refeitos no próximo login bem-sucedido. A verificação roda num pool pequeno por
+# worker (SENHA_PARALELO) com fila limitada (SENHA_FILA): na rajada de logins do início
+# do turno quem passa da fila espera uma vaga por até SENHA_ESPERA segundos (prazo que
+# vale para a espera e o cálculo juntos) e só então recebe 503 + Retry-After, em vez de
+# segurar a thread do Gunicorn indefinidamente. O hashlib solta o GIL durante
+# scrypt/pbkdf2, então threads bastam.
+SENHA_METODO = os.environ.get("SENHA_METODO", "scrypt:32768:8:1")
+SENHA_PARALELO = int(os.environ.get("SENHA_PARALELO", 2))
+SENHA_FILA = int(os.environ.get("SENHA_FILA", 16))
+SENHA_ESPERA = float(os.environ.get("SENHA_ESPERA", 10))
 
-    tz = pytz.timezone("America/Sao_Paulo")
-    hoje = datetime.now(tz).strftime("%Y-%m-%d")
+_senhas = {
+    "pool": None, "pid": None, "lock": threading.Lock(),
+    "vagas": threading.BoundedSemaphore(SENHA_PARALELO + SENHA_FILA),
+    "verificacoes": 0, "rehashes": 0, "recusadas": 0,
+}
 
-    if isinstance(conn, sqlite3.Connection):
-        cur.execute("""
-            SELECT consultor,
-                   COALESCE(SUM(valor_equivalente), 0) AS total_eq,
-                   COALESCE(SUM(valor_original), 0) AS total_or
-            FROM propostas
-            WHERE DATE(data, 'localtime') = ?
-            GROUP BY consultor;
-        """, (hoje,))
-    else:
-        cur.execute("""
-            SELECT consultor,
-                   COALESCE(SUM(valor_equivalente), 0) AS total_eq,
-                   COALESCE(SUM(valor_original), 0) AS total_or
-            FROM propostas
-            WHERE DATE(data AT TIME ZONE 'America/Sao_Paulo') = %s
-            GROUP BY consultor;
-        """, (hoje,))
 
-    resultados = {r[0]: (r[1], r[2]) for r in cur.fetchall()}
+class SenhaOcupada(Exception):
+    pass
 
-    cur.execute("""
-        SELECT consultor,
-               COALESCE(SUM(valor_equivalente), 0) AS eq_total
-        FROM propostas
-        GROUP BY consultor;
-    """)
-    totais = {r[0]: r[1] for r in cur.fetchall()}
 
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS meta_dia (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            valor REAL
-        )
-    """ if isinstance(conn, sqlite3.Connection) else """
-        CREATE TABLE IF NOT EXISTS meta_dia (
-            id SERIAL PRIMARY KEY,
-            valor NUMERIC(12,2)
-        )
-    """)
-    cur.execute("SELECT valor FROM meta_dia ORDER BY id DESC LIMIT 1;")
-    meta_dia_row = cur.fetchone()
-    meta_dia = meta_dia_row[0] if meta_dia_row else 0
+def gerar_hash_senha(senha):
+    return generate_password_hash(senha, method=SENHA_METODO)
 
-    conn.close()
 
-    ranking = []
-    for nome in todos_usuarios:
-        eq_dia, or_dia = resultados.get(nome, (0, 0))
-        meta = metas_dict.get(nome, 0)
-        eq_total = totais.get(nome, 0)
-        falta = max(meta - eq_total, 0)
-        ranking.append([nome, eq_dia, or_dia, meta, falta])
+@functools.lru_cache(maxsize=1)
+def _prefixo_hash():
+    # o Werkzeug completa os parâmetros omitidos ("scrypt" -> "scrypt:32768:8:1")
+    return gerar_hash_senha("").split("$", 1)[0]
 
-    ranking.sort(key=lambda x: x[1], reverse=True)
 
-    total_eq = sum(r[1] for r in ranking)
-    total_or = sum(r[2] for r in ranking)
+def precisa_rehash(senha_hash):
+    return senha_hash.split("$", 1)[0] != _prefixo_hash()
 
-    falta_meta_dia = max(meta_dia - total_eq, 0)
 
-    return render_template(
-        "indice_dia.html",
-        ranking=ranking,
-        total_eq=total_eq,
-        total_or=total_or,
-        meta_dia=meta_dia,
-        falta_meta_dia=falta_meta_dia,
-        data_atual=hoje
-    )
+def _pool_senhas():
+    # criado sob demanda em cada worker: threads não sobrevivem ao fork do --preload
+    with _senhas["lock"]:
+        if _senhas["pid"] != os.getpid():
+            _senhas["pool"] = ThreadPoolExecutor(max_workers=SENHA_PARALELO, thread_name_prefix="senhas")
+            _senhas["pid"] = os.getpid()
+        return _senhas["pool"]
+
+
+def _verificar(senha_hash, senha):
+    if not check_password_hash(senha_hash, senha):
+        return False, None
+    return True, gerar_hash_senha(senha) if precisa_rehash(senha_hash) else None
+
+
+def verificar_senha(senha_hash, senha):
+    # (ok, novo_hash): novo_hash vem preenchido quando o hash gravado usa outro método.
+    # Levanta SenhaOcupada se não houver resposta em SENHA_ESPERA segundos.
+    prazo = time.monotonic() + SENHA_ESPERA
+    if not _senhas["vagas"].acquire(timeout=SENHA_ESPERA):
+        _senhas["recusadas"] += 1
+        raise SenhaOcupada()
+    try:
+        futuro = _pool_senhas().submit(_verificar, senha_hash, senha)
+    except Exception:
+        _senhas["vagas"].release()
+        raise
+    # A vaga só volta quando o hash termina (ou é cancelado antes de começar): depois
+    # do timeout o cálculo continua rodando e não pode abrir espaço para mais um.
+    futuro.add_done_callback(lambda _: _senhas["vagas"].release())
+    try:
+        ok, novo_hash = futuro.result(timeout=max(prazo - time.monotonic(), 0))
+    except FuturoTimeout:
+        futuro.cancel()
+        _senhas["recusadas"] += 1
+        raise SenhaOcupada()
+    _senhas["verificacoes"] += 1
+    return ok, novo_hash
+
+
+def estatisticas_senhas():
+    return {
+        "metodo": _prefixo_hash(),
+        "paralelo": SENHA_PARALELO,
+        "fila": SENHA_FILA,
+        **{k: _senhas[k] for k in ("verificacoes", "rehashes", "recusadas")},
+    }
+
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -331,13 +1979,32 @@ def login():
         senha = request.form["senha"]
         conn = get_conn()
         cur = conn.cursor()
-        cur.execute("SELECT nome, senha, role FROM users WHERE nome = ?" if isinstance(conn, sqlite3.Connection)
-                    else "SELECT nome, senha, role FROM users WHERE nome = %s", (nome,))
+        ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+        cur.execute(f"SELECT nome, senha, role FROM users WHERE nome = {ph}", (nome,))
         user = cur.fetchone()
         conn.close()
-        if user and check_password_hash(user[1], senha):
-            session["user"], session["role"] = user[0], user[2]
-            return redirect(url_for("dashboard"))
+        if user:
+            try:
+                ok, novo_hash = verificar_senha(user[1], senha)
+            except SenhaOcupada:
+                return render_template("login.html", erro="Muitos acessos ao mesmo tempo. Tente novamente em instantes."), \
+                    503, {"Retry-After": "2"}
+            if ok:
+                if novo_hash:
+                    def regravar_hash(cur, conn):
+                        ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+                        # só troca se ninguém alterou a senha enquanto verificávamos
+                        cur.execute(f"UPDATE users SET senha = {ph} WHERE nome = {ph} AND senha = {ph}",
+                                    (novo_hash, user[0], user[1]))
+
+                    try:
+                        executar_escrita(regravar_hash, publicar=False)
+                        _senhas["rehashes"] += 1
+                    except Exception as e:
+                        # o hash antigo continua válido; tenta de novo no próximo login
+                        print("⚠️ Erro ao atualizar o hash da senha:", e)
+                session["user"], session["role"] = user[0], user[2]
+                return redirect(url_for("dashboard"))
         return render_template("login.html", erro="Usuário ou senha incorretos.")
     return render_template("login.html")
 
@@ -383,43 +2050,657 @@ def nova_proposta():
             request.form.get("valor_parcela") or 0,
             request.form.get("quantidade_parcelas"),
             request.form.get("data_pagamento_prevista"),
-            request.form.get("motivo_cancelamento")
+            request.form.get("motivo_cancelamento"),
+            *colunas_busca(request.form.get("nome_cliente"), request.form.get("cpf"))
         )
 
-        conn = get_conn()
-        cur = conn.cursor()
-        ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+        codigos = (request.form.get("fonte"), request.form.get("banco"), request.form.get("observacao"))
+        executar_escrita(lambda cur, conn: inserir_proposta(cur, conn, dados + codigos_proposta(cur, conn, *codigos)))
+        return render_template("nova_proposta.html", sucesso="Proposta enviada com sucesso!")
 
-        cur.execute(f"""
-            INSERT INTO propostas 
-            (
-                data, consultor, fonte, banco, senha_digitada, tabela,
-                nome_cliente, cpf, valor_equivalente, valor_original,
-                observacao, telefone, produto, valor_parcela,
-                quantidade_parcelas, data_pagamento_prevista, motivo_cancelamento
-            )
-            VALUES ({','.join([ph]*17)})
-        """, dados)
+    return render_template("nova_proposta.html")
 
-        conn.commit()
+
+def inserir_proposta(cur, conn, dados):
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+    cur.execute(f"""
+        INSERT INTO propostas 
+        (
+            data, consultor, fonte, banco, senha_digitada, tabela,
+            nome_cliente, cpf, valor_equivalente, valor_original,
+            observacao, telefone, produto, valor_parcela,
+            quantidade_parcelas, data_pagamento_prevista, motivo_cancelamento,
+            nome_busca, cpf_digitos, fonte_id, banco_id, status_id
+        )
+        VALUES ({','.join([ph]*22)})
+        {"" if isinstance(conn, sqlite3.Connection) else "RETURNING id"}
+    """, dados)
+    novo_id = cur.lastrowid if isinstance(conn, sqlite3.Connection) else cur.fetchone()[0]
+    ajustar_agregados(cur, conn, [novo_id], 1)
+    return novo_id
+
+COLUNAS_EXPORTACAO = [
+    "ID",
+    "Data",
+    "Consultor",
+    "Fonte",
+    "Banco",
+    "Senha Digitada",
+    "Tabela",
+    "Nome do Cliente",
+    "CPF",
+    "Valor Equivalente",
+    "Valor Original",
+    "Observação",
+    "Telefone",
+    "Valor Parcela",
+    "Qtd Parcelas",
+    "Data CIP",
+    "Motivo Cancelamento"
+]
+EXPORTACAO_LOTE = 2000
+
+def linhas_exportacao(consulta, params):
+    # Cursor do lado do servidor no PostgreSQL; no SQLite o cursor já é lazy.
+    # A conexão é emprestada aqui (fora do contexto da requisição) porque a
+    # resposta continua sendo gerada depois que a rota retorna.
+    conn = get_conn(leitura=True)
+    try:
+        if isinstance(conn, sqlite3.Connection):
+            cur = conn.cursor()
+        else:
+            cur = conn.cursor(name="exportacao_relatorio")
+            cur.itersize = EXPORTACAO_LOTE
+        cur.execute(consulta, tuple(params))
+        while True:
+            lote = cur.fetchmany(EXPORTACAO_LOTE)
+            if not lote:
+                break
+            yield from lote
+        cur.close()
+    finally:
         conn.close()
-        return render_template("nova_proposta.html", sucesso="Proposta enviada com sucesso!")
 
-    return render_template("nova_proposta.html")
+def exportar_csv(consulta, params, nome_arquivo):
+    def gerar():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=";")
+        buffer.write("\ufeff")
+        writer.writerow(COLUNAS_EXPORTACAO)
+        for i, linha in enumerate(linhas_exportacao(consulta, params), 1):
+            writer.writerow(linha)
+            if i % EXPORTACAO_LOTE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return app.response_class(
+        gerar(),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(nome_arquivo)}"},
+    )
+
+def exportar_xlsx(consulta, params, nome_arquivo):
+    from openpyxl import Workbook
+
+    # Modo write-only: as linhas vão direto para um arquivo temporário em disco,
+    # que depois é enviado em blocos; a memória não cresce com o relatório.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Relatorio")
+    ws.append(COLUNAS_EXPORTACAO)
+    for linha in linhas_exportacao(consulta, params):
+        ws.append(list(linha))
+
+    arquivo = tempfile.TemporaryFile()
+    wb.save(arquivo)
+    arquivo.seek(0)
+    return send_file(arquivo, as_attachment=True, download_name=nome_arquivo)
+
+# Importação em lote de propostas (planilhas do banco). O arquivo é lido em
+# streaming, validado linha a linha e gravado em lotes de IMPORTACAO_LOTE, um
+# commit por lote; as linhas com problema voltam num relatório de erros.
+IMPORTACAO_LOTE = int(os.environ.get("IMPORTACAO_LOTE", 5000))
+IMPORTACAO_MAX_ERROS = 1000
+
+COLUNAS_PROPOSTA = [
+    "data", "consultor", "fonte", "banco", "senha_digitada", "tabela",
+    "nome_cliente", "cpf", "valor_equivalente", "valor_original",
+    "observacao", "telefone", "produto", "valor_parcela",
+    "quantidade_parcelas", "data_pagamento_prevista", "motivo_cancelamento",
+]
+
+# cabeçalhos aceitos (já normalizados), incluindo os da exportação do relatório
+CABECALHOS_IMPORTACAO = {
+    **{coluna: coluna for coluna in COLUNAS_PROPOSTA},
+    "nome_do_cliente": "nome_cliente",
+    "cliente": "nome_cliente",
+    "qtd_parcelas": "quantidade_parcelas",
+    "parcelas": "quantidade_parcelas",
+    "data_cip": "data_pagamento_prevista",
+    "status": "observacao",
+}
+CABECALHOS_OBRIGATORIOS = {"data", "consultor", "cpf"}
+
+# dd/mm/aaaa [hh:mm[:ss]]; o formato ISO fica com datetime.fromisoformat
+RE_DATA_BR = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{2}|\d{4})(?:[ T](\d{1,2}):(\d{2})(?::(\d{2}))?)?")
+RE_MILHAR_BRL = re.compile(r"[1-9]\d{0,2}(\.\d{3})+")
+
+
+def _texto(valor):
+    if valor is None:
+        return None
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    texto = str(valor).strip()
+    return texto or None
+
+
+def _cpf_valido(digitos):
+    if digitos == digitos[0] * 11:
+        return False
+    numeros = [int(d) for d in digitos]
+    for n in (9, 10):
+        soma = sum(d * p for d, p in zip(numeros, range(n + 1, 1, -1)))
+        if soma * 10 % 11 % 10 != numeros[n]:
+            return False
+    return True
+
+
+def normalizar_cpf(valor):
+    digitos = re.sub(r"\D", "", _texto(valor) or "")
+    if not digitos:
+        raise ValueError("CPF vazio")
+    digitos = digitos.zfill(11)
+    if len(digitos) != 11 or not _cpf_valido(digitos):
+        raise ValueError(f"CPF inválido: {valor}")
+    return f"{digitos[:3]}.{digitos[3:6]}.{digitos[6:9]}-{digitos[9:]}"
+
+
+def normalizar_valor_brl(valor):
+    if isinstance(valor, (int, float)):
+        numero = float(valor)
+    else:
+        texto = (_texto(valor) or "").replace("R$", "").replace("\xa0", "").replace(" ", "")
+        if not texto:
+            return 0.0
+        # "1.234" e "R$ 2.500" são milhar (padrão BR); "1.5" e "12.34" são decimal
+        if "," in texto:
+            texto = texto.replace(".", "").replace(",", ".")
+        elif RE_MILHAR_BRL.fullmatch(texto):
+            texto = texto.replace(".", "")
+        elif texto.count(".") > 1:
+            raise ValueError(f"valor inválido: {valor}")
+        try:
+            numero = float(texto)
+        except ValueError:
+            raise ValueError(f"valor inválido: {valor}")
+    if numero < 0:
+        raise ValueError(f"valor negativo: {valor}")
+    return round(numero, 2)
+
+
+def normalizar_data_importacao(valor):
+    # Datas sem fuso são horário de Brasília; com fuso, são convertidas para ele.
+    if isinstance(valor, datetime):
+        data = valor
+    elif isinstance(valor, date):
+        data = datetime(valor.year, valor.month, valor.day)
+    else:
+        texto = _texto(valor)
+        if not texto:
+            raise ValueError("data vazia")
+        try:
+            br = RE_DATA_BR.fullmatch(texto)
+            if br:
+                dia, mes, ano, hora, minuto, segundo = br.groups()
+                ano = int(ano) + (2000 if len(ano) == 2 else 0)
+                data = datetime(ano, int(mes), int(dia), int(hora or 0), int(minuto or 0), int(segundo or 0))
+            else:
+                data = datetime.fromisoformat(texto)
+        except ValueError:
+            raise ValueError(f"data inválida: {valor}")
+    if data.tzinfo is not None:
+        data = data.astimezone(pytz.timezone("America/Sao_Paulo")).replace(tzinfo=None)
+    return data
+
+
+def _canonico(valor, mapa):
+    texto = _texto(valor)
+    if texto is None:
+        return None
+    canonico = mapa.get(_chave_texto(texto))
+    if canonico is None:
+        raise ValueError(f"valor não reconhecido: {texto}")
+    return canonico
+
+
+def validar_linha_importacao(campos, consultores, canonicos):
+    # Devolve (tupla na ordem de COLUNAS_PROPOSTA, lista de erros). `consultores` e
+    # `canonicos` mapeiam a forma normalizada (_chave_texto) para o valor gravado.
+    erros = []
+
+    def campo(nome, funcao):
+        try:
+            return funcao(campos.get(nome))
+        except ValueError as e:
+            erros.append(f"{nome}: {e}")
+            return None
+
+    data = campo("data", normalizar_data_importacao)
+    consultor = consultores.get(_chave_texto(_texto(campos.get("consultor")) or ""))
+    if consultor is None:
+        erros.append(f"consultor: não cadastrado: {_texto(campos.get('consultor')) or '(vazio)'}")
+
+    data_cip = campo("data_pagamento_prevista",
+                     lambda v: normalizar_data_importacao(v).strftime("%d/%m/%Y") if _texto(v) or isinstance(v, date) else None)
+    parcelas = campo("quantidade_parcelas", lambda v: int(normalizar_valor_brl(v)) if _texto(v) else None)
+
+    proposta = (
+        data.replace(microsecond=0).isoformat(" ") if data else None,
+        consultor,
+        campo("fonte", lambda v: _canonico(v, canonicos["fonte"])),
+        campo("banco", lambda v: _canonico(v, canonicos["banco"])),
+        _texto(campos.get("senha_digitada")),
+        _texto(campos.get("tabela")),
+        _texto(campos.get("nome_cliente")),
+        campo("cpf", normalizar_cpf),
+        campo("valor_equivalente", normalizar_valor_brl),
+        campo("valor_original", normalizar_valor_brl),
+        campo("observacao", lambda v: _canonico(v, canonicos["observacao"])),
+        _texto(campos.get("telefone")),
+        _texto(campos.get("produto")),
+        campo("valor_parcela", normalizar_valor_brl),
+        parcelas,
+        data_cip,
+        _texto(campos.get("motivo_cancelamento")),
+    )
+    return proposta, erros
+
+
+def linhas_planilha(arquivo, nome_arquivo):
+    # Gera (número da linha na planilha, {coluna: valor}) sem carregar o arquivo inteiro.
+    if nome_arquivo.lower().endswith(".xlsx"):
+        from openpyxl import load_workbook
+        wb = load_workbook(arquivo, read_only=True, data_only=True)
+        linhas = wb.active.iter_rows(values_only=True)
+    else:
+        amostra = arquivo.read(65536)
+        arquivo.seek(0)
+        try:
+            amostra.decode("utf-8")
+            encoding = "utf-8-sig"
+        except UnicodeDecodeError as e:
+            encoding = "utf-8-sig" if e.start >= len(amostra) - 3 else "cp1252"
+        texto = io.TextIOWrapper(arquivo, encoding=encoding, newline="")
+        try:
+            delimitador = csv.Sniffer().sniff(amostra.decode(encoding, errors="ignore"), delimiters=";,\t").delimiter
+        except csv.Error:
+            delimitador = ";"
+        linhas = csv.reader(texto, delimiter=delimitador)
+
+    cabecalho = next(linhas, None) or []
+    indices = [(i, CABECALHOS_IMPORTACAO.get(_chave_texto(c or ""))) for i, c in enumerate(cabecalho)]
+    indices = [(i, coluna) for i, coluna in indices if coluna]
+    faltando = CABECALHOS_OBRIGATORIOS - {coluna for _, coluna in indices}
+    if faltando:
+        raise ValueError(f"Colunas obrigatórias ausentes: {', '.join(sorted(faltando))}")
+
+    for numero, valores in enumerate(linhas, 2):
+        if not any(v not in (None, "") for v in valores):
+            continue
+        yield numero, {coluna: valores[i] for i, coluna in indices if i < len(valores)}
+
+
+def inserir_varias(cur, conn, sql_insert, linhas, sufixo=""):
+    # SQLite: executemany (sem ida e volta por linha). PostgreSQL: um INSERT com
+    # várias tuplas em VALUES por página, em vez de um comando por linha.
+    n = len(linhas[0])
+    if isinstance(conn, sqlite3.Connection):
+        cur.executemany(f"{sql_insert} VALUES ({','.join(['?'] * n)}) {sufixo}", linhas)
+        return
+    tupla = "(" + ",".join(["%s"] * n) + ")"
+    for i in range(0, len(linhas), 500):
+        pagina = linhas[i:i + 500]
+        cur.execute(f"{sql_insert} VALUES {','.join([tupla] * len(pagina))} {sufixo}",
+                    [v for linha in pagina for v in linha])
+
+
+def gravar_lote_propostas(cur, conn, lote):
+    codigos = {}
+    for p in lote:
+        if (p[2], p[3], p[10]) not in codigos:
+            codigos[p[2], p[3], p[10]] = codigos_proposta(cur, conn, p[2], p[3], p[10])
+    lote = [(*p, *colunas_busca(p[6], p[7]), *codigos[p[2], p[3], p[10]]) for p in lote]
+    inserir_varias(cur, conn,
+                   f"INSERT INTO propostas ({', '.join(COLUNAS_PROPOSTA + COLUNAS_BUSCA + COLUNAS_DIMENSAO)})",
+                   lote)
+
+    # agregado diário somado em Python: um upsert por chave em vez de reler o lote
+    deltas = {}
+    for p in lote:
+        chave = (p[1] or "", p[0][:10], p[-3] or 0, p[-2] or 0, p[-1] or 0)
+        delta = deltas.setdefault(chave, [0, 0.0, 0.0])
+        delta[0] += 1
+        delta[1] += p[8] or 0
+        delta[2] += p[9] or 0
+    inserir_varias(
+        cur, conn,
+        f"INSERT INTO propostas_diarias ({CHAVE_AGREGADO}, qtd, total_eq, total_or)",
+        [(*chave, *delta) for chave, delta in deltas.items()],
+        f"""ON CONFLICT ({CHAVE_AGREGADO}) DO UPDATE SET
+            qtd = propostas_diarias.qtd + excluded.qtd,
+            total_eq = propostas_diarias.total_eq + excluded.total_eq,
+            total_or = propostas_diarias.total_or + excluded.total_or""",
+    )
+    inserir_varias(cur, conn, "INSERT INTO series_pendentes (dia)",
+                   sorted({(chave[1],) for chave in deltas}), "ON CONFLICT (dia) DO UPDATE SET dia = excluded.dia")
+
+
+def importar_propostas(arquivo, nome_arquivo):
+    canonicos = {
+        "fonte": _mapa_canonico(FONTES_LISTA),
+        "banco": _mapa_canonico(BANCOS_LISTA),
+        "observacao": _mapa_canonico(OBSERVACOES_LISTA),
+    }
+    resultado = {"importadas": 0, "com_erro": 0, "erros": []}
+
+    def registrar_erro(numero, mensagens):
+        resultado["com_erro"] += 1
+        if len(resultado["erros"]) < IMPORTACAO_MAX_ERROS:
+            resultado["erros"].append({"linha": numero, "erros": mensagens})
+
+    with conexao() as conn:
+        consultores = {_chave_texto(nome): nome for nome in consultores_cadastrados(conn.cursor())}
+    lote, numeros = [], []
+
+    def gravar():
+        # um commit (e um aviso às telas) por lote, pela fila de escrita
+        dados = list(lote)
+        try:
+            executar_escrita(lambda cur, conn: gravar_lote_propostas(cur, conn, dados))
+            resultado["importadas"] += len(dados)
+        except Exception as e:
+            for numero in numeros:
+                registrar_erro(numero, [f"erro ao gravar o lote: {e}"])
+        lote.clear()
+        numeros.clear()
+
+    for numero, campos in linhas_planilha(arquivo, nome_arquivo):
+        proposta, erros = validar_linha_importacao(campos, consultores, canonicos)
+        if erros:
+            registrar_erro(numero, erros)
+            continue
+        lote.append(proposta)
+        numeros.append(numero)
+        if len(lote) >= IMPORTACAO_LOTE:
+            gravar()
+    if lote:
+        gravar()
+    return resultado
+
+
+@app.route("/importar_propostas", methods=["GET", "POST"])
+def importar_propostas_view():
+    if "user" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+
+    if request.method == "GET":
+        return render_template("importar_propostas.html")
+
+    arquivo = request.files.get("arquivo")
+    nome = (arquivo.filename or "") if arquivo else ""
+    if not nome.lower().endswith((".csv", ".xlsx")):
+        erro = "Envie um arquivo .csv ou .xlsx."
+        resultado = None
+    else:
+        inicio = time.perf_counter()
+        try:
+            resultado = importar_propostas(arquivo.stream, nome)
+            resultado["segundos"] = round(time.perf_counter() - inicio, 2)
+            erro = None
+        except ValueError as e:
+            resultado, erro = None, str(e)
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(resultado if resultado else {"erro": erro}), 200 if resultado else 400
+    return render_template("importar_propostas.html", resultado=resultado, erro=erro,
+                           max_erros=IMPORTACAO_MAX_ERROS)
+
+
+@app.cli.command("importar-propostas")
+@click.argument("caminho")
+def importar_propostas_cmd(caminho):
+    inicio = time.perf_counter()
+    with open(caminho, "rb") as arquivo:
+        resultado = importar_propostas(arquivo, caminho)
+    segundos = time.perf_counter() - inicio
+    print(f"✅ {resultado['importadas']} proposta(s) importada(s) em {segundos:.2f}s, "
+          f"{resultado['com_erro']} linha(s) com erro.")
+    for erro in resultado["erros"][:50]:
+        print(f"    linha {erro['linha']}: {'; '.join(erro['erros'])}")
+
+
+# Troca de status em massa (conciliação de fim de mês): um UPDATE por lote de
+# STATUS_LOTE propostas, com o agregado diário ajustado uma vez por lote.
+STATUS_LOTE = 500
+STATUS_MAX_NAO_ENCONTRADOS = 1000
+
+
+def separar_identificadores(texto, tipo):
+    # Devolve (valores válidos, tokens não reconhecidos); tipo é "ids" ou "cpfs".
+    validos, invalidos = [], []
+    for token in re.split(r"[\s,;]+", texto or ""):
+        if not token:
+            continue
+        digitos = re.sub(r"\D", "", token)
+        if tipo == "ids" and token.isdigit():
+            validos.append(int(token))
+        elif tipo == "cpfs" and digitos and len(digitos) <= 11:
+            validos.append(digitos.zfill(11))
+        else:
+            invalidos.append(token)
+    return list(dict.fromkeys(validos)), invalidos
+
+
+def atualizar_status_em_lote(ids, cpfs, observacao, motivo=None):
+    status = _mapa_canonico(OBSERVACOES_LISTA).get(_chave_texto(observacao or ""))
+    if status is None:
+        raise ValueError(f"Status inválido: {observacao}")
+    # motivo só faz sentido para cancelamento; sem motivo novo, o atual é mantido
+    motivo = (motivo or None) if status == "CANCELADO" else None
+
+    resultado = {
+        "status": status,
+        "solicitados": len(ids) + len(cpfs),
+        "encontradas": 0,
+        "atualizadas": 0,
+        "ja_no_status": 0,
+        "nao_encontrados": [],
+    }
+
+    vistos = set()  # proposta pedida por id e por CPF conta (e é ajustada) uma vez só
+
+    def atualizar_lote(cur, conn, coluna, lote):
+        # roda na fila de escrita: devolve as contagens em vez de mexer em resultado,
+        # para um lote que falhe não deixar números pela metade
+        sqlite = isinstance(conn, sqlite3.Connection)
+        ph = "?" if sqlite else "%s"
+        # fora do cancelamento o motivo gravado fica como está
+        set_motivo = f", motivo_cancelamento = COALESCE({ph}, motivo_cancelamento)" if status == "CANCELADO" else ""
+        status_id = codigo_dimensao(cur, "status", status)
+        cur.execute(f"""
+            SELECT id, cpf_digitos, status_id, motivo_cancelamento
+            FROM propostas
+            WHERE {coluna} IN ({','.join([ph] * len(lote))})
+            {"" if sqlite else "FOR UPDATE"}
+        """, tuple(lote))
+        linhas = cur.fetchall()
+
+        achados = {r[0] if coluna == "id" else r[1] for r in linhas}
+        linhas = [r for r in linhas if r[0] not in vistos]
+        parcial = {
+            "ids": [r[0] for r in linhas],
+            "faltando": [v for v in lote if v not in achados],
+            "encontradas": len(linhas),
+            "ja_no_status": sum(1 for r in linhas if r[2] == status_id),
+            "atualizadas": 0,
+        }
+
+        # só o que muda de fato: outro status, ou um motivo de cancelamento novo
+        alvo = [r[0] for r in linhas
+                if r[2] != status_id or (motivo is not None and r[3] != motivo)]
+        if alvo:
+            ajustar_agregados(cur, conn, alvo, -1)
+            cur.execute(f"""
+                UPDATE propostas
+                SET observacao = {ph}, status_id = {ph}{set_motivo}
+                WHERE id IN ({','.join([ph] * len(alvo))})
+            """, (status, status_id, *([motivo] if set_motivo else []), *alvo))
+            parcial["atualizadas"] = cur.rowcount
+            ajustar_agregados(cur, conn, alvo, 1)
+        return parcial
+
+    # um commit por lote, pela fila de escrita
+    for coluna, valores in (("id", ids), ("cpf_digitos", cpfs)):
+        for i in range(0, len(valores), STATUS_LOTE):
+            lote = valores[i:i + STATUS_LOTE]
+            parcial = executar_escrita(lambda cur, conn: atualizar_lote(cur, conn, coluna, lote))
+            vistos.update(parcial["ids"])
+            espaco = STATUS_MAX_NAO_ENCONTRADOS - len(resultado["nao_encontrados"])
+            resultado["nao_encontrados"] += parcial["faltando"][:max(espaco, 0)]
+            for chave in ("encontradas", "ja_no_status", "atualizadas"):
+                resultado[chave] += parcial[chave]
+
+    return resultado
+
+
+@app.route("/atualizar_status", methods=["GET", "POST"])
+def atualizar_status():
+    # Formulário do admin ou API: POST JSON {"ids": [...], "cpfs": [...],
+    # "observacao": "PAGO", "motivo_cancelamento": "..."}.
+    if "user" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+
+    contexto = {"observacoes": OBSERVACOES_LISTA, "motivos": MOTIVOS_CANCELAMENTO}
+    if request.method == "GET":
+        return render_template("atualizar_status.html", **contexto)
+
+    if request.is_json:
+        corpo = request.get_json(silent=True) or {}
+        ids, invalidos = separar_identificadores(" ".join(map(str, corpo.get("ids") or [])), "ids")
+        cpfs, invalidos_cpf = separar_identificadores(" ".join(map(str, corpo.get("cpfs") or [])), "cpfs")
+        invalidos += invalidos_cpf
+        observacao, motivo = corpo.get("observacao"), corpo.get("motivo_cancelamento")
+    else:
+        tipo = request.form.get("tipo", "ids")
+        valores, invalidos = separar_identificadores(request.form.get("identificadores"), tipo)
+        ids, cpfs = (valores, []) if tipo == "ids" else ([], valores)
+        observacao, motivo = request.form.get("observacao"), request.form.get("motivo_cancelamento")
+
+    try:
+        resultado = atualizar_status_em_lote(ids, cpfs, observacao, motivo)
+        resultado["invalidos"] = invalidos
+        erro = None
+    except ValueError as e:
+        resultado, erro = None, str(e)
+
+    if request.is_json:
+        return jsonify(resultado if resultado else {"erro": erro}), 200 if resultado else 400
+    return render_template("atualizar_status.html", resultado=resultado, erro=erro, **contexto)
+
+
+RESUMO_CACHE_TTL = float(os.environ.get("RESUMO_CACHE_TTL", 30))
+_cache_resumos = CacheTTL(RESUMO_CACHE_TTL)
+
+# Propostas que entram nos relatórios, igual em propostas e no agregado diário (que
+# guarda consultor nulo como ''): consultor preenchido e que não seja admin.
+FILTRO_CONSULTOR_RELATORIO = "consultor <> '' AND consultor NOT IN (SELECT nome FROM users WHERE role = 'admin')"
+
+
+def resumo_relatorio(cur, ph, condicoes, params, dias=None):
+    # Total de propostas e somas dos pagos numa passada só, em cache pela assinatura
+    # do filtro. Com `dias` (visão "Todos" sem outros filtros) lê do agregado diário.
+    chave = (" AND ".join(condicoes), tuple(params), dias)
+    resumo = _cache_resumos.obter(chave)
+    if resumo is not None:
+        return resumo
+
+    pago = codigo_dimensao(cur, "status", "PAGO")
+    if dias:
+        cur.execute(f"""
+            SELECT
+                COALESCE(SUM(qtd), 0),
+                COALESCE(SUM(CASE WHEN status_id = {ph} THEN total_eq END), 0),
+                COALESCE(SUM(CASE WHEN status_id = {ph} THEN total_or END), 0)
+            FROM propostas_diarias
+            WHERE dia >= {ph} AND dia < {ph}
+            AND {FILTRO_CONSULTOR_RELATORIO}
+        """, (pago, pago, *dias))
+    else:
+        cur.execute(f"""
+            SELECT
+                COUNT(*),
+                COALESCE(SUM(CASE WHEN status_id = {ph} THEN valor_equivalente END), 0),
+                COALESCE(SUM(CASE WHEN status_id = {ph} THEN valor_original END), 0)
+            FROM propostas
+            WHERE {" AND ".join(condicoes)}
+        """, (pago, pago, *params))
+
+    resumo = tuple(cur.fetchone())
+    _cache_resumos.guardar(chave, resumo)
+    return resumo
+
+
+def dias_validos(*dias):
+    try:
+        for dia in dias:
+            datetime.strptime(dia, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def resumo_painel(cur, ph, tabela, condicoes, params):
+    # (total, pagos eq, pagos or, canceladas qtd, canceladas or, aguardando qtd,
+    # aguardando or) numa consulta só, em `propostas` ou em `propostas_diarias`.
+    if tabela == "propostas_diarias":
+        qtd, eq, or_ = "qtd", "total_eq", "total_or"
+    else:
+        qtd, eq, or_ = "1", "valor_equivalente", "valor_original"
+    pago = codigo_dimensao(cur, "status", "PAGO")
+    cancelado = codigo_dimensao(cur, "status", "CANCELADO")
+    aguardando = [codigo for codigo, nome in nomes_dimensao(cur, "status").items() if "AGUARD" in nome.upper()] or [0]
+    em_aguardando = f"status_id IN ({','.join([ph] * len(aguardando))})"
+    cur.execute(f"""
+        SELECT
+            COALESCE(SUM({qtd}), 0),
+            COALESCE(SUM(CASE WHEN status_id = {ph} THEN {eq} END), 0),
+            COALESCE(SUM(CASE WHEN status_id = {ph} THEN {or_} END), 0),
+            COALESCE(SUM(CASE WHEN status_id = {ph} THEN {qtd} ELSE 0 END), 0),
+            COALESCE(SUM(CASE WHEN status_id = {ph} THEN {or_} END), 0),
+            COALESCE(SUM(CASE WHEN {em_aguardando} THEN {qtd} ELSE 0 END), 0),
+            COALESCE(SUM(CASE WHEN {em_aguardando} THEN {or_} END), 0)
+        FROM {tabela}
+        WHERE {" AND ".join(condicoes)}
+    """, (pago, pago, cancelado, cancelado, *aguardando, *aguardando, *params))
+    total, *somas = cur.fetchone()
+    return (int(total), float(somas[0]), float(somas[1]), int(somas[2]), float(somas[3]),
+            int(somas[4]), float(somas[5]))
+
 
 @app.route("/relatorios", methods=["GET", "POST"])
 def relatorios():
     if "user" not in session or session["role"] != "admin":
         return redirect(url_for("login"))   
 
-    conn = get_conn()
+    conn = get_conn(leitura=True)
     cur = conn.cursor()
 
-    cur.execute("""
+    cur.execute(f"""
         SELECT DISTINCT consultor
         FROM propostas
-        WHERE consultor IS NOT NULL
-        AND consultor NOT IN (SELECT nome FROM users WHERE role = 'admin')
+        WHERE {FILTRO_CONSULTOR_RELATORIO}
         ORDER BY consultor;
     """)
     usuarios = [u[0] for u in cur.fetchall()]
@@ -455,7 +2736,7 @@ def relatorios():
             tabela=tabela or "",
             banco=banco or "",
             cpf=cpf or "",
-            pagina=1
+            por_pagina=request.form.get("por_pagina") or ""
         ))
 
     def normalizar_data(data_str):
@@ -480,14 +2761,21 @@ def relatorios():
 
     condicoes, params = [], []
 
-    condicoes.append("consultor NOT IN (SELECT nome FROM users WHERE role = 'admin')")
+    condicoes.append(FILTRO_CONSULTOR_RELATORIO)
 
     def filtro_lower(campo, valor):
         return f"LOWER({campo}) LIKE {ph}", f"%{valor.lower()}%"
 
     if user and user.strip() and user != "-":
-        condicoes.append(f"LOWER(consultor) LIKE {ph}")
-        params.append(f"%{user.lower()}%")
+        # resolve a busca parcial contra a lista de consultores para filtrar por igualdade
+        encontrados = [u for u in usuarios if user.lower() in u.lower()]
+        if encontrados:
+            condicoes.append(f"consultor IN ({','.join([ph] * len(encontrados))})")
+            params += encontrados
+        else:
+            condicoes.append("1 = 0")
+
+    dias_inteiros = None
 
     if data_ini and data_fim:
         condicoes.append(f"data BETWEEN {ph} AND {ph}")
@@ -495,9 +2783,13 @@ def relatorios():
         mes_atual = "Filtro por período"
 
     elif cpf:
-        filtro, valor = filtro_lower("cpf", cpf)
-        condicoes.append(filtro)
-        params.append(valor)
+        digitos = re.sub(r"\D", "", cpf)
+        if digitos:
+            filtro, valor = filtro_cpf(conn, ph, digitos)
+            condicoes.append(filtro)
+            params.append(valor)
+        else:
+            condicoes.append("1 = 0")
         mes_atual = "Filtro por CPF"
 
     elif mes or ano:
@@ -506,29 +2798,29 @@ def relatorios():
 
         if not mes:
             inicio = f"{ano}-01-01 00:00:00"
-            fim = f"{ano}-12-31 23:59:59"
+            fim = f"{int(ano) + 1}-01-01 00:00:00"
             mes_atual = f"Ano {ano}"
         else:
             inicio = f"{ano}-{mes}-01 00:00:00"
             inicio_dt = datetime.strptime(inicio, "%Y-%m-%d %H:%M:%S")
-            fim_dt = inicio_dt + relativedelta(months=1) - timedelta(seconds=1)
-            fim = fim_dt.strftime("%Y-%m-%d %H:%M:%S")
+            fim = (inicio_dt + relativedelta(months=1)).strftime("%Y-%m-%d %H:%M:%S")
             mes_atual = f"{mes}/{ano}"
 
-        condicoes.append(f"data BETWEEN {ph} AND {ph}")
+        condicoes.append(filtro_periodo(ph))
         params += [inicio, fim]
+        dias_inteiros = (inicio[:10], fim[:10])
 
     else:
         agora = datetime.now()
-        inicio_mes = agora.replace(day=1, hour=0, minute=0, second=0)
+        inicio_mes = agora.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
         proximo_mes = inicio_mes + relativedelta(months=1)
-        fim_mes = proximo_mes - timedelta(seconds=1)
 
-        condicoes.append(f"data BETWEEN {ph} AND {ph}")
+        condicoes.append(filtro_periodo(ph))
         params += [
             inicio_mes.strftime("%Y-%m-%d %H:%M:%S"),
-            fim_mes.strftime("%Y-%m-%d %H:%M:%S")
+            proximo_mes.strftime("%Y-%m-%d %H:%M:%S")
         ]
+        dias_inteiros = (inicio_mes.strftime("%Y-%m-%d"), proximo_mes.strftime("%Y-%m-%d"))
 
         meses_pt = {
             "January": "Janeiro", "February": "Fevereiro", "March": "Março",
@@ -540,9 +2832,9 @@ def relatorios():
         mes_atual = f"{meses_pt[mes_nome]}/{inicio_mes.year}"
 
     if observacao:
-        filtro, valor = filtro_lower("observacao", observacao)
+        filtro, valores = filtro_dimensao(cur, ph, "status", observacao, exato=False)
         condicoes.append(filtro)
-        params.append(valor)
+        params += valores
 
     if senha_digitada:
         filtro, valor = filtro_lower("senha_digitada", senha_digitada)
@@ -550,102 +2842,66 @@ def relatorios():
         params.append(valor)
 
     if fonte:
-        filtro, valor = filtro_lower("fonte", fonte)
+        filtro, valores = filtro_dimensao(cur, ph, "fonte", fonte, exato=False)
         condicoes.append(filtro)
-        params.append(valor)
+        params += valores
 
     if banco:
-        filtro, valor = filtro_lower("banco", banco)
+        filtro, valores = filtro_dimensao(cur, ph, "banco", banco, exato=False)
         condicoes.append(filtro)
-        params.append(valor)
+        params += valores
 
     if tabela:
         filtro, valor = filtro_lower("tabela", tabela)
         condicoes.append(filtro)
         params.append(valor)
 
+    select_base = query_base
     if condicoes:
         query_base += " WHERE " + " AND ".join(condicoes)
 
-    order_clause = "ORDER BY datetime(data) DESC" if isinstance(conn, sqlite3.Connection) else "ORDER BY data DESC"
+    order_clause = "ORDER BY data DESC, id DESC"
 
-    pagina = int(request.args.get("pagina", 1))
-    por_pagina = 50
-    offset = (pagina - 1) * por_pagina
-
-    cur.execute(f"SELECT COUNT(*) FROM ({query_base})", tuple(params))
-    total_registros = cur.fetchone()[0]
-    total_paginas = (total_registros + por_pagina - 1) // por_pagina
+    if acao in ("baixar", "baixar_csv"):
+        conn.close()
+        nome_arquivo = f"Relatorio_{user or 'Todos'}_{datetime.now().strftime('%d-%m_%Hh%M')}"
+        consulta = f"{query_base} {order_clause}"
+        if acao == "baixar_csv":
+            return exportar_csv(consulta, params, f"{nome_arquivo}.csv")
+        return exportar_xlsx(consulta, params, f"{nome_arquivo}.xlsx")
 
-    query_paginada = f"{query_base} {order_clause} LIMIT {ph} OFFSET {ph}"
-    params_paginada = params + [por_pagina, offset]
+    por_pagina = tamanho_pagina(request.args.get("por_pagina"))
 
-    cur.execute(
-        query_paginada.replace("?", "%s") if not isinstance(conn, sqlite3.Connection) else query_paginada,
-        tuple(params_paginada)
+    somente_periodo = not (user or observacao or senha_digitada or fonte or banco or tabela)
+    total_registros, total_equivalente, total_original = resumo_relatorio(
+        cur, ph, condicoes, params, dias_inteiros if somente_periodo else None
     )
-    dados = cur.fetchall()
+    total_paginas = (total_registros + por_pagina - 1) // por_pagina
 
-    cur.execute(
-        f"""
-        SELECT 
-            COALESCE(SUM(valor_equivalente),0),
-            COALESCE(SUM(valor_original),0)
-        FROM ({query_base})
-        WHERE UPPER(observacao) = 'PAGO'
-        """,
-        tuple(params)
+    dados, cursor_anterior, cursor_proxima, pagina = paginar_keyset(
+        cur, ph, select_base, condicoes, params, request.args.get("cursor"), por_pagina, total_registros
     )
 
-    total_equivalente, total_original = cur.fetchone()
+    args_links = {k: v for k, v in request.args.items() if k not in ("cursor", "pagina") and v}
+    links_paginacao = {
+        "primeira": url_for("relatorios", **args_links) if pagina > 1 else None,
+        "anterior": url_for("relatorios", **args_links, cursor=cursor_anterior) if cursor_anterior else None,
+        "proxima": url_for("relatorios", **args_links, cursor=cursor_proxima) if cursor_proxima else None,
+        "ultima": url_for("relatorios", **args_links,
+                          cursor=codificar_cursor(None, None, "ultima", total_paginas))
+                  if cursor_proxima else None,
+    }
+
     total_propostas = total_registros
 
-    cur.execute("SELECT valor FROM metas_globais ORDER BY id DESC LIMIT 1;")
-    meta_row = cur.fetchone()
-    meta_global = float(meta_row[0]) if meta_row else 0.0
+    meta_global = meta_global_atual(cur)
 
     if user:
-        cur.execute(
-            "SELECT meta FROM metas_individuais WHERE consultor = %s;"
-            if not isinstance(conn, sqlite3.Connection)
-            else "SELECT meta FROM metas_individuais WHERE consultor = ?;",
-            (user,),
-        )
-        meta_individual_row = cur.fetchone()
-        meta_individual = float(meta_individual_row[0]) if meta_individual_row else meta_global
+        meta_individual = metas_individuais(cur).get(user, meta_global)
         falta_para_meta = max(meta_individual - float(total_equivalente or 0), 0)
     else:
         falta_para_meta = max(meta_global - float(total_equivalente or 0), 0)
 
-    if acao == "baixar":
-        colunas = [
-            "ID",
-            "Data",
-            "Consultor",
-            "Fonte",
-            "Banco",
-            "Senha Digitada",
-            "Tabela",
-            "Nome do Cliente",
-            "CPF",
-            "Valor Equivalente",
-            "Valor Original",
-            "Observação",
-            "Telefone",
-            "Valor Parcela",
-            "Qtd Parcelas",
-            "Data CIP",
-            "Motivo Cancelamento"
-        ]
-
-        df = pd.DataFrame(dados, columns=colunas)
-        output = io.BytesIO()
-        df.to_excel(output, index=False, engine="openpyxl")
-        output.seek(0)
-        filename = f"Relatorio_{user or 'Todos'}_{datetime.now().strftime('%d-%m_%Hh%M')}.xlsx"
-        conn.close()
-        return send_file(output, as_attachment=True, download_name=filename)
-
     conn.close()
 
     return render_template(
@@ -667,20 +2923,107 @@ def relatorios():
         falta_para_meta=falta_para_meta,
         pagina=pagina,
         total_paginas=total_paginas,
+        links_paginacao=links_paginacao,
+        por_pagina=por_pagina,
         mes_atual=mes_atual
     )
 
 from datetime import datetime, timedelta
 
-@app.route("/dashboard")
-def dashboard():
-    if "user" not in session:
-        return redirect(url_for("login"))
 
-    periodo = request.args.get("periodo")
-    inicio = request.args.get("inicio")
-    fim = request.args.get("fim")
+@dataclass
+class ResumoDashboard:
+    total_eq: float = 0.0
+    total_or: float = 0.0
+    total_propostas: int = 0
+    canceladas_qtd: int = 0
+    canceladas_valor: float = 0.0
+    aguardando_qtd: int = 0
+    aguardando_valor: float = 0.0
+    total_hoje: float = 0.0
+    ranking: list = field(default_factory=list)
+    bancos_dados: list = field(default_factory=list)
+    fontes: dict = field(default_factory=dict)
+
+
+def agregar_dashboard(cur, ph, inicio, fim, hoje):
+    # Lê do agregado diário, agrupado no nível mais fino (consultor, banco, fonte,
+    # status); os cards são consolidados em Python.
+    filtro_data = f"(dia >= {ph} AND dia <= {ph})"
+    filtro_hoje = f"(dia = {ph})"
+    cur.execute(f"""
+        SELECT
+            consultor,
+            banco_id,
+            fonte_id,
+            status_id,
+            CASE WHEN {filtro_data} THEN 1 ELSE 0 END AS no_periodo,
+            CASE WHEN {filtro_hoje} THEN 1 ELSE 0 END AS de_hoje,
+            SUM(qtd) AS qtd,
+            SUM(total_eq) AS total_eq,
+            SUM(total_or) AS total_or
+        FROM propostas_diarias
+        WHERE {filtro_data} OR {filtro_hoje}
+        GROUP BY 1, 2, 3, 4, 5, 6
+    """, (inicio, fim, hoje, inicio, fim, hoje))
+
+    linhas = cur.fetchall()
+    bancos, fontes, status_nomes = (nomes_dimensao(cur, d) for d in ("banco", "fonte", "status"))
+
+    resumo = ResumoDashboard(fontes={fonte: {} for fonte in FONTES_LISTA})
+    por_consultor, por_banco = {}, {}
+
+    for consultor, banco_id, fonte_id, status_id, no_periodo, de_hoje, qtd, eq, or_ in linhas:
+        eq, or_ = float(eq or 0), float(or_ or 0)
+        banco, fonte, status = bancos.get(banco_id), fontes.get(fonte_id), status_nomes.get(status_id, "")
+
+        if de_hoje:
+            resumo.total_hoje += eq
+
+        if not no_periodo:
+            continue
 
+        status_upper = (status or "").upper()
+
+        if status_upper == "PAGO":
+            resumo.total_eq += eq
+            resumo.total_or += or_
+            resumo.total_propostas += qtd
+            por_consultor[consultor] = por_consultor.get(consultor, 0) + eq
+            if banco:
+                b_qtd, b_valor = por_banco.get(banco, (0, 0))
+                por_banco[banco] = (b_qtd + qtd, b_valor + eq)
+
+        elif status_upper == "CANCELADO":
+            resumo.canceladas_qtd += qtd
+            resumo.canceladas_valor += eq
+
+        elif status_upper == "AGUARDANDO SALDO":
+            resumo.aguardando_qtd += qtd
+            resumo.aguardando_valor += eq
+
+        if fonte in resumo.fontes:
+            status_titulo = (status or "Andamento").title()
+            info = resumo.fontes[fonte].setdefault(
+                status_titulo, {"qtd": 0, "valor_eq": 0.0, "valor_or": 0.0}
+            )
+            info["qtd"] += qtd
+            info["valor_eq"] += eq
+            info["valor_or"] += or_
+
+    resumo.ranking = sorted(por_consultor.items(), key=lambda r: r[1], reverse=True)[:3]
+    resumo.bancos_dados = sorted(
+        ((banco, qtd, valor) for banco, (qtd, valor) in por_banco.items()),
+        key=lambda b: b[1]
+    )
+    resumo.fontes = {
+        fonte: dict(sorted(status_dados.items()))
+        for fonte, status_dados in resumo.fontes.items()
+    }
+    return resumo
+
+
+def dados_dashboard(periodo, inicio, fim):
     agora = datetime.now()
 
     if inicio and fim:
@@ -691,177 +3034,206 @@ def dashboard():
             inicio = agora.replace(day=1).strftime("%Y-%m-%d")
             fim = agora.strftime("%Y-%m-%d")
     else:
-        if periodo == "hoje":
-            inicio = fim = agora.strftime("%Y-%m-%d")
-        elif periodo == "ultima_semana":
-            inicio = (agora - timedelta(days=7)).strftime("%Y-%m-%d")
-            fim = agora.strftime("%Y-%m-%d")
-        elif periodo == "ultimo_mes":
-            mes_passado = (agora.replace(day=1) - timedelta(days=1))
-            inicio = mes_passado.replace(day=1).strftime("%Y-%m-%d")
-            fim = mes_passado.strftime("%Y-%m-%d")
-        elif periodo == "tudo":
-            inicio, fim = "1900-01-01", "2100-01-01"
-        else:
-            inicio = agora.replace(day=1).strftime("%Y-%m-%d")
-            fim = agora.strftime("%Y-%m-%d")
-
-    conn = get_conn()
-    cur = conn.cursor()
-    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
-
-    if isinstance(conn, sqlite3.Connection):
-        filtro_data = f"date(data) BETWEEN {ph} AND {ph}"
-    else:
-        filtro_data = f"DATE(data AT TIME ZONE 'America/Sao_Paulo') BETWEEN {ph} AND {ph}"
-
-    cur.execute(f"""
-        SELECT 
-            COALESCE(SUM(valor_equivalente),0),
-            COALESCE(SUM(valor_original),0),
-            COUNT(*)
-        FROM propostas
-        WHERE {filtro_data}
-            AND UPPER(observacao) = 'PAGO'
-    """, (inicio, fim))
-    total_eq, total_or, total_propostas = cur.fetchone() or (0, 0, 0)
-    
-    cur.execute(f"""
-        SELECT 
-            COUNT(*),
-            COALESCE(SUM(valor_equivalente), 0)
-        FROM propostas
-        WHERE {filtro_data}
-          AND UPPER(observacao) = 'CANCELADO'
-    """, (inicio, fim))
-
-    canceladas_qtd, canceladas_valor = cur.fetchone() or (0, 0)
-    
-    cur.execute(f"""
-        SELECT 
-            COUNT(*),
-            COALESCE(SUM(valor_equivalente), 0)
-        FROM propostas
-        WHERE {filtro_data}
-          AND UPPER(observacao) = 'AGUARDANDO SALDO'
-    """, (inicio, fim))
-
-    aguardando_qtd, aguardando_valor = cur.fetchone() or (0, 0)
-
-    cur.execute("SELECT valor FROM metas_globais ORDER BY id DESC LIMIT 1;")
-    meta_row = cur.fetchone()
-    meta_global = meta_row[0] if meta_row else 0
-    falta_meta = max(meta_global - (total_eq or 0), 0)
-
-    cur.execute(f"""
-        SELECT consultor, SUM(valor_equivalente) AS total
-        FROM propostas
-        WHERE {filtro_data}
-            AND UPPER(observacao) = 'PAGO'
-        GROUP BY consultor
-        ORDER BY total DESC
-        LIMIT 3;
-    """, (inicio, fim))
-
-    ranking = cur.fetchall()
-
-    cur.execute(f"""
-        SELECT banco, COUNT(*) AS total_propostas, COALESCE(SUM(valor_equivalente), 0) AS total_valor
-        FROM propostas
-        WHERE {filtro_data}
-            AND UPPER(observacao) = 'PAGO'
-        GROUP BY banco
-        HAVING banco IS NOT NULL AND banco <> ''
-        ORDER BY total_propostas ASC;
-    """, (inicio, fim))
-    bancos_dados = cur.fetchall()
-    
-    cur.execute(f"""
-        SELECT 
-            fonte,
-            observacao AS status,
-            COUNT(*) AS qtd,
-            COALESCE(SUM(valor_equivalente), 0) AS total_eq,
-            COALESCE(SUM(valor_original), 0) AS total_or
-        FROM propostas
-        WHERE fonte IN ('URA', 'Disparo/Whatsapp', 'Disparo/SMS', 
-                        'Indicação', 'Discadora', 'Tráfego')
-          AND {filtro_data}
-        GROUP BY fonte, observacao
-        ORDER BY fonte, observacao;
-    """, (inicio, fim))
-
-    dados_fontes = cur.fetchall()
-
-    fontes_lista = [
-        "URA",
-        "Disparo/Whatsapp",
-        "Disparo/SMS",
-        "Indicação",
-        "Discadora",
-        "Tráfego"
-    ]
+        if periodo == "hoje":
+            inicio = fim = agora.strftime("%Y-%m-%d")
+        elif periodo == "ultima_semana":
+            inicio = (agora - timedelta(days=7)).strftime("%Y-%m-%d")
+            fim = agora.strftime("%Y-%m-%d")
+        elif periodo == "ultimo_mes":
+            mes_passado = (agora.replace(day=1) - timedelta(days=1))
+            inicio = mes_passado.replace(day=1).strftime("%Y-%m-%d")
+            fim = mes_passado.strftime("%Y-%m-%d")
+        elif periodo == "tudo":
+            inicio, fim = "1900-01-01", "2100-01-01"
+        else:
+            inicio = agora.replace(day=1).strftime("%Y-%m-%d")
+            fim = agora.strftime("%Y-%m-%d")
 
-    fontes = {fonte: {} for fonte in fontes_lista}
-    for fonte, status, qtd, eq, or_ in dados_fontes:
-        status = (status or "Andamento").strip().title()
-        fontes[fonte][status] = {
-            "qtd": qtd,
-            "valor_eq": float(eq or 0),
-            "valor_or": float(or_ or 0)
-        }
+    # antes de pegar a conexão: ritmo_mes() pega a sua, e duas por requisição
+    # esgotam o pool com DB_POOL_MAX requisições simultâneas
+    ritmo = ritmo_mes()
 
-    import calendar
+    conn = get_conn(leitura=True)
+    cur = conn.cursor()
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
 
     hoje_str = agora.strftime("%Y-%m-%d")
 
-    cur.execute(f"""
-        SELECT COALESCE(SUM(valor_equivalente), 0)
-        FROM propostas
-        WHERE DATE(data) = {ph}
-    """, (hoje_str,))
-    total_hoje = cur.fetchone()[0] or 0
-
-    primeiro_dia = agora.replace(day=1)
-    dias_passados = (agora - primeiro_dia).days + 1
-    dias_mes_real = calendar.monthrange(agora.year, agora.month)[1]
-
-    from datetime import date
-    dias_uteis_restantes = sum(
-        1 for i in range(agora.day + 1, dias_mes_real + 1)
-        if date(agora.year, agora.month, i).weekday() < 5
-    )
+    resumo = agregar_dashboard(cur, ph, inicio, fim, hoje_str)
+    total_eq, total_or, total_propostas = resumo.total_eq, resumo.total_or, resumo.total_propostas
+
+    meta_global = meta_global_atual(cur)
+    falta_meta = max(float(meta_global or 0) - (total_eq or 0), 0)
+    conn.close()
 
     media_diaria_contratos = (total_or / total_propostas) if total_propostas > 0 else 0
 
     ticket_meta_diaria = 0
     if meta_global and total_eq is not None:
-        falta_dias = max(dias_uteis_restantes, 1)
+        falta_dias = max(ritmo.restantes, 1)
         ticket_meta_diaria = (falta_meta / falta_dias) if falta_dias > 0 else 0
 
-    conn.close()
-
-    return render_template(
-        "dashboard.html",
+    return dict(
         total_eq=float(total_eq or 0),
         total_or=float(total_or or 0),
         total_propostas=int(total_propostas or 0),
         falta_meta=float(falta_meta or 0),
         meta_global=float(meta_global or 0),
-        ranking=ranking or [],
+        ranking=resumo.ranking,
         inicio=inicio,
         fim=fim,
         periodo=periodo,
-        bancos_dados=bancos_dados,
-        fontes=fontes,
+        bancos_dados=resumo.bancos_dados,
+        fontes=resumo.fontes,
         ticket_meta_diaria=float(ticket_meta_diaria or 0),
         media_diaria_contratos=float(media_diaria_contratos or 0),
-        canceladas_qtd=int(canceladas_qtd or 0),
-        canceladas_valor=float(canceladas_valor or 0),
-        aguardando_qtd=int(aguardando_qtd or 0),
-        aguardando_valor=float(aguardando_valor or 0),
+        canceladas_qtd=resumo.canceladas_qtd,
+        canceladas_valor=resumo.canceladas_valor,
+        aguardando_qtd=resumo.aguardando_qtd,
+        aguardando_valor=resumo.aguardando_valor,
+        ritmo=ritmo.geral._asdict(),
+        dias_uteis_restantes=ritmo.restantes,
     )
 
+@app.route("/dashboard")
+def dashboard():
+    if "user" not in session:
+        return redirect(url_for("login"))
+
+    dados = dados_dashboard(request.args.get("periodo"), request.args.get("inicio"), request.args.get("fim"))
+    return render_template("dashboard.html", **dados)
+
+@app.route("/api/dashboard")
+def api_dashboard():
+    if "user" not in session:
+        return jsonify({"erro": "não autenticado"}), 401
+
+    return resposta_json_condicional(lambda: dados_dashboard(
+        request.args.get("periodo"), request.args.get("inicio"), request.args.get("fim")))
+
+
+SERIES_CACHE_TTL = float(os.environ.get("SERIES_CACHE_TTL", 30))
+# agrupamento -> (início do bucket de um dia, passo até o próximo bucket)
+SERIES_AGRUPAMENTOS = {
+    "dia": (lambda d: d, timedelta(days=1)),
+    "semana": (lambda d: d - timedelta(days=d.weekday()), timedelta(days=7)),
+    "mes": (lambda d: d.replace(day=1), relativedelta(months=1)),
+}
+_cache_series = CacheTTL(SERIES_CACHE_TTL, max_itens=128)
+
+
+def _linhas_series(cur, ph, inicio, fim, consultor, fonte, banco):
+    filtros = [(d, v) for d, v in (("consultor", consultor), ("fonte", fonte), ("banco", banco)) if v]
+    if len(filtros) <= 1:
+        dimensao, valor = filtros[0] if filtros else ("", "")
+        if dimensao in ("fonte", "banco"):
+            codigo = codigo_dimensao(cur, dimensao, valor)
+            if codigo is None:
+                return []
+            valor = str(codigo)
+        cur.execute(f"""
+            SELECT dia, {', '.join(SERIES_METRICAS)}
+            FROM propostas_series
+            WHERE dimensao = {ph} AND valor = {ph} AND dia >= {ph} AND dia <= {ph}
+            ORDER BY dia
+        """, (dimensao, valor, inicio, fim))
+        return cur.fetchall()
+
+    # filtros combinados: direto do agregado diário, que também já vem por dia
+    condicoes, params = ["dia >= " + ph, "dia <= " + ph], [inicio, fim]
+    if consultor:
+        condicoes.append(f"consultor = {ph}")
+        params.append(consultor)
+    for dimensao, texto in (("fonte", fonte), ("banco", banco)):
+        if texto:
+            condicao, codigos = filtro_dimensao(cur, ph, dimensao, texto)
+            condicoes.append(condicao)
+            params += codigos
+    pago = codigo_dimensao(cur, "status", "PAGO") or 0
+    cancelado = codigo_dimensao(cur, "status", "CANCELADO") or 0
+    cur.execute(f"""
+        SELECT dia, SUM(qtd),
+               SUM(CASE WHEN status_id = {ph} THEN qtd ELSE 0 END),
+               SUM(CASE WHEN status_id = {ph} THEN total_eq ELSE 0 END),
+               SUM(CASE WHEN status_id = {ph} THEN qtd ELSE 0 END),
+               SUM(CASE WHEN status_id = {ph} THEN total_eq ELSE 0 END)
+        FROM propostas_diarias
+        WHERE {" AND ".join(condicoes)}
+        GROUP BY dia
+        ORDER BY dia
+    """, (pago, pago, cancelado, cancelado, *params))
+    return cur.fetchall()
+
+
+def dados_series(agrupamento, inicio, fim, consultor=None, fonte=None, banco=None):
+    chave = (agrupamento, inicio, fim, consultor, fonte, banco)
+    dados = _cache_series.obter(chave)
+    if dados is not None:
+        return dados
+
+    # recalcula os dias pendentes pelo escritor e lê do primário, já com o commit feito
+    with conexao() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM series_pendentes LIMIT 1;")
+        pendente = cur.fetchone()
+    if pendente:
+        executar_escrita(atualizar_series, publicar=False)
+    with conexao() as conn:
+        cur = conn.cursor()
+        ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+        linhas = _linhas_series(cur, ph, inicio, fim, consultor, fonte, banco)
+
+    # buckets contínuos (zerados onde não houve produção), do primeiro dia com dados até o fim
+    bucket, passo = SERIES_AGRUPAMENTOS[agrupamento]
+    somas = {}
+    for linha in linhas:
+        soma = somas.setdefault(bucket(date.fromisoformat(str(linha[0])[:10])), [0] * len(SERIES_METRICAS))
+        for i, valor in enumerate(linha[1:]):
+            soma[i] += float(valor or 0)
+    rotulos = []
+    if somas:
+        atual, ultimo = min(somas), bucket(date.fromisoformat(fim))
+        while atual <= ultimo:
+            rotulos.append(atual)
+            atual += passo
+    # colunas no formato dos datasets do Chart.js
+    vazio = [0] * len(SERIES_METRICAS)
+    colunas = list(zip(*(somas.get(r, vazio) for r in rotulos))) or [()] * len(SERIES_METRICAS)
+    dados = {
+        "agrupamento": agrupamento,
+        "inicio": inicio,
+        "fim": fim,
+        "filtros": {"consultor": consultor, "fonte": fonte, "banco": banco},
+        "rotulos": [r.isoformat() for r in rotulos],
+    }
+    for metrica, valores in zip(SERIES_METRICAS, colunas):
+        dados[metrica] = [int(v) for v in valores] if metrica.endswith("qtd") else [round(v, 2) for v in valores]
+    _cache_series.guardar(chave, dados)
+    return dados
+
+
+@app.route("/api/series")
+def api_series():
+    if "user" not in session:
+        return jsonify({"erro": "não autenticado"}), 401
+
+    agrupamento = request.args.get("agrupamento", "dia")
+    if agrupamento not in SERIES_AGRUPAMENTOS:
+        return jsonify({"erro": "agrupamento deve ser dia, semana ou mes"}), 400
+    hoje = datetime.now(pytz.timezone("America/Sao_Paulo")).date()
+    try:
+        fim = date.fromisoformat(request.args.get("fim") or hoje.isoformat())
+        inicio = date.fromisoformat(request.args.get("inicio") or (fim - relativedelta(years=1)).isoformat())
+    except ValueError:
+        return jsonify({"erro": "datas no formato AAAA-MM-DD"}), 400
+    if inicio > fim:
+        return jsonify({"erro": "inicio depois do fim"}), 400
+
+    return resposta_json_condicional(lambda: dados_series(
+        agrupamento, inicio.isoformat(), fim.isoformat(),
+        request.args.get("consultor") or None, request.args.get("fonte") or None, request.args.get("banco") or None,
+    ))
+
 from datetime import timedelta
 
 @app.route("/painel_admin", methods=["GET", "POST"])
@@ -878,98 +3250,17 @@ def painel_admin():
         ultimo_dia = (agora.replace(day=1) + relativedelta(months=1) - timedelta(days=1)).strftime("%Y-%m-%d")
         data_fim = ultimo_dia
 
-    conn = get_conn()
+    conn = get_conn(leitura=True)
     cur = conn.cursor()
-    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS metas_globais (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            valor REAL
-        )
-    """ if isinstance(conn, sqlite3.Connection) else """
-        CREATE TABLE IF NOT EXISTS metas_globais (
-            id SERIAL PRIMARY KEY,
-            valor NUMERIC(12,2)
-        )
-    """)
 
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS metas_individuais (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            consultor TEXT UNIQUE,
-            meta REAL
-        )
-    """ if isinstance(conn, sqlite3.Connection) else """
-        CREATE TABLE IF NOT EXISTS metas_individuais (
-            id SERIAL PRIMARY KEY,
-            consultor TEXT UNIQUE,
-            meta NUMERIC(12,2)
-        )
-    """)
+    meta_global = meta_global_atual(cur)
+    meta_dia = meta_dia_atual(cur)
 
-    if isinstance(conn, sqlite3.Connection):
-        query = f"""
-            SELECT u.nome AS consultor,
-                   COALESCE(SUM(p.valor_equivalente), 0) AS total_eq,
-                   COALESCE(SUM(p.valor_original), 0) AS total_or,
-                   COALESCE(m.meta, 0) AS meta,
-                   (COALESCE(m.meta, 0) - COALESCE(SUM(p.valor_equivalente), 0)) AS falta
-            FROM users u
-            LEFT JOIN propostas p
-                ON u.nome = p.consultor
-               AND DATE(p.data) BETWEEN {ph} AND {ph}
-               AND UPPER(p.observacao) = 'PAGO'
-            LEFT JOIN metas_individuais m
-                ON u.nome = m.consultor
-            WHERE u.role != 'admin'
-            GROUP BY u.nome, m.meta
-            ORDER BY total_eq DESC;
-        """
-    else:
-        query = f"""
-            SELECT u.nome AS consultor,
-                   COALESCE(SUM(p.valor_equivalente), 0) AS total_eq,
-                   COALESCE(SUM(p.valor_original), 0) AS total_or,
-                   COALESCE(m.meta, 0) AS meta,
-                   (COALESCE(m.meta, 0) - COALESCE(SUM(p.valor_equivalente), 0)) AS falta
-            FROM users u
-            LEFT JOIN propostas p
-                ON u.nome = p.consultor
-               AND DATE(p.data AT TIME ZONE 'America/Sao_Paulo') BETWEEN {ph} AND {ph}
-               AND UPPER(p.observacao) = 'PAGO'
-            LEFT JOIN metas_individuais m
-                ON u.nome = m.consultor
-            WHERE u.role != 'admin'
-            GROUP BY u.nome, m.meta
-            ORDER BY total_eq DESC;
-        """
-
-    cur.execute(query, (data_ini, data_fim))
-    ranking = cur.fetchall()
-
-    cur.execute("SELECT valor FROM metas_globais ORDER BY id DESC LIMIT 1;")
-    meta_global_row = cur.fetchone()
-    meta_global = meta_global_row[0] if meta_global_row else 0
+    conn.close()
 
+    ranking = dados_ranking(data_ini, data_fim)
     media_usuarios = (sum([r[3] or 0 for r in ranking]) / len(ranking)) if ranking else 0
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS meta_dia (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            valor REAL
-        )
-    """ if isinstance(conn, sqlite3.Connection) else """
-        CREATE TABLE IF NOT EXISTS meta_dia (
-            id SERIAL PRIMARY KEY,
-            valor NUMERIC(12,2)
-        )
-    """)
-    cur.execute("SELECT valor FROM meta_dia ORDER BY id DESC LIMIT 1;")
-    meta_dia_row = cur.fetchone()
-    meta_dia = meta_dia_row[0] if meta_dia_row else 0
-
-    conn.close()
+    ritmo = ritmo_mes()
 
     return render_template(
         "painel_admin.html",
@@ -978,7 +3269,8 @@ def painel_admin():
         media_usuarios=media_usuarios,
         data_ini=data_ini,
         data_fim=data_fim,
-        meta_dia=meta_dia
+        meta_dia=meta_dia,
+        ritmo=ritmo
     )
 
 @app.route("/editar_meta", methods=["POST"])
@@ -991,31 +3283,15 @@ def editar_meta():
     except:
         nova_meta = 0
 
-    conn = get_conn()
-    cur = conn.cursor()
-    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS metas_globais (
-            id SERIAL PRIMARY KEY,
-            valor NUMERIC(12,2)
-        )
-    """ if not isinstance(conn, sqlite3.Connection) else """
-        CREATE TABLE IF NOT EXISTS metas_globais (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            valor REAL
-        )
-    """)
-
-    cur.execute("TRUNCATE metas_globais RESTART IDENTITY" if not isinstance(conn, sqlite3.Connection) else "DELETE FROM metas_globais;")
-    cur.execute(f"INSERT INTO metas_globais (valor) VALUES ({ph})", (nova_meta,))
-    conn.commit()
+    def gravar(cur, conn):
+        ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+        cur.execute("TRUNCATE metas_globais RESTART IDENTITY" if not isinstance(conn, sqlite3.Connection) else "DELETE FROM metas_globais;")
+        cur.execute(f"INSERT INTO metas_globais (valor) VALUES ({ph})", (nova_meta,))
+        invalidar_cadastros(cur)
 
-    cur.execute("SELECT valor FROM metas_globais ORDER BY id DESC LIMIT 1;")
-    ultimo = cur.fetchone()
-    print("Meta salva com sucesso:", ultimo[0] if ultimo else "(nenhuma)")
+    executar_escrita(gravar)
+    print("Meta salva com sucesso:", nova_meta)
 
-    conn.close()
     flash("Meta global atualizada com sucesso!", "success")
     return redirect(url_for("painel_admin"))
 
@@ -1029,12 +3305,12 @@ def painel_usuario():
     usuario_logado = session["user"]
     role = session["role"]
 
-    conn = get_conn()
+    conn = get_conn(leitura=True)
     cur = conn.cursor()
 
     if role == "admin":
         cur.execute(
-            "SELECT DISTINCT consultor FROM propostas WHERE consultor IS NOT NULL ORDER BY consultor;"
+            "SELECT DISTINCT consultor FROM propostas_diarias WHERE consultor <> '' ORDER BY consultor;"
         )
         consultores = [r[0] for r in cur.fetchall()]
     else:
@@ -1080,65 +3356,50 @@ def painel_usuario():
 
     ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
 
-    if isinstance(conn, sqlite3.Connection):
-        query = f"""
-            SELECT
-                id, data, fonte, banco, senha_digitada, tabela, nome_cliente, cpf,
-                valor_equivalente, valor_original, observacao, telefone,
-                valor_parcela, quantidade_parcelas, data_pagamento_prevista, motivo_cancelamento
-            FROM propostas
-            WHERE consultor = {ph}
-              AND date(data) BETWEEN {ph} AND {ph}
-        """
-    else:
-        query = f"""
-            SELECT
-                id, data, fonte, banco, senha_digitada, tabela, nome_cliente, cpf,
-                valor_equivalente, valor_original, observacao, telefone,
-                valor_parcela, quantidade_parcelas, data_pagamento_prevista, motivo_cancelamento
-            FROM propostas
-            WHERE consultor = {ph}
-              AND DATE(data AT TIME ZONE 'America/Sao_Paulo') BETWEEN {ph} AND {ph}
-        """
-
-    params = [consultor_filtro, inicio, fim]
+    select_base = """
+        SELECT
+            id, data, fonte, banco, senha_digitada, tabela, nome_cliente, cpf,
+            valor_equivalente, valor_original, observacao, telefone,
+            valor_parcela, quantidade_parcelas, data_pagamento_prevista, motivo_cancelamento
+        FROM propostas
+    """
 
-    params = [consultor_filtro, inicio, fim]
+    condicoes = [f"consultor = {ph}", filtro_periodo(ph)]
+    params = [consultor_filtro, *intervalo_datas(inicio, fim)]
 
     if busca:
-        query += f"""
-            AND (
-                LOWER(nome_cliente) LIKE LOWER({ph})
-                OR REPLACE(REPLACE(cpf, '.', ''), '-', '') LIKE {ph}
-            )
-        """
-        params.append(f"%{busca}%")
-        params.append(busca.replace(".", "").replace("-", ""))
-
-    if fonte_filtro:
-        query += f" AND LOWER(fonte) = LOWER({ph})"
-        params.append(fonte_filtro)
-
-    if banco_filtro:
-        query += f" AND LOWER(banco) = LOWER({ph})"
-        params.append(banco_filtro)
-
-    if observacao_filtro:
-        query += f" AND LOWER(observacao) = LOWER({ph})"
-        params.append(observacao_filtro)
-
-    query += " ORDER BY datetime(data) DESC;" if isinstance(conn, sqlite3.Connection) else " ORDER BY data DESC;"
-
-    cur.execute(query, tuple(params))
+        filtro, valores = filtro_busca_cliente(cur, conn, ph, busca)
+        condicoes.append(filtro)
+        params += valores
+
+    filtros_dimensao, params_dimensao = [], []
+    for dimensao, valor in (("fonte", fonte_filtro), ("banco", banco_filtro), ("status", observacao_filtro)):
+        if valor:
+            filtro, valores = filtro_dimensao(cur, ph, dimensao, valor)
+            filtros_dimensao.append(filtro)
+            params_dimensao += valores
+    condicoes += filtros_dimensao
+    params += params_dimensao
+
+    # Totais do período inteiro calculados no banco; só a página exibida vira objetos Python.
+    # Sem busca por cliente, o agregado diário tem todas as colunas do filtro.
+    if not busca and dias_validos(inicio, fim):
+        resumo = resumo_painel(
+            cur, ph, "propostas_diarias",
+            [f"consultor = {ph}", f"dia >= {ph} AND dia <= {ph}", *filtros_dimensao],
+            [consultor_filtro, inicio, fim, *params_dimensao]
+        )
+    else:
+        resumo = resumo_painel(cur, ph, "propostas", condicoes, params)
+    (total_propostas, total_eq, total_or, canceladas_qtd, canceladas_valor,
+     aguardando_qtd, aguardando_valor) = resumo
 
-    propostas_raw = cur.fetchall()
+    propostas_raw, cursor_anterior, cursor_proxima, pagina = paginar_keyset(
+        cur, ph, select_base, condicoes, params,
+        request.args.get("cursor"), tamanho_pagina(request.args.get("por_pagina"))
+    )
 
     propostas = []
-    canceladas_qtd = 0
-    canceladas_valor = 0
-    aguardando_qtd = 0
-    aguardando_valor = 0
-
     for p in propostas_raw:
         try:
             data_val = p[1]
@@ -1148,39 +3409,15 @@ def painel_usuario():
                 except Exception:
                     data_val = datetime.strptime(data_val, "%Y-%m-%d")
             propostas.append((p[0], data_val, *p[2:]))
-
-            if (p[10] or "").upper() == "CANCELADO":
-                canceladas_qtd += 1
-                canceladas_valor += float(p[9] or 0)
-
-            elif 'AGUARD' in (p[10] or "").upper():
-                aguardando_qtd += 1
-                aguardando_valor += float(p[9] or 0)
-
         except Exception:
             propostas.append(p)
 
-    total_eq = sum(
-        float(p[8] or 0)
-        for p in propostas
-        if str(p[10] or "").upper() == "PAGO"
-    )
-    
-    total_or = sum(
-        float(p[9] or 0)
-        for p in propostas
-        if str(p[10] or "").upper() == "PAGO"
-    )
-    
+    args_links = {k: v for k, v in request.args.items() if k != "cursor" and v}
+    link_anterior = url_for("painel_usuario", **args_links, cursor=cursor_anterior) if cursor_anterior else None
+    link_proxima = url_for("painel_usuario", **args_links, cursor=cursor_proxima) if cursor_proxima else None
+
     try:
-        cur.execute(
-            "SELECT meta FROM metas_individuais WHERE consultor = ?"
-            if isinstance(conn, sqlite3.Connection)
-            else "SELECT meta FROM metas_individuais WHERE consultor = %s",
-            (consultor_filtro,),
-        )
-        meta_row = cur.fetchone()
-        meta_individual = float(meta_row[0]) if meta_row else 0
+        meta_individual = metas_individuais(cur).get(consultor_filtro, 0.0)
     except Exception as e:
         print("⚠️ Erro ao buscar meta individual:", e)
         meta_individual = 0
@@ -1198,6 +3435,10 @@ def painel_usuario():
         "painel_usuario.html",
         usuario_logado=usuario_logado,
         propostas=propostas,
+        total_propostas=total_propostas,
+        pagina=pagina,
+        link_anterior=link_anterior,
+        link_proxima=link_proxima,
         total_eq=total_eq,
         total_or=total_or,
         consultores=consultores,
@@ -1218,9 +3459,9 @@ def painel_usuario():
         fonte_filtro=fonte_filtro,
         banco_filtro=banco_filtro,
         observacao_filtro=observacao_filtro,
-        fontes_lista=["URA","Disparo/Whatsapp","Disparo/SMS","Indicação","Discadora","Tráfego"],
-        bancos_lista=["C6","Qualibank", "PAN", "V8", "Amigoz", "Facta-CLT", "Facta-FGTS", "Tá Quitado", "C6 INSS", "C6 CLT", "BMG"],
-        observacoes_lista=["PAGO","AGUARDANDO SALDO","EM ANÁLISE","REPRESENTAÇÃO","CANCELADO","AGUARDANDO AVERBAÇÃO"],
+        fontes_lista=FONTES_LISTA,
+        bancos_lista=BANCOS_LISTA,
+        observacoes_lista=OBSERVACOES_LISTA,
     )
 
 @app.route("/editar_meta_individual", methods=["POST"])
@@ -1229,21 +3470,15 @@ def editar_meta_individual():
         return redirect(url_for("login"))
     consultor = request.form["consultor"]
     nova_meta = float(request.form["nova_meta"])
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS metas_individuais (
-            id SERIAL PRIMARY KEY,
-            consultor TEXT UNIQUE,
-            meta NUMERIC(12,2)
-        );
-    """)
-    cur.execute("INSERT INTO metas_individuais (consultor, meta) VALUES (%s, %s) "
-                "ON CONFLICT (consultor) DO UPDATE SET meta = EXCLUDED.meta;" if not isinstance(conn, sqlite3.Connection)
-                else "INSERT OR REPLACE INTO metas_individuais (consultor, meta) VALUES (?, ?);",
-                (consultor, nova_meta))
-    conn.commit()
-    conn.close()
+
+    def gravar(cur, conn):
+        cur.execute("INSERT INTO metas_individuais (consultor, meta) VALUES (%s, %s) "
+                    "ON CONFLICT (consultor) DO UPDATE SET meta = EXCLUDED.meta;" if not isinstance(conn, sqlite3.Connection)
+                    else "INSERT OR REPLACE INTO metas_individuais (consultor, meta) VALUES (?, ?);",
+                    (consultor, nova_meta))
+        invalidar_cadastros(cur)
+
+    executar_escrita(gravar)
     return redirect(url_for("painel_admin"))
 
 
@@ -1257,20 +3492,21 @@ def register():
         senha = request.form["senha"]
         role = request.form["role"]
 
-        conn = get_conn()
-        cur = conn.cursor()
-
-        ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+        senha_hash = gerar_hash_senha(senha)
 
-        cur.execute(f"SELECT * FROM users WHERE nome = {ph}", (nome,))
-        if cur.fetchone():
-            conn.close()
+        def gravar(cur, conn):
+            ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+            # a conferência vai na mesma escrita, para dois cadastros iguais não passarem
+            cur.execute(f"SELECT 1 FROM users WHERE nome = {ph}", (nome,))
+            if cur.fetchone():
+                return False
+            cur.execute(f"INSERT INTO users (nome, senha, role) VALUES ({ph}, {ph}, {ph})", (nome, senha_hash, role))
+            invalidar_cadastros(cur)
+            return True
+
+        if not executar_escrita(gravar, publicar=False):
             return render_template("register.html", erro="Usuário já existe!")
-
-        senha_hash = generate_password_hash(senha)
-        cur.execute(f"INSERT INTO users (nome, senha, role) VALUES ({ph}, {ph}, {ph})", (nome, senha_hash, role))
-        conn.commit()
-        conn.close()
+        limpar_cache_cadastros()
         return render_template("register.html", sucesso="Usuário criado com sucesso!")
 
     return render_template("register.html")
@@ -1287,9 +3523,10 @@ def editar_usuario(id):
     cur.execute("SELECT id, nome, role FROM users WHERE id = ?" if isinstance(conn, sqlite3.Connection)
                 else "SELECT id, nome, role FROM users WHERE id = %s", (id,))
     user = cur.fetchone()
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+    conn.close()
 
     if not user:
-        conn.close()
         return redirect(url_for("usuarios"))
 
     if request.method == "POST":
@@ -1297,22 +3534,22 @@ def editar_usuario(id):
         senha = request.form["senha"]
         role = request.form.get("role")
 
-        ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
-
         if senha.strip():
-            senha_hash = generate_password_hash(senha)
+            senha_hash = gerar_hash_senha(senha)
             query = f"UPDATE users SET nome = {ph}, senha = {ph}, role = {ph} WHERE id = {ph}"
             params = (nome, senha_hash, role, id)
         else:
             query = f"UPDATE users SET nome = {ph}, role = {ph} WHERE id = {ph}"
             params = (nome, role, id)
 
-        cur.execute(query, params)
-        conn.commit()
-        conn.close()
+        def gravar(cur, conn):
+            cur.execute(query, params)
+            invalidar_cadastros(cur)
+
+        executar_escrita(gravar, publicar=False)
+        limpar_cache_cadastros()
         return redirect(url_for("usuarios"))
 
-    conn.close()
     return render_template("editar.html", user=user)
 
 @app.route("/usuarios", endpoint="usuarios")
@@ -1328,17 +3565,43 @@ def usuarios():
     return render_template("usuarios.html", usuarios=usuarios)
 
 
+@app.route("/api/pool")
+def api_pool():
+    if "user" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify(estatisticas_pool())
+
+
+@app.route("/api/cache")
+def api_cache():
+    if "user" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    return jsonify({
+        "cadastros": {**_cache_cadastros.estatisticas(), "versao": _versao_cadastros["versao"]},
+        "resumos": _cache_resumos.estatisticas(),
+    })
+
+
+@app.route("/api/consultas_lentas")
+def api_consultas_lentas():
+    if "user" not in session or session["role"] != "admin":
+        return redirect(url_for("login"))
+    n = request.args.get("n", 20, type=int)
+    return jsonify(consultas_mais_lentas(max(n, 1), request.args.get("ordem", "tempo_max")))
+
+
 @app.route("/excluir/<int:id>", methods=["POST"])
 def excluir_usuario(id):
     if "user" not in session or session["role"] != "admin":
         return redirect(url_for("login"))
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM users WHERE id = ?" if isinstance(conn, sqlite3.Connection)
-                else "DELETE FROM users WHERE id = %s", (id,))
-    conn.commit()
-    conn.close()
+    def excluir(cur, conn):
+        cur.execute("DELETE FROM users WHERE id = ?" if isinstance(conn, sqlite3.Connection)
+                    else "DELETE FROM users WHERE id = %s", (id,))
+        invalidar_cadastros(cur)
+
+    executar_escrita(excluir, publicar=False)
+    limpar_cache_cadastros()
     flash("Usuário excluído com sucesso!")
     return redirect(url_for("usuarios"))
 
@@ -1362,12 +3625,17 @@ def excluir_proposta(id):
     if "user" not in session:
         return redirect(url_for("login"))
 
-    conn = get_conn()
-    cur = conn.cursor()
-    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
-    cur.execute(f"DELETE FROM propostas WHERE id = {ph}", (id,))
-    conn.commit()
-    conn.close()
+    def excluir(cur, conn):
+        sqlite = isinstance(conn, sqlite3.Connection)
+        ph = "?" if sqlite else "%s"
+        # trava a linha antes de descontar do agregado: no duplo clique a segunda exclusão
+        # espera a primeira e, sem linha, não desconta de novo
+        cur.execute(f"SELECT id FROM propostas WHERE id = {ph} {'' if sqlite else 'FOR UPDATE'}", (id,))
+        if cur.fetchone():
+            ajustar_agregados(cur, conn, [id], -1)
+            cur.execute(f"DELETE FROM propostas WHERE id = {ph}", (id,))
+
+    executar_escrita(excluir)
 
     origem = request.args.get("origem")
 
@@ -1383,24 +3651,22 @@ def editar_proposta(id):
     if "user" not in session:
         return redirect(url_for("login"))
 
-    conn = None
     try:
-        conn = get_conn()
-        cur = conn.cursor()
-
         # Consultar a proposta existente
-        cur.execute(f"""
-            SELECT 
-                id, data, fonte, banco, senha_digitada, tabela, nome_cliente, cpf,
-                valor_equivalente, valor_original, observacao, telefone,
-                valor_parcela, quantidade_parcelas, produto, data_pagamento_prevista
-            FROM propostas
-            WHERE id = %s
-        """, (id,))
-        proposta = cur.fetchone()
+        with conexao() as conn:
+            cur = conn.cursor()
+            ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+            cur.execute(f"""
+                SELECT 
+                    id, data, fonte, banco, senha_digitada, tabela, nome_cliente, cpf,
+                    valor_equivalente, valor_original, observacao, telefone,
+                    valor_parcela, quantidade_parcelas, produto, data_pagamento_prevista
+                FROM propostas
+                WHERE id = {ph}
+            """, (id,))
+            proposta = cur.fetchone()
 
         if not proposta:
-            conn.close()
             return "Proposta não encontrada", 404
 
         if request.method == "POST":
@@ -1431,38 +3697,55 @@ def editar_proposta(id):
                     nova_data = data_obj.strftime("%Y-%m-%d %H:%M:%S")
                 except Exception as e:
                     print("Erro ao converter data_manual:", e)
-                    nova_data = proposta[1]
+                    nova_data = None
             else:
-                nova_data = proposta[1]
-
-            ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
-            
-            cur.execute(f"""
-                UPDATE propostas SET
-                    data = {ph},
-                    fonte = {ph},
-                    banco = {ph},
-                    senha_digitada = {ph},
-                    produto = {ph},
-                    tabela = {ph},
-                    nome_cliente = {ph},
-                    cpf = {ph},
-                    valor_equivalente = {ph},
-                    valor_original = {ph},
-                    valor_parcela = {ph},
-                    quantidade_parcelas = {ph},
-                    observacao = {ph},
-                    telefone = {ph},
-                    data_pagamento_prevista = {ph},
-                    motivo_cancelamento = {ph}
-                WHERE id = {ph}
-            """, (
-                nova_data, fonte, banco, senha_digitada, produto, tabela, nome_cliente, cpf,
-                valor_equivalente, valor_original, valor_parcela, quantidade_parcelas,
-                observacao, telefone, data_pagamento_prevista, motivo_cancelamento, id
-            ))
-
-            conn.commit()
+                nova_data = None
+
+            def gravar(cur, conn):
+                sqlite = isinstance(conn, sqlite3.Connection)
+                ph = "?" if sqlite else "%s"
+                # a linha fica travada até o commit, para duas edições simultâneas não
+                # descontarem o mesmo valor antigo do agregado
+                cur.execute(f"SELECT data FROM propostas WHERE id = {ph} {'' if sqlite else 'FOR UPDATE'}", (id,))
+                atual = cur.fetchone()
+                if not atual:
+                    return False
+                ajustar_agregados(cur, conn, [id], -1)
+                cur.execute(f"""
+                    UPDATE propostas SET
+                        data = {ph},
+                        fonte = {ph},
+                        banco = {ph},
+                        senha_digitada = {ph},
+                        produto = {ph},
+                        tabela = {ph},
+                        nome_cliente = {ph},
+                        cpf = {ph},
+                        valor_equivalente = {ph},
+                        valor_original = {ph},
+                        valor_parcela = {ph},
+                        quantidade_parcelas = {ph},
+                        observacao = {ph},
+                        telefone = {ph},
+                        data_pagamento_prevista = {ph},
+                        motivo_cancelamento = {ph},
+                        nome_busca = {ph},
+                        cpf_digitos = {ph},
+                        fonte_id = {ph},
+                        banco_id = {ph},
+                        status_id = {ph}
+                    WHERE id = {ph}
+                """, (
+                    nova_data or atual[0], fonte, banco, senha_digitada, produto, tabela, nome_cliente, cpf,
+                    valor_equivalente, valor_original, valor_parcela, quantidade_parcelas,
+                    observacao, telefone, data_pagamento_prevista, motivo_cancelamento,
+                    *colunas_busca(nome_cliente, cpf), *codigos_proposta(cur, conn, fonte, banco, observacao), id
+                ))
+                ajustar_agregados(cur, conn, [id], 1)
+                return True
+
+            if not executar_escrita(gravar):
+                return "Proposta não encontrada", 404
 
             flash("Proposta atualizada com sucesso!", "success")
 
@@ -1471,13 +3754,10 @@ def editar_proposta(id):
                 return redirect(url_for("relatorios"))
             return redirect(url_for("painel_usuario"))
 
-        conn.close()
         return render_template("editar_proposta.html", proposta=proposta)
 
     except Exception as e:
         print("Erro ao editar proposta:", e)
-        if conn:
-            conn.close()
         return f"Ocorreu um erro ao editar a proposta: {e}", 500
 
 @app.route("/visao_fontes")
@@ -1491,33 +3771,36 @@ def visao_fontes():
         "Tráfego"
     ]
 
-    conn = get_conn()
+    conn = get_conn(leitura=True)
     cur = conn.cursor()
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
 
-    cur.execute("""
+    codigos = [codigo_dimensao(cur, "fonte", fonte) for fonte in fontes_lista]
+    cur.execute(f"""
         SELECT 
-            fonte,
-            observacao,  -- usamos observacao como status (Pagas, Andamento, etc)
-            COUNT(*) AS qtd,
-            COALESCE(SUM(valor_equivalente), 0) AS total_eq,
-            COALESCE(SUM(valor_original), 0) AS total_or
-        FROM propostas
-        WHERE fonte IN ('URA', 'Disparo/Whatsapp', 'Disparo/SMS', 
-                        'Indicação', 'Discadora', 'Tráfego')
-        GROUP BY fonte, observacao
-        ORDER BY fonte;
-    """)
+            fonte_id,
+            status_id,  -- usamos observacao como status (Pagas, Andamento, etc)
+            SUM(qtd) AS qtd,
+            COALESCE(SUM(total_eq), 0) AS total_eq,
+            COALESCE(SUM(total_or), 0) AS total_or
+        FROM propostas_diarias
+        WHERE fonte_id IN ({','.join([ph] * len(codigos))})
+        GROUP BY fonte_id, status_id
+        ORDER BY fonte_id;
+    """, codigos)
 
     dados = cur.fetchall()
+    nomes_fonte, nomes_status = nomes_dimensao(cur, "fonte"), nomes_dimensao(cur, "status")
     conn.close()
 
     fontes = {fonte: {} for fonte in fontes_lista}
 
-    for fonte, status, qtd, eq, or_ in dados:
+    for fonte_id, status_id, qtd, eq, or_ in dados:
+        fonte = nomes_fonte.get(fonte_id)
         if fonte not in fontes:
             continue
 
-        status = (status or "Andamento").strip().title()
+        status = (nomes_status.get(status_id) or "Andamento").title()
         fontes[fonte][status] = {
             "qtd": qtd,
             "valor_eq": float(eq or 0),
@@ -1536,32 +3819,208 @@ def editar_meta_dia():
     except:
         nova_meta_dia = 0
 
-    conn = get_conn()
-    cur = conn.cursor()
-
-    if isinstance(conn, sqlite3.Connection):
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS meta_dia (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                valor REAL
-            )
-        """)
-        cur.execute("DELETE FROM meta_dia;")
-        cur.execute("INSERT INTO meta_dia (valor) VALUES (?)", (nova_meta_dia,))
-    else:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS meta_dia (
-                id SERIAL PRIMARY KEY,
-                valor NUMERIC(12,2)
-            )
-        """)
-        cur.execute("TRUNCATE meta_dia RESTART IDENTITY;")
-        cur.execute("INSERT INTO meta_dia (valor) VALUES (%s);", (nova_meta_dia,))
+    def gravar(cur, conn):
+        if isinstance(conn, sqlite3.Connection):
+            cur.execute("DELETE FROM meta_dia;")
+            cur.execute("INSERT INTO meta_dia (valor) VALUES (?)", (nova_meta_dia,))
+        else:
+            cur.execute("TRUNCATE meta_dia RESTART IDENTITY;")
+            cur.execute("INSERT INTO meta_dia (valor) VALUES (%s);", (nova_meta_dia,))
+        invalidar_cadastros(cur)
 
-    conn.commit()
-    conn.close()
+    executar_escrita(gravar)
     return redirect(url_for("painel_admin"))
 
+def periodo_mes_atual():
+    agora = datetime.now()
+    data_ini = agora.replace(day=1).strftime("%Y-%m-%d")
+    data_fim = (agora.replace(day=1) + relativedelta(months=1) - timedelta(days=1)).strftime("%Y-%m-%d")
+    return data_ini, data_fim
+
+# Ranking de consultores compartilhado por /ranking, /painel_admin, /indice_dia e o
+# canal ao vivo: uma consulta ao agregado diário por (período, dia, backend), guardada
+# por RANKING_CACHE_TTL segundos para que as telas abertas ao mesmo tempo dividam o
+# cálculo. Escritas limpam o cache do worker; o canal ao vivo limpa ao receber o aviso.
+RANKING_CACHE_TTL = float(os.environ.get("RANKING_CACHE_TTL", 5))
+_cache_ranking = CacheTTL(RANKING_CACHE_TTL, max_itens=64)
+
+
+class LinhaRanking(NamedTuple):
+    # as cinco primeiras posições são as que os templates leem (r[0]..r[4])
+    consultor: str
+    total_eq: float
+    total_or: float
+    meta: float
+    falta: float
+    posicao: int
+    dia_eq: float
+    dia_or: float
+
+
+@dataclass
+class RankingPeriodo:
+    data_ini: str
+    data_fim: str
+    dia: str
+    linhas: list = field(default_factory=list)
+    total_eq: float = 0.0
+    total_or: float = 0.0
+    dia_eq: float = 0.0
+    dia_or: float = 0.0
+    meta_dia: float = 0.0
+    falta_meta_dia: float = 0.0
+
+
+def consulta_ranking(ph):
+    # pagos no período e produção do dia (qualquer status) por consultor, numa passada
+    pagos = f"p.status_id = {ph} AND p.dia >= {ph} AND p.dia <= {ph}"
+    return f"""
+        SELECT p.consultor,
+               COALESCE(SUM(CASE WHEN {pagos} THEN p.total_eq END), 0),
+               COALESCE(SUM(CASE WHEN {pagos} THEN p.total_or END), 0),
+               COALESCE(SUM(CASE WHEN p.dia = {ph} THEN p.total_eq END), 0),
+               COALESCE(SUM(CASE WHEN p.dia = {ph} THEN p.total_or END), 0)
+        FROM propostas_diarias p
+        WHERE (p.dia >= {ph} AND p.dia <= {ph}) OR p.dia = {ph}
+        GROUP BY p.consultor
+    """
+
+
+def hoje_sao_paulo():
+    # o "hoje" dos painéis e do canal ao vivo, independente do fuso do servidor
+    return datetime.now(pytz.timezone("America/Sao_Paulo")).date()
+
+
+def ranking_periodo(data_ini, data_fim, dia=None, leitura=True):
+    # leitura=False (canal ao vivo) lê do primário e ignora o que está no cache, que
+    # pode ter vindo de uma réplica atrasada em relação à escrita que gerou o aviso.
+    dia = dia or hoje_sao_paulo().isoformat()
+    chave = (data_ini, data_fim, dia, "postgres" if DATABASE_URL else "sqlite")
+    ranking = _cache_ranking.obter(chave) if leitura else None
+    if ranking is not None:
+        return ranking
+
+    conn = get_conn(leitura=leitura)
+    try:
+        cur = conn.cursor()
+        ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+        pago = codigo_dimensao(cur, "status", "PAGO")
+        cur.execute(consulta_ranking(ph), (
+            pago, data_ini, data_fim, pago, data_ini, data_fim, dia, dia, data_ini, data_fim, dia
+        ))
+        somas = {r[0]: [float(v or 0) for v in r[1:]] for r in cur.fetchall()}
+        consultores = consultores_cadastrados(cur)
+        metas = metas_individuais(cur)
+        meta_dia = meta_dia_atual(cur)
+    finally:
+        conn.close()
+
+    linhas = []
+    for nome in consultores:
+        eq, or_, dia_eq, dia_or = somas.get(nome, (0.0, 0.0, 0.0, 0.0))
+        meta = float(metas.get(nome) or 0)
+        linhas.append((nome, eq, or_, meta, meta - eq, dia_eq, dia_or))
+    linhas.sort(key=lambda r: r[1], reverse=True)
+
+    ranking = RankingPeriodo(data_ini, data_fim, dia, meta_dia=meta_dia)
+    for posicao, (nome, eq, or_, meta, falta, dia_eq, dia_or) in enumerate(linhas, 1):
+        ranking.linhas.append(LinhaRanking(nome, eq, or_, meta, falta, posicao, dia_eq, dia_or))
+        ranking.total_eq += eq
+        ranking.total_or += or_
+        ranking.dia_eq += dia_eq
+        ranking.dia_or += dia_or
+    ranking.falta_meta_dia = max(meta_dia - ranking.dia_eq, 0)
+
+    _cache_ranking.guardar(chave, ranking)
+    return ranking
+
+
+def dados_ranking(data_ini, data_fim, leitura=True):
+    return ranking_periodo(data_ini, data_fim, leitura=leitura).linhas
+
+
+# Ritmo do mês: com o calendário de dias úteis e os pagos do mês (do ranking
+# compartilhado), calcula numa passada, para cada consultor e para a meta global,
+# quanto falta, quanto precisa por dia útil restante, a média por dia útil decorrido,
+# a projeção de fechamento e a diferença projetada para a meta. Guardado por dia,
+# com o mesmo TTL e as mesmas invalidações do ranking.
+_cache_ritmo = CacheTTL(RANKING_CACHE_TTL, max_itens=8)
+
+
+class RitmoConsultor(NamedTuple):
+    consultor: str
+    meta: float
+    realizado: float
+    falta: float
+    necessario_dia: float
+    media_dia: float
+    projecao: float
+    gap: float          # meta - projeção: positivo é o que falta no ritmo atual
+
+
+@dataclass
+class RitmoMes:
+    dia: str
+    dias_uteis: int
+    decorridos: int
+    restantes: int
+    geral: RitmoConsultor
+    consultores: dict = field(default_factory=dict)
+    ranking: RankingPeriodo = None
+
+
+def dias_uteis_mes(cur, ph, ano, mes):
+    primeiro = date(ano, mes, 1)
+    ultimo = primeiro + relativedelta(months=1) - timedelta(days=1)
+
+    def consulta(c):
+        # limites reais do mês: no PostgreSQL dia é DATE e '2026-11-31' não existe
+        c.execute(f"SELECT dia FROM calendario WHERE util = 1 AND dia >= {ph} AND dia <= {ph} ORDER BY dia;",
+                  (primeiro.isoformat(), ultimo.isoformat()))
+        dias = [str(r[0]) for r in c.fetchall()]
+        if not dias:
+            # mês fora da faixa do calendário: só os fins de semana
+            dias = [d.isoformat() for d in (primeiro + timedelta(days=i) for i in range(ultimo.day))
+                    if d.weekday() < 5]
+        return dias
+    return _cadastro(cur, f"dias_uteis:{ano:04d}-{mes:02d}", consulta)
+
+
+def _ritmo(nome, meta, realizado, decorridos, restantes):
+    falta = max(meta - realizado, 0.0)
+    media = realizado / decorridos if decorridos else 0.0
+    projecao = realizado + media * restantes
+    return RitmoConsultor(nome, meta, realizado, falta, falta / max(restantes, 1), media, projecao, meta - projecao)
+
+
+def ritmo_mes(dia=None, leitura=True):
+    dia = dia or hoje_sao_paulo().isoformat()
+    chave = (dia, "postgres" if DATABASE_URL else "sqlite")
+    ritmo = _cache_ritmo.obter(chave) if leitura else None
+    if ritmo is not None:
+        return ritmo
+
+    ano, mes = int(dia[:4]), int(dia[5:7])
+    inicio = date(ano, mes, 1)
+    fim = inicio + relativedelta(months=1) - timedelta(days=1)
+    ranking = ranking_periodo(inicio.isoformat(), fim.isoformat(), dia, leitura)
+    with conexao(leitura=leitura) as conn:
+        cur = conn.cursor()
+        ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+        uteis = dias_uteis_mes(cur, ph, ano, mes)
+        meta_global = float(meta_global_atual(cur) or 0)
+
+    decorridos = sum(1 for d in uteis if d <= dia)
+    restantes = len(uteis) - decorridos
+    ritmo = RitmoMes(
+        dia, len(uteis), decorridos, restantes,
+        _ritmo(None, meta_global, ranking.total_eq, decorridos, restantes),
+        {r.consultor: _ritmo(r.consultor, r.meta, r.total_eq, decorridos, restantes) for r in ranking.linhas},
+        ranking,
+    )
+    _cache_ritmo.guardar(chave, ritmo)
+    return ritmo
+
 @app.route("/ranking", methods=["GET"])
 def ranking():
     if "user" not in session:
@@ -1570,62 +4029,282 @@ def ranking():
     data_ini = request.args.get("data_ini")
     data_fim = request.args.get("data_fim")
 
-    agora = datetime.now()
     if not data_ini or not data_fim:
-        data_ini = agora.replace(day=1).strftime("%Y-%m-%d")
-        data_fim = (agora.replace(day=1) + relativedelta(months=1) - timedelta(days=1)).strftime("%Y-%m-%d")
-
-    conn = get_conn()
-    cur = conn.cursor()
-    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
-
-    if isinstance(conn, sqlite3.Connection):
-        query = f"""
-            SELECT u.nome AS consultor,
-                   COALESCE(SUM(p.valor_equivalente), 0) AS total_eq,
-                   COALESCE(SUM(p.valor_original), 0) AS total_or,
-                   COALESCE(m.meta, 0) AS meta,
-                   (COALESCE(m.meta, 0) - COALESCE(SUM(p.valor_equivalente), 0)) AS falta
-            FROM users u
-            LEFT JOIN propostas p
-                ON u.nome = p.consultor
-               AND DATE(p.data) BETWEEN {ph} AND {ph}
-               AND UPPER(p.observacao) = 'PAGO'
-            LEFT JOIN metas_individuais m
-                ON u.nome = m.consultor
-            WHERE u.role != 'admin'
-            GROUP BY u.nome, m.meta
-            ORDER BY total_eq DESC;
-        """
-    else:
-        query = f"""
-            SELECT u.nome AS consultor,
-                   COALESCE(SUM(p.valor_equivalente), 0) AS total_eq,
-                   COALESCE(SUM(p.valor_original), 0) AS total_or,
-                   COALESCE(m.meta, 0) AS meta,
-                   (COALESCE(m.meta, 0) - COALESCE(SUM(p.valor_equivalente), 0)) AS falta
-            FROM users u
-            LEFT JOIN propostas p
-                ON u.nome = p.consultor
-               AND DATE(p.data AT TIME ZONE 'America/Sao_Paulo') BETWEEN {ph} AND {ph}
-               AND UPPER(p.observacao) = 'PAGO'
-            LEFT JOIN metas_individuais m
-                ON u.nome = m.consultor
-            WHERE u.role != 'admin'
-            GROUP BY u.nome, m.meta
-            ORDER BY total_eq DESC;
-        """
-
-    cur.execute(query, (data_ini, data_fim))
-    ranking = cur.fetchall()
-    conn.close()
+        data_ini, data_fim = periodo_mes_atual()
 
     return render_template(
         "ranking.html",
-        ranking=ranking,
+        ranking=dados_ranking(data_ini, data_fim),
         data_ini=data_ini,
-        data_fim=data_fim
+        data_fim=data_fim,
+        ao_vivo=(data_ini, data_fim) == periodo_mes_atual()
     )
 
+# ---------------------------------------------------------------------------
+# Atualizações ao vivo (Server-Sent Events) para /indice_dia e /ranking.
+#
+# Cada escrita em propostas chama publicar_alteracao(). No SQLite o aviso vai
+# direto para o canal do processo; no PostgreSQL vai por NOTIFY, e cada worker
+# do Gunicorn mantém uma única conexão em LISTEN, então o aviso chega a todos.
+# Um despachante por worker recalcula o ranking uma vez por rajada de escritas
+# e entrega o snapshot às telas conectadas, que recebem só o que mudou. Quem
+# conecta (ou reconecta, a cada SSE_DURACAO_MAX) recebe o último snapshot do
+# despachante. Sem escritas, telas ociosas não geram nenhuma consulta.
+#
+# Cada conexão SSE prende um thread do worker. SSE_MAX_CONEXOES é o limite por
+# worker, então cabem workers × SSE_MAX_CONEXOES telas ao vivo (6 com o Procfile:
+# 3 workers × 2, sobrando 2 dos 4 threads de cada um para as outras rotas). As
+# telas além disso voltam ao polling de /api/indice_dia. Para mais TVs, suba
+# --threads junto com SSE_MAX_CONEXOES.
+# ---------------------------------------------------------------------------
+
+CANAL_NOTIFY = "propostas_alteradas"
+SSE_MAX_CONEXOES = int(os.environ.get("SSE_MAX_CONEXOES", 2))
+SSE_DURACAO_MAX = float(os.environ.get("SSE_DURACAO_MAX", 300))
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", 15))
+
+
+def snapshot_ao_vivo():
+    # Sempre do primário: o snapshot é refeito logo depois do aviso de uma escrita.
+    indice = dados_indice_dia(leitura=False)
+    ranking = dados_ranking(*periodo_mes_atual(), leitura=False)
+    return {
+        "indice_dia": {
+            "linhas": {r[0]: [r[1], r[2]] for r in indice["ranking"]},
+            "total_eq": indice["total_eq"],
+            "total_or": indice["total_or"],
+            "meta_dia": indice["meta_dia"],
+            "data_atual": indice["data_atual"],
+        },
+        "ranking": {
+            "linhas": {r[0]: [float(r[1] or 0), float(r[2] or 0), float(r[3] or 0)] for r in ranking},
+        },
+    }
+
+
+def delta_snapshot(anterior, atual):
+    delta = {}
+    for secao, dados in atual.items():
+        antes = (anterior or {}).get(secao, {})
+        linhas_antes = antes.get("linhas", {})
+        parte = {chave: valor for chave, valor in dados.items()
+                 if chave != "linhas" and antes.get(chave) != valor}
+        alteradas = {nome: linha for nome, linha in dados["linhas"].items() if linhas_antes.get(nome) != linha}
+        removidas = [nome for nome in linhas_antes if nome not in dados["linhas"]]
+        if alteradas:
+            parte["linhas"] = alteradas
+        if removidas:
+            parte["removidas"] = removidas
+        if parte:
+            delta[secao] = parte
+    return delta
+
+
+class CanalAoVivo:
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._assinantes = set()
+        self._sinal = threading.Event()
+        self._thread = None
+        # último snapshot calculado, (dia, snapshot); qualquer aviso de escrita o
+        # invalida e sobe a geração, para um cálculo antigo não ser guardado depois
+        self._ultimo = None
+        self._geracao = 0
+        self._calculo_lock = threading.Lock()
+
+    def assinar(self):
+        with self._lock:
+            if len(self._assinantes) >= SSE_MAX_CONEXOES:
+                return None
+            fila = queue.Queue(maxsize=1)
+            self._assinantes.add(fila)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._despachar, name="canal-ao-vivo", daemon=True)
+                self._thread.start()
+        return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            self._assinantes.discard(fila)
+
+    def sinalizar(self):
+        self._invalidar()
+        self._sinal.set()
+
+    def _invalidar(self):
+        with self._lock:
+            self._geracao += 1
+            self._ultimo = None
+
+    def _guardar(self, geracao, dia, snapshot):
+        with self._lock:
+            if geracao == self._geracao:
+                self._ultimo = (dia, snapshot)
+
+    def snapshot_atual(self):
+        # Para quem acaba de conectar: o último snapshot, se ainda vale; senão um
+        # cálculo só, compartilhado pelas telas que conectarem juntas.
+        with self._calculo_lock:
+            dia = hoje_sao_paulo()
+            with self._lock:
+                if self._ultimo is not None and self._ultimo[0] == dia:
+                    return self._ultimo[1]
+                geracao = self._geracao
+            snapshot = snapshot_ao_vivo()
+            self._guardar(geracao, dia, snapshot)
+            return snapshot
+
+    def _entregar(self, snapshot):
+        with self._lock:
+            assinantes = list(self._assinantes)
+        for fila in assinantes:
+            # Só interessa o snapshot mais recente: descarta o que a tela ainda não leu.
+            try:
+                fila.get_nowait()
+            except queue.Empty:
+                pass
+            fila.put_nowait(snapshot)
+
+    def _esperar_sinal(self, timeout):
+        if DATABASE_URL and psycopg2:
+            return self._ouvinte_pg.esperar(timeout)
+        disparado = self._sinal.wait(timeout)
+        self._sinal.clear()
+        return disparado
+
+    def _despachar(self):
+        if DATABASE_URL and psycopg2:
+            self._ouvinte_pg = OuvintePostgres(CANAL_NOTIFY)
+        dia = hoje_sao_paulo()
+        while True:
+            disparado = self._esperar_sinal(60)
+            virou_dia = hoje_sao_paulo() != dia
+            if not (disparado or virou_dia):
+                continue
+            self._invalidar()
+            dia = hoje_sao_paulo()
+
+            # junta uma rajada de escritas em um único recálculo
+            time.sleep(0.5)
+            self._sinal.clear()
+
+            with self._lock:
+                if not self._assinantes:
+                    continue
+                geracao = self._geracao
+            # o aviso pode ter vindo de outro worker, com o cache deste ainda antigo
+            _cache_ranking.limpar()
+            _cache_ritmo.limpar()
+            try:
+                snapshot = snapshot_ao_vivo()
+            except Exception as e:
+                print("⚠️ Erro ao recalcular ranking ao vivo:", e)
+                continue
+            self._guardar(geracao, dia, snapshot)
+            self._entregar(snapshot)
+
+
+class OuvintePostgres:
+    # Conexão dedicada (fora do pool) em LISTEN; espera com select(), sem consultas.
+    def __init__(self, canal):
+        self.canal = canal
+        self.conn = None
+
+    def _conectar(self):
+        self.conn = psycopg2.connect(DATABASE_URL, sslmode="require")
+        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.conn.cursor().execute(f"LISTEN {self.canal};")
+
+    def esperar(self, timeout):
+        try:
+            if self.conn is None or self.conn.closed:
+                self._conectar()
+            if select.select([self.conn], [], [], timeout) == ([], [], []):
+                return False
+            self.conn.poll()
+            recebeu = bool(self.conn.notifies)
+            self.conn.notifies.clear()
+            return recebeu
+        except Exception as e:
+            print("⚠️ Erro no LISTEN do canal ao vivo:", e)
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+            time.sleep(5)
+            return False
+
+
+_canal = None
+_canal_lock = threading.Lock()
+
+
+def canal_ao_vivo():
+    global _canal
+    with _canal_lock:
+        if _canal is None or _canal.pid != os.getpid():
+            _canal = CanalAoVivo()
+        return _canal
+
+
+def publicar_alteracao(conn, subir_versao=True):
+    # Chamar depois do commit da escrita. A versão sobe só depois do commit para um
+    # poll nunca receber o ETag novo com os dados antigos (a fila de escrita do SQLite
+    # já sobe no commit do grupo e passa subir_versao=False).
+    limpar_cache_cadastros()
+    _cache_resumos.limpar()
+    _cache_ranking.limpar()
+    _cache_ritmo.limpar()
+    _cache_series.limpar()
+    if REPLICA_JANELA > 0 and has_request_context():
+        session["ultima_escrita"] = time.time()
+    cur = conn.cursor()
+    if subir_versao:
+        cur.execute("UPDATE cache_versao SET versao = versao + 1 WHERE id = 2;")
+    if isinstance(conn, sqlite3.Connection):
+        conn.commit()
+        canal_ao_vivo().sinalizar()
+    else:
+        cur.execute("SELECT pg_notify(%s, '');", (CANAL_NOTIFY,))
+        conn.commit()
+
+
+@app.route("/api/ao_vivo")
+def api_ao_vivo():
+    if "user" not in session:
+        return jsonify({"erro": "não autenticado"}), 401
+
+    canal = canal_ao_vivo()
+    fila = canal.assinar()
+    if fila is None:
+        # Cada conexão SSE ocupa um thread do worker; acima do limite a tela volta ao polling.
+        print(f"⚠️ Limite de {SSE_MAX_CONEXOES} conexões ao vivo no worker {os.getpid()}; tela em polling.")
+        return jsonify({"erro": "limite de conexões ao vivo atingido"}), 503
+
+    def eventos():
+        enviado = canal.snapshot_atual()
+        yield f"retry: 5000\ndata: {json.dumps(delta_snapshot(None, enviado))}\n\n"
+
+        # A conexão é encerrada de tempos em tempos; o EventSource reconecta sozinho.
+        fim = time.monotonic() + SSE_DURACAO_MAX
+        while time.monotonic() < fim:
+            try:
+                snapshot = fila.get(timeout=SSE_HEARTBEAT)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            delta = delta_snapshot(enviado, snapshot)
+            enviado = snapshot
+            if delta:
+                yield f"data: {json.dumps(delta)}\n\n"
+
+    resp = app.response_class(eventos(), mimetype="text/event-stream")
+    resp.call_on_close(lambda: canal.cancelar(fila))
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
@@ -0,0 +1,499 @@
+"""Benchmark das rotas de leitura com propostas sintéticas.
+
+Semeia um banco novo para cada tamanho pedido, navega pelas rotas com o test
+client do Flask (logado como admin) e grava p50/p95/p99, consultas por
+requisição (via Server-Timing) e pico de memória em JSON:
+
+    python benchmark.py --linhas 10000 100000 1000000
+    python benchmark.py --linhas 10000 --comparar benchmark_<commit>.json
+
+Por padrão usa um SQLite temporário. Com --postgres URL usa esse banco, que é
+APAGADO (propostas, agregado e usuários não-admin) antes de cada semeadura.
+
+Antes das rotas, mede a inicialização de um worker em processos novos: tempo de
+importação do app, tempo do boot (create_app com o schema já migrado) e memória
+residente máxima. Só a inicialização: --linhas sem valores.
+
+Por fim simula a rajada de logins do início do turno (--logins consultores em
+--login-threads threads, repetindo após o 503) enquanto o painel da TV consulta
+/api/indice_dia, e grava o tempo até entrar e o p95 do painel ocioso e durante
+a rajada. Com --login-metodo as senhas são gravadas com outro método e o
+primeiro login de cada um também mede o rehash.
+
+As escritas (--escritas propostas via /nova_proposta em --escrita-threads
+threads) medem propostas/s e erros; no SQLite rodam com e sem a fila de
+escrita única (SQLITE_FILA_ESCRITA).
+"""
+import argparse, json, os, platform, random, resource, sqlite3, subprocess, sys, tempfile, threading, time, tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+LOTE = 5000
+
+PESOS_OBSERVACAO = {
+    "PAGO": 35,
+    "AGUARDANDO SALDO": 15,
+    "EM ANÁLISE": 20,
+    "REPRESENTAÇÃO": 5,
+    "CANCELADO": 15,
+    "AGUARDANDO AVERBAÇÃO": 10,
+}
+PRODUTOS = ["PORTABILIDADE", "REFINANCIAMENTO", "NOVO", "AUMENTO", "CARTÃO"]
+TABELAS = ["6X", "12X", "24X", "36X", "48X", "84X", "96X"]
+PRIMEIROS_NOMES = ["MARIA", "JOSÉ", "ANA", "JOÃO", "ANTÔNIO", "FRANCISCA", "CARLOS", "PAULO", "LÚCIA", "RAIMUNDA"]
+SOBRENOMES = ["DA SILVA", "DOS SANTOS", "PEREIRA", "ALVES", "FERREIRA", "RODRIGUES", "GOMES", "SOUZA", "LIMA", "CONCEIÇÃO"]
+
+
+def rotas(ano, consultor):
+    return [
+        "/dashboard",
+        "/dashboard?periodo=tudo",
+        "/api/dashboard",
+        "/relatorios",
+        f"/relatorios?ano={ano}",
+        f"/relatorios?usuario={consultor}&ano={ano}",
+        "/relatorios?cpf=123",
+        "/relatorios?cpf=123.456.789-01",
+        f"/painel_usuario?consultor={consultor}",
+        f"/painel_usuario?consultor={consultor}&periodo=tudo",
+        f"/painel_usuario?consultor={consultor}&periodo=tudo&busca=silva",
+        "/ranking",
+        "/indice_dia",
+        "/api/indice_dia",
+        f"/api/series?agrupamento=dia&inicio={ano - 2}-01-01",
+        f"/api/series?agrupamento=semana&inicio={ano - 2}-01-01&consultor={consultor}",
+        f"/api/series?agrupamento=mes&inicio={ano - 2}-01-01&fonte=URA&banco=C6",
+    ]
+
+
+def proposta_sintetica(rnd, consultores, pesos, inicio, segundos):
+    data = inicio + timedelta(seconds=rnd.randrange(segundos))
+    observacao = rnd.choices(list(PESOS_OBSERVACAO), weights=list(PESOS_OBSERVACAO.values()))[0]
+    valor_original = round(rnd.lognormvariate(8.5, 0.8), 2)
+    parcelas = rnd.choice([48, 72, 84, 96])
+    cpf = "".join(str(rnd.randrange(10)) for _ in range(11))
+    proposta = (
+        data.strftime("%Y-%m-%d %H:%M:%S"),
+        rnd.choices(consultores, weights=pesos)[0],
+        rnd.choice(A.FONTES_LISTA),
+        rnd.choice(A.BANCOS_LISTA),
+        f"login_{rnd.randrange(1, 6):02d}",
+        rnd.choice(TABELAS),
+        f"{rnd.choice(PRIMEIROS_NOMES)} {rnd.choice(SOBRENOMES)}",
+        f"{cpf[:3]}.{cpf[3:6]}.{cpf[6:9]}-{cpf[9:]}",
+        round(valor_original * rnd.uniform(0.3, 1.2), 2),
+        valor_original,
+        observacao,
+        f"(11) 9{rnd.randrange(10**7, 10**8)}",
+        rnd.choice(PRODUTOS),
+        round(valor_original / parcelas * 1.8, 2),
+        parcelas,
+        (data + timedelta(days=rnd.randrange(5, 40))).strftime("%d/%m/%Y"),
+        rnd.choice(A.MOTIVOS_CANCELAMENTO) if observacao == "CANCELADO" else None,
+    )
+    return (*proposta, *A.colunas_busca(proposta[6], proposta[7]))
+
+
+def semear(linhas, n_consultores, anos, seed):
+    rnd = random.Random(seed)
+    consultores = [f"consultor_{i:03d}" for i in range(1, n_consultores + 1)]
+    pesos = [1 / (i ** 0.5) for i in range(1, n_consultores + 1)]
+    fim = datetime.now()
+    inicio = fim - timedelta(days=365 * anos)
+    segundos = int((fim - inicio).total_seconds())
+
+    conn = A.get_conn()
+    cur = conn.cursor()
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+
+    cur.execute("DELETE FROM propostas;")
+    cur.execute("DELETE FROM propostas_diarias;")
+    cur.execute("DELETE FROM users WHERE role != 'admin';")
+    senha = A.gerar_hash_senha("bench")
+    cur.executemany(f"INSERT INTO users (nome, senha, role) VALUES ({ph}, {ph}, {ph})",
+                    [(nome, senha, "user") for nome in consultores])
+
+    colunas = A.COLUNAS_PROPOSTA + A.COLUNAS_BUSCA + A.COLUNAS_DIMENSAO
+    sql = f"INSERT INTO propostas ({', '.join(colunas)}) VALUES ({','.join([ph] * len(colunas))})"
+    restantes = linhas
+    while restantes > 0:
+        lote = [proposta_sintetica(rnd, consultores, pesos, inicio, segundos)
+                for _ in range(min(LOTE, restantes))]
+        lote = [(*p, *A.codigos_proposta(cur, conn, p[2], p[3], p[10])) for p in lote]
+        cur.executemany(sql, lote)
+        conn.commit()
+        restantes -= len(lote)
+
+    A.reconstruir_agregados(conn)
+    if isinstance(conn, sqlite3.Connection):
+        cur.execute("ANALYZE;")
+    else:
+        cur.execute("ANALYZE propostas;")
+        cur.execute("ANALYZE propostas_diarias;")
+    conn.commit()
+    conn.close()
+    return consultores
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    indice = max(int(round(p / 100 * len(ordenados) + 0.5)) - 1, 0)
+    return ordenados[min(indice, len(ordenados) - 1)]
+
+
+def server_timing(resp):
+    # db;dur=1.2;desc="5 consultas"
+    cabecalho = resp.headers.get("Server-Timing", "")
+    dur, consultas = 0.0, 0
+    for parte in cabecalho.split(";"):
+        parte = parte.strip()
+        if parte.startswith("dur="):
+            dur = float(parte[4:])
+        elif parte.startswith("desc="):
+            consultas = int(parte[5:].strip('"').split()[0])
+    return dur, consultas
+
+
+def limpar_caches():
+    A._cache_resumos.limpar()
+    A._cache_cadastros.limpar()
+    A._cache_ranking.limpar()
+    A._cache_ritmo.limpar()
+    A._cache_series.limpar()
+
+
+def medir(client, url, repeticoes, com_cache):
+    client.get(url)
+    tempos, db_ms, consultas = [], [], 0
+    for _ in range(repeticoes):
+        if not com_cache:
+            limpar_caches()
+        inicio = time.perf_counter()
+        resp = client.get(url)
+        tempos.append((time.perf_counter() - inicio) * 1000)
+        resp.close()
+        if resp.status_code != 200:
+            raise RuntimeError(f"{url} respondeu {resp.status_code}")
+        dur, consultas = server_timing(resp)
+        db_ms.append(dur)
+
+    if not com_cache:
+        limpar_caches()
+    tracemalloc.start()
+    client.get(url).close()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "p50_ms": round(percentil(tempos, 50), 2),
+        "p95_ms": round(percentil(tempos, 95), 2),
+        "p99_ms": round(percentil(tempos, 99), 2),
+        "media_ms": round(sum(tempos) / len(tempos), 2),
+        "db_p50_ms": round(percentil(db_ms, 50), 2),
+        "consultas": consultas,
+        "memoria_pico_kb": round(pico / 1024, 1),
+    }
+
+
+def rodar_tamanho(linhas, args):
+    print(f"🛠️ Semeando {linhas} propostas...")
+    inicio = time.perf_counter()
+    consultores = semear(linhas, args.consultores, args.anos, args.seed)
+    semeadura = time.perf_counter() - inicio
+
+    client = A.app.test_client()
+    resp = client.post("/login", data={"nome": "admin", "senha": "Tech@2025"})
+    if resp.status_code != 302:
+        raise RuntimeError("Login do admin falhou")
+
+    resultado = {"semeadura_s": round(semeadura, 2), "rotas": {}}
+    for url in rotas(datetime.now().year, consultores[0]):
+        resultado["rotas"][url] = dados = medir(client, url, args.repeticoes, args.com_cache)
+        print(f"  {url:<60} p50 {dados['p50_ms']:>9.2f} ms  p95 {dados['p95_ms']:>9.2f} ms  "
+              f"{dados['consultas']:>3} consultas  {dados['memoria_pico_kb']:>9.1f} KB")
+    return resultado
+
+
+def _gravar_propostas(quantidade, seed):
+    rnd = random.Random(seed)
+    client = A.app.test_client()
+    with client.session_transaction() as sessao:
+        sessao["user"], sessao["role"] = "admin", "admin"
+    tempos, erros = [], 0
+    for _ in range(quantidade):
+        cpf = "".join(str(rnd.randrange(10)) for _ in range(11))
+        inicio = time.perf_counter()
+        resp = client.post("/nova_proposta", data={
+            "data_manual": datetime.now().strftime("%Y-%m-%dT%H:%M"),
+            "fonte": rnd.choice(A.FONTES_LISTA),
+            "banco": rnd.choice(A.BANCOS_LISTA),
+            "nome_cliente": f"{rnd.choice(PRIMEIROS_NOMES)} {rnd.choice(SOBRENOMES)}",
+            "cpf": f"{cpf[:3]}.{cpf[3:6]}.{cpf[6:9]}-{cpf[9:]}",
+            "valor_equivalente": f"{rnd.uniform(100, 5000):.2f}",
+            "valor_original": f"{rnd.uniform(100, 5000):.2f}",
+            "observacao": rnd.choice(list(PESOS_OBSERVACAO)),
+        })
+        tempos.append((time.perf_counter() - inicio) * 1000)
+        resp.close()
+        erros += resp.status_code != 200
+    return tempos, erros
+
+
+def medir_escritas(args, sqlite):
+    resultado = {}
+    por_thread = max(args.escritas // args.escrita_threads, 1)
+    for fila in ([False, True] if sqlite else [False]):
+        A.SQLITE_FILA_ESCRITA = fila
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.escrita_threads) as executor:
+            partes = list(executor.map(_gravar_propostas, [por_thread] * args.escrita_threads,
+                                       range(args.escrita_threads)))
+        duracao = time.perf_counter() - inicio
+        tempos = [t for parte, _ in partes for t in parte]
+        modo = "fila" if fila else "direto"
+        resultado[modo] = dados = {
+            "propostas": len(tempos),
+            "threads": args.escrita_threads,
+            "propostas_por_s": round(len(tempos) / duracao, 1),
+            "p50_ms": round(percentil(tempos, 50), 2),
+            "p95_ms": round(percentil(tempos, 95), 2),
+            "erros": sum(erros for _, erros in partes),
+        }
+        if fila:
+            dados["maior_grupo"] = A.fila_escrita().stats["maior_grupo"]
+        print(f"  escritas ({modo}): {dados['propostas_por_s']:.1f} propostas/s  p95 {dados['p95_ms']:.1f} ms  "
+              f"{dados['erros']} erros")
+    A.SQLITE_FILA_ESCRITA = os.environ.get("SQLITE_FILA_ESCRITA", "0") == "1"
+    return resultado
+
+
+def _tempos_painel(client, parar, tempos):
+    while not parar.is_set():
+        limpar_caches()
+        inicio = time.perf_counter()
+        client.get("/api/indice_dia").close()
+        tempos.append((time.perf_counter() - inicio) * 1000)
+        time.sleep(0.05)
+
+
+def _logar(nome):
+    # o navegador repete depois do Retry-After (encurtado para o benchmark)
+    client = A.app.test_client()
+    inicio, recusas = time.perf_counter(), 0
+    while True:
+        resp = client.post("/login", data={"nome": nome, "senha": "bench"})
+        resp.close()
+        if resp.status_code == 302:
+            return (time.perf_counter() - inicio) * 1000, recusas
+        if resp.status_code != 503:
+            raise RuntimeError(f"Login de {nome} respondeu {resp.status_code}")
+        recusas += 1
+        time.sleep(float(resp.headers.get("Retry-After", 1)) / 10)
+
+
+def medir_rajada_login(args):
+    nomes = [f"rajada_{i:03d}" for i in range(args.logins)]
+    conn = A.get_conn()
+    cur = conn.cursor()
+    ph = "?" if isinstance(conn, sqlite3.Connection) else "%s"
+    senha = (A.generate_password_hash("bench", method=args.login_metodo) if args.login_metodo
+             else A.gerar_hash_senha("bench"))
+    cur.execute("DELETE FROM users WHERE nome LIKE 'rajada_%';")
+    cur.executemany(f"INSERT INTO users (nome, senha, role) VALUES ({ph}, {ph}, {ph})",
+                    [(nome, senha, "user") for nome in nomes])
+    A.invalidar_cadastros(cur)
+    conn.commit()
+    conn.close()
+
+    painel = A.app.test_client()
+    if painel.post("/login", data={"nome": "admin", "senha": "Tech@2025"}).status_code != 302:
+        raise RuntimeError("Login do admin falhou")
+
+    ocioso, durante, parar = [], [], threading.Event()
+    monitor = threading.Thread(target=_tempos_painel, args=(painel, parar, ocioso))
+    monitor.start()
+    time.sleep(1)
+    parar.set()
+    monitor.join()
+
+    rehashes = A._senhas["rehashes"]
+    parar = threading.Event()
+    monitor = threading.Thread(target=_tempos_painel, args=(painel, parar, durante))
+    monitor.start()
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.login_threads) as executor:
+        logins = list(executor.map(_logar, nomes))
+    duracao = time.perf_counter() - inicio
+    parar.set()
+    monitor.join()
+
+    conn = A.get_conn()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM users WHERE nome LIKE 'rajada_%';")
+    A.invalidar_cadastros(cur)
+    conn.commit()
+    conn.close()
+
+    tempos = [t for t, _ in logins]
+    resultado = {
+        "logins": args.logins,
+        "threads": args.login_threads,
+        "metodo": A.estatisticas_senhas()["metodo"],
+        "logins_por_s": round(args.logins / duracao, 1),
+        "login_p50_ms": round(percentil(tempos, 50), 2),
+        "login_p95_ms": round(percentil(tempos, 95), 2),
+        "login_max_ms": round(max(tempos), 2),
+        "recusas_503": sum(r for _, r in logins),
+        "rehashes": A._senhas["rehashes"] - rehashes,
+        "painel_ocioso_p95_ms": round(percentil(ocioso, 95), 2),
+        "painel_rajada_p95_ms": round(percentil(durante, 95), 2),
+    }
+    print(f"  rajada de {args.logins} logins ({resultado['metodo']}): {resultado['logins_por_s']:.1f}/s  "
+          f"p95 {resultado['login_p95_ms']:.0f} ms  {resultado['recusas_503']} respostas 503  "
+          f"{resultado['rehashes']} rehashes  painel p95 {resultado['painel_ocioso_p95_ms']:.1f} -> "
+          f"{resultado['painel_rajada_p95_ms']:.1f} ms")
+    return resultado
+
+
+SCRIPT_INICIALIZACAO = """
+import json, resource, sys, time
+sys.path.insert(0, sys.argv[1])
+inicio = time.perf_counter()
+import app
+importado = time.perf_counter()
+app.create_app()
+fim = time.perf_counter()
+print(json.dumps({
+    "importacao_ms": (importado - inicio) * 1000,
+    "boot_ms": (fim - importado) * 1000,
+    "rss_max_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+}))
+"""
+
+
+def medir_inicializacao(raiz, vezes):
+    # A primeira execução migra o banco vazio e fica de fora das medidas.
+    amostras = []
+    for _ in range(vezes + 1):
+        saida = subprocess.run([sys.executable, "-c", SCRIPT_INICIALIZACAO, raiz],
+                               capture_output=True, text=True, check=True).stdout
+        amostras.append(json.loads(saida.strip().splitlines()[-1]))
+    amostras = amostras[1:]
+    resultado = {
+        chave: round(percentil([a[chave] for a in amostras], 50), 2)
+        for chave in ("importacao_ms", "boot_ms", "rss_max_kb")
+    }
+    print(f"  inicialização: importação {resultado['importacao_ms']:.1f} ms  boot {resultado['boot_ms']:.1f} ms  "
+          f"RSS {resultado['rss_max_kb'] / 1024:.1f} MB")
+    return resultado
+
+
+def commit_atual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def comparar(atual, arquivo):
+    with open(arquivo, encoding="utf-8") as f:
+        anterior = json.load(f)
+    print(f"\nComparação com {arquivo} ({anterior.get('commit')}), p95:")
+    for chave, antes in (anterior.get("inicializacao") or {}).items():
+        depois = (atual.get("inicializacao") or {}).get(chave)
+        if depois is not None and antes:
+            alerta = "⚠️" if depois / antes > 1.2 else "  "
+            print(f"{alerta} inicialização {chave:<14} {antes:>9.2f} -> {depois:>9.2f} ({depois / antes:.2f}x)")
+    for modo, depois in (atual.get("escritas") or {}).items():
+        antes = (anterior.get("escritas") or {}).get(modo)
+        if antes and antes["propostas_por_s"]:
+            razao = depois["propostas_por_s"] / antes["propostas_por_s"]
+            alerta = "⚠️" if razao < 0.8 else "  "
+            print(f"{alerta} escritas {modo:<8} {antes['propostas_por_s']:>9.1f} -> {depois['propostas_por_s']:>9.1f} "
+                  f"propostas/s ({razao:.2f}x)")
+    for chave in ("login_p95_ms", "painel_rajada_p95_ms"):
+        antes = (anterior.get("rajada_login") or {}).get(chave)
+        depois = (atual.get("rajada_login") or {}).get(chave)
+        if depois is not None and antes:
+            alerta = "⚠️" if depois / antes > 1.2 else "  "
+            print(f"{alerta} rajada de login {chave:<20} {antes:>9.2f} -> {depois:>9.2f} ({depois / antes:.2f}x)")
+    for linhas, dados in atual["resultados"].items():
+        base = anterior.get("resultados", {}).get(linhas)
+        if not base:
+            continue
+        for url, medidas in dados["rotas"].items():
+            antes = base["rotas"].get(url)
+            if not antes or not antes["p95_ms"]:
+                continue
+            razao = medidas["p95_ms"] / antes["p95_ms"]
+            alerta = "⚠️" if razao > 1.2 else "  "
+            print(f"{alerta} {linhas:>8} {url:<60} {antes['p95_ms']:>9.2f} -> {medidas['p95_ms']:>9.2f} ms ({razao:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--linhas", type=int, nargs="*", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--consultores", type=int, default=40)
+    parser.add_argument("--anos", type=int, default=3)
+    parser.add_argument("--repeticoes", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=2025)
+    parser.add_argument("--inicializacoes", type=int, default=5, help="processos para medir a inicialização (0 desliga)")
+    parser.add_argument("--escritas", type=int, default=2000, help="propostas gravadas via /nova_proposta (0 desliga)")
+    parser.add_argument("--escrita-threads", type=int, default=12, help="threads gravando ao mesmo tempo")
+    parser.add_argument("--logins", type=int, default=100, help="logins simultâneos na rajada (0 desliga)")
+    parser.add_argument("--login-threads", type=int, default=12, help="threads da rajada (3 workers x 4 threads)")
+    parser.add_argument("--login-metodo", metavar="METODO", help="grava as senhas com outro método para medir o rehash")
+    parser.add_argument("--com-cache", action="store_true", help="não limpa os caches entre requisições")
+    parser.add_argument("--postgres", metavar="URL", help="banco PostgreSQL descartável")
+    parser.add_argument("--saida", help="arquivo JSON (padrão: benchmark_<commit>.json)")
+    parser.add_argument("--comparar", metavar="JSON", help="resultado anterior para comparar p95")
+    args = parser.parse_args()
+
+    raiz = os.path.dirname(os.path.abspath(__file__))
+    saida = os.path.abspath(args.saida) if args.saida else None
+    anterior = os.path.abspath(args.comparar) if args.comparar else None
+
+    global A
+    # o app lê DATABASE_URL na importação e abre o local.db no diretório atual: aponta
+    # para o destino antes de importar. As migrações rodam no create_app() abaixo.
+    if args.postgres:
+        os.environ["DATABASE_URL"] = args.postgres
+    else:
+        os.environ.pop("DATABASE_URL", None)
+        os.chdir(tempfile.mkdtemp(prefix="bench_"))
+    inicializacao = medir_inicializacao(raiz, args.inicializacoes) if args.inicializacoes else None
+
+    sys.path.insert(0, raiz)
+    import app as A
+    A.create_app()
+
+    commit = commit_atual()
+    resultado = {
+        "commit": commit,
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "backend": "postgres" if args.postgres else "sqlite",
+        "python": platform.python_version(),
+        "repeticoes": args.repeticoes,
+        "com_cache": args.com_cache,
+        "inicializacao": inicializacao,
+        "resultados": {},
+    }
+    for linhas in args.linhas:
+        resultado["resultados"][str(linhas)] = rodar_tamanho(linhas, args)
+    if args.escritas:
+        resultado["escritas"] = medir_escritas(args, sqlite=not args.postgres)
+    if args.logins:
+        resultado["rajada_login"] = medir_rajada_login(args)
+
+    saida = saida or os.path.join(raiz, f"benchmark_{commit or 'local'}.json")
+    with open(saida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"✅ Resultados gravados em {saida}")
+
+    if anterior:
+        comparar(resultado, anterior)
+
+
+if __name__ == "__main__":
+    main()
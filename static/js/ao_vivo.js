@@ -0,0 +1,39 @@
+function aplicarDeltaAoVivo(estado, delta) {
+  Object.entries(delta).forEach(([secao, parte]) => {
+    const atual = estado[secao] || (estado[secao] = { linhas: {} });
+
+    Object.entries(parte).forEach(([chave, valor]) => {
+      if (chave !== "linhas" && chave !== "removidas") atual[chave] = valor;
+    });
+    Object.assign(atual.linhas, parte.linhas || {});
+    (parte.removidas || []).forEach(nome => delete atual.linhas[nome]);
+  });
+}
+
+function linhasOrdenadas(secao) {
+  return Object.entries(secao.linhas)
+    .map(([nome, valores]) => [nome, ...valores])
+    .sort((a, b) => b[1] - a[1]);
+}
+
+// Abre o canal SSE; se o servidor recusar (limite de conexões) ou o navegador
+// não suportar, chama aoFalhar para a página voltar ao polling.
+function conectarAoVivo(url, secao, aoAtualizar, aoFalhar) {
+  if (!window.EventSource) {
+    aoFalhar();
+    return;
+  }
+
+  const estado = {};
+  const fonte = new EventSource(url);
+
+  fonte.onmessage = ev => {
+    const delta = JSON.parse(ev.data);
+    aplicarDeltaAoVivo(estado, delta);
+    if (delta[secao] && estado[secao]) aoAtualizar(estado[secao]);
+  };
+
+  fonte.onerror = () => {
+    if (fonte.readyState === EventSource.CLOSED) aoFalhar();
+  };
+}
@@ -0,0 +1,213 @@
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app as consigtech
+
+
+@pytest.mark.parametrize("texto, esperado", [
+    ("1.234", 1234.0),
+    ("12.345", 12345.0),
+    ("R$ 2.500", 2500.0),
+    ("1.234.567", 1234567.0),
+    ("1.234,56", 1234.56),
+    ("R$ 1.234,5", 1234.5),
+    ("1234,56", 1234.56),
+    ("1.5", 1.5),
+    ("12.34", 12.34),
+    ("0.500", 0.5),
+    ("1500", 1500.0),
+    ("", 0.0),
+    (None, 0.0),
+    (1234.567, 1234.57),
+])
+def test_normalizar_valor_brl(texto, esperado):
+    assert consigtech.normalizar_valor_brl(texto) == esperado
+
+
+@pytest.mark.parametrize("texto", ["abc", "1.23.4", "-10", "R$ -1,00"])
+def test_normalizar_valor_brl_rejeita(texto):
+    with pytest.raises(ValueError):
+        consigtech.normalizar_valor_brl(texto)
+
+
+def test_verificar_senha_espera_vaga(monkeypatch):
+    # com uma vaga só, os logins da rajada esperam a vez em vez de receber 503
+    monkeypatch.setitem(consigtech._senhas, "vagas", threading.BoundedSemaphore(1))
+    senha_hash = consigtech.gerar_hash_senha("x")
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        resultados = list(executor.map(lambda _: consigtech.verificar_senha(senha_hash, "x"), range(6)))
+    assert resultados == [(True, None)] * 6
+
+
+@pytest.fixture
+def banco(tmp_path, monkeypatch):
+    monkeypatch.setattr(consigtech, "DATABASE_URL", "")
+    monkeypatch.setattr(consigtech, "DATABASE_READ_URL", "")
+    monkeypatch.setattr(consigtech, "LOCAL_DB", str(tmp_path / "teste.db"))
+    return tmp_path / "teste.db"
+
+
+def test_migracoes_banco_novo(banco):
+    ultima = consigtech.MIGRACOES[-1][0]
+    assert consigtech.aplicar_migracoes() == ultima
+    # rodar de novo não reaplica nada
+    assert consigtech.aplicar_migracoes() == ultima
+
+    conn = sqlite3.connect(banco)
+    versoes = [v for (v,) in conn.execute("SELECT versao FROM schema_version ORDER BY versao")]
+    tabelas = {n for (n,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.close()
+    assert versoes == [v for v, _, _ in consigtech.MIGRACOES]
+    assert {"users", "propostas", "propostas_diarias", "cache_versao", "calendario",
+            "propostas_series", "series_pendentes"} <= tabelas
+
+
+def test_migracoes_nao_dependem_do_codigo_atual(banco, monkeypatch):
+    # migração publicada não muda quando as listas e funções do app mudam
+    def falha(*args):
+        raise AssertionError("migração chamou código do app")
+    for nome in ("FONTES_LISTA", "BANCOS_LISTA", "OBSERVACOES_LISTA"):
+        monkeypatch.setattr(consigtech, nome, [])
+    for nome in ("colunas_busca", "sincronizar_calendario", "_criar_codigo", "_chave_texto"):
+        monkeypatch.setattr(consigtech, nome, falha)
+    consigtech.aplicar_migracoes()
+
+    conn = sqlite3.connect(banco)
+    assert conn.execute("SELECT chave FROM status_proposta ORDER BY id").fetchall()[:2] == [("pago",), ("aguardando_saldo",)]
+    assert conn.execute("SELECT COUNT(*) FROM bancos").fetchone() == (11,)
+    conn.close()
+
+
+def test_close_repetido_nao_devolve_emprestimo_alheio(banco):
+    consigtech.aplicar_migracoes()
+    externo = consigtech.get_conn()
+    interno = consigtech.get_conn()
+    assert isinstance(externo, sqlite3.Connection)
+    externo.cursor().execute("INSERT INTO meta_dia (valor) VALUES (1)")
+
+    interno.close()
+    interno.close()
+    # o segundo close não contou como devolução do externo, que segue com a transação
+    assert externo.in_transaction
+    with pytest.raises(sqlite3.ProgrammingError):
+        interno.cursor()
+    externo.close()
+    # com o último empréstimo devolvido, o que não foi commitado é desfeito
+    conn = sqlite3.connect(banco)
+    assert conn.execute("SELECT COUNT(*) FROM meta_dia").fetchone() == (0,)
+    conn.close()
+
+
+def test_cursor_ida_e_volta():
+    token = consigtech.codificar_cursor("2026-03-10 14:00:00", 42, "proxima", 3)
+    assert consigtech.decodificar_cursor(token) == ("2026-03-10 14:00:00", 42, "proxima", 3)
+
+
+@pytest.mark.parametrize("token", ["", None, "lixo!", consigtech.codificar_cursor("2026-01-01", 1, "lado", 1)])
+def test_cursor_invalido(token):
+    assert consigtech.decodificar_cursor(token) is None
+
+
+@pytest.fixture
+def propostas_paginadas():
+    conn = sqlite3.connect(":memory:")
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE propostas (id INTEGER PRIMARY KEY, data TEXT)")
+    # datas repetidas para o desempate por id e algumas sem data, que vão para o fim
+    cur.executemany("INSERT INTO propostas (id, data) VALUES (?, ?)",
+                    [(i, f"2026-01-{(i // 3) + 1:02d}" if i % 7 else None) for i in range(1, 26)])
+    esperado = [i for i, _ in cur.execute(
+        "SELECT id, data FROM propostas ORDER BY data IS NULL, data DESC, id DESC")]
+    return cur, esperado
+
+
+@pytest.mark.parametrize("por_pagina", [4, 10])
+def test_paginar_keyset_percorre_tudo(propostas_paginadas, por_pagina):
+    cur, esperado = propostas_paginadas
+    select_base = "SELECT id, data FROM propostas"
+
+    vistos, token, paginas = [], None, []
+    while True:
+        linhas, anterior, proxima, pagina = consigtech.paginar_keyset(
+            cur, "?", select_base, [], [], token, por_pagina)
+        vistos += [linha[0] for linha in linhas]
+        paginas.append(pagina)
+        if not proxima:
+            break
+        token = proxima
+    assert vistos == esperado
+    assert paginas == list(range(1, len(paginas) + 1))
+
+    # voltando da última página chega na penúltima, igual à ida
+    linhas, _, _, pagina = consigtech.paginar_keyset(cur, "?", select_base, [], [], anterior, por_pagina)
+    assert pagina == len(paginas) - 1
+    assert [linha[0] for linha in linhas] == esperado[(pagina - 1) * por_pagina:pagina * por_pagina]
+
+
+def test_paginar_keyset_ultima_alinhada(propostas_paginadas):
+    cur, esperado = propostas_paginadas
+    select_base = "SELECT id, data FROM propostas"
+    token = consigtech.codificar_cursor(None, None, "ultima", 1)
+
+    # 25 linhas em páginas de 4: a última é a 7ª, só com a última linha sem data
+    linhas, anterior, proxima, pagina = consigtech.paginar_keyset(
+        cur, "?", select_base, [], [], token, 4, total=len(esperado))
+    assert [linha[0] for linha in linhas] == esperado[24:]
+    assert pagina == 7 and proxima is None
+
+    # a anterior junta linhas com e sem data, igual à 6ª página da ida
+    linhas, _, proxima, pagina = consigtech.paginar_keyset(cur, "?", select_base, [], [], anterior, 4)
+    assert [linha[0] for linha in linhas] == esperado[20:24]
+    assert pagina == 6 and proxima is not None
+
+
+@pytest.fixture
+def cliente(banco):
+    consigtech.aplicar_migracoes()
+    consigtech.garantir_admin()
+    consigtech.limpar_cache_cadastros()
+    consigtech.app.config["TESTING"] = True
+    cliente = consigtech.app.test_client()
+    assert cliente.post("/login", data={"nome": "admin", "senha": "Tech@2025"}).status_code == 302
+    return cliente
+
+
+def test_rotas_gravam_pela_fila(cliente, banco, monkeypatch):
+    monkeypatch.setattr(consigtech, "SQLITE_FILA_ESCRITA", True)
+    monkeypatch.setitem(consigtech._fila_escrita, "fila", None)
+
+    assert cliente.post("/register", data={"nome": "bia", "senha": "x", "role": "user"}).status_code == 200
+    assert cliente.post("/editar_meta", data={"nova_meta": "5000"}).status_code == 302
+    assert cliente.post("/editar_meta_dia", data={"nova_meta_dia": "300"}).status_code == 302
+    assert cliente.post("/editar_meta_individual", data={"consultor": "bia", "nova_meta": "10"}).status_code == 302
+    assert cliente.post("/excluir/999").status_code == 302
+
+    assert consigtech._fila_escrita["fila"].stats["escritas"] == 5
+    conn = sqlite3.connect(banco)
+    assert conn.execute("SELECT valor FROM metas_globais").fetchall() == [(5000.0,)]
+    assert conn.execute("SELECT meta FROM metas_individuais WHERE consultor = 'bia'").fetchall() == [(10.0,)]
+    conn.close()
+
+
+def test_snapshot_ao_vivo_vira_no_dia_de_sao_paulo(monkeypatch):
+    # 01:30 UTC ainda é o dia anterior em São Paulo: o snapshot guardado continua valendo
+    agora = {"utc": consigtech.datetime(2026, 3, 11, 1, 30, tzinfo=consigtech.pytz.utc)}
+
+    class Relogio(consigtech.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return agora["utc"].astimezone(tz) if tz else agora["utc"].replace(tzinfo=None)
+
+    calculos = []
+    monkeypatch.setattr(consigtech, "datetime", Relogio)
+    monkeypatch.setattr(consigtech, "snapshot_ao_vivo", lambda: calculos.append(1) or len(calculos))
+    canal = consigtech.CanalAoVivo()
+    canal._guardar(canal._geracao, consigtech.date(2026, 3, 10), "ontem em SP")
+    assert canal.snapshot_atual() == "ontem em SP"
+
+    agora["utc"] = consigtech.datetime(2026, 3, 11, 3, 30, tzinfo=consigtech.pytz.utc)
+    assert canal.snapshot_atual() == 1
+    assert canal.snapshot_atual() == 1